@@ -0,0 +1,65 @@
+import os
+import socket
+import threading
+
+# machine this process runs on; workers of the node of the API read the chunks
+# straight from its disk instead of receiving their bytes
+NODE_ID = os.environ.get('NODE_ID', socket.gethostname())
+# queue every worker consumes, chunks go there when the node of the API is busy
+DEFAULT_QUEUE = os.environ.get('CELERY_QUEUE', 'celery')
+
+
+def node_queue(node_id: str = NODE_ID) -> str:
+    """
+    Queue only the workers of node_id consume.
+    """
+    return f'node.{node_id}'
+
+
+class NodeRouter:
+    """
+    Picks the queue of every chunk sent: the queue of the node holding the
+    decoded song while its workers have room (capacity chunks in flight),
+    the queue shared by every node otherwise.
+    """
+
+    def __init__(self, node_id: str = NODE_ID, capacity: int = 0):
+        self.node_id = node_id
+        self.capacity = capacity
+        self.local = 0
+        self.remote = 0
+        self._lock = threading.Lock()
+        # task id -> sent to the local node
+        self._in_flight = {}
+
+    def set_capacity(self, capacity: int):
+        with self._lock:
+            self.capacity = capacity
+
+    def route(self, task_id: str):
+        """
+        Queue of the task and whether it stays on this node.
+        """
+        with self._lock:
+            local = sum(self._in_flight.values()) < self.capacity
+            self._in_flight[task_id] = local
+            if local:
+                self.local += 1
+            else:
+                self.remote += 1
+        return (node_queue(self.node_id), True) if local else (DEFAULT_QUEUE, False)
+
+    def release(self, task_id: str):
+        """
+        The task finished or was revoked.
+        """
+        with self._lock:
+            self._in_flight.pop(task_id, None)
+
+    def local_in_flight(self) -> int:
+        with self._lock:
+            return sum(self._in_flight.values())
+
+    def clear(self):
+        with self._lock:
+            self._in_flight.clear()
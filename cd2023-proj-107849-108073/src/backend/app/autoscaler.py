@@ -0,0 +1,225 @@
+"""
+Starts and stops local celery workers to follow the load.
+
+Every AUTOSCALE_INTERVAL seconds the controller reads the chunks waiting in
+RabbitMQ (plus the ones still queued in the API scheduler), the time the
+workers took per chunk (jobs table of the store the API writes, backend/DATA_FILES/music.db
+or STORE_PATH) and the load of the machine,
+and keeps enough workers to go through that backlog in AUTOSCALE_TARGET_MAKESPAN
+seconds. The cores are split between the workers (TORCH_NUM_THREADS).
+
+Run it from this folder instead of starting the workers by hand:
+    python autoscaler.py
+    DEMUCS_MODEL=stub python autoscaler.py --broker amqp://localhost:5672
+    python autoscaler.py --store /path/to/backend/DATA_FILES/music.db
+"""
+import argparse
+import json
+import math
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+from kombu import Connection
+
+from store import Store, STORE_PATH
+from affinity import node_queue
+
+BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'amqp://192.168.0.100:5672')
+TASK_QUEUE = os.environ.get('CELERY_QUEUE', 'celery')
+AUTOSCALE_MIN_WORKERS = int(os.environ.get('AUTOSCALE_MIN_WORKERS', '1'))
+AUTOSCALE_MAX_WORKERS = int(os.environ.get('AUTOSCALE_MAX_WORKERS', str(os.cpu_count() or 1)))
+# seconds the current backlog should take to go through
+AUTOSCALE_TARGET_MAKESPAN = float(os.environ.get('AUTOSCALE_TARGET_MAKESPAN', '60'))
+AUTOSCALE_INTERVAL = float(os.environ.get('AUTOSCALE_INTERVAL', '5'))
+# seconds without scaling before a worker is retired
+AUTOSCALE_COOLDOWN = float(os.environ.get('AUTOSCALE_COOLDOWN', '30'))
+# load average per core over which no worker is added
+AUTOSCALE_MAX_LOAD = float(os.environ.get('AUTOSCALE_MAX_LOAD', '0.9'))
+# seconds per chunk assumed until the workers reported some
+AUTOSCALE_DEFAULT_CHUNK_TIME = float(os.environ.get('AUTOSCALE_DEFAULT_CHUNK_TIME', '10'))
+# GET /scheduler of the API, to count the chunks not sent to RabbitMQ yet
+AUTOSCALE_API_URL = os.environ.get('AUTOSCALE_API_URL', '')
+
+
+def plan(backlog: int, chunk_time: float, workers: int, cpus: int, load: float,
+         target: float = AUTOSCALE_TARGET_MAKESPAN, min_workers: int = AUTOSCALE_MIN_WORKERS,
+         max_workers: int = AUTOSCALE_MAX_WORKERS, max_load: float = AUTOSCALE_MAX_LOAD):
+    """
+    Number of workers wanted for backlog chunks taking chunk_time seconds each,
+    and the torch threads each of them should use.
+    Workers are added all at once but retired one at a time.
+    """
+    desired = math.ceil(backlog * chunk_time / target) if backlog else 0
+    desired = max(min_workers, min(max_workers, desired))
+    if desired > workers and load / cpus > max_load:
+        # the cores are already busy, more processes would only slow every chunk down
+        desired = max(workers, min_workers)
+    elif desired < workers:
+        desired = workers - 1
+    threads = max(1, cpus // max(1, desired))
+    return desired, threads
+
+
+class WorkerPool:
+    """
+    Celery worker processes started by the controller.
+    command(name, threads) returns the command line of a worker.
+    """
+
+    def __init__(self, command, cwd: str = None, env: dict = None):
+        self.command = command
+        self.cwd = cwd
+        self.env = env or {}
+        # (process, threads), oldest first
+        self.workers = []
+        self._retiring = []
+        self._started = 0
+
+    def spawn(self, threads: int):
+        self._started += 1
+        env = dict(os.environ, **self.env, TORCH_NUM_THREADS=str(threads), OMP_NUM_THREADS=str(threads))
+        process = subprocess.Popen(self.command(f'autoscale{self._started}', threads), cwd=self.cwd, env=env)
+        self.workers.append((process, threads))
+        print(f'Started worker {process.pid} with {threads} threads')
+
+    def retire(self, index: int = 0):
+        """
+        Warm shutdown: the worker finishes its current chunk before exiting.
+        """
+        process, _ = self.workers.pop(index)
+        process.send_signal(signal.SIGTERM)
+        self._retiring.append(process)
+        print(f'Retiring worker {process.pid}')
+
+    def reap(self):
+        """
+        Forget the workers that exited.
+        """
+        self.workers = [(p, t) for p, t in self.workers if p.poll() is None]
+        self._retiring = [p for p in self._retiring if p.poll() is None]
+
+    def stop(self, timeout: float = 60):
+        while self.workers:
+            self.retire()
+        deadline = time.time() + timeout
+        for process in self._retiring:
+            try:
+                process.wait(max(0, deadline - time.time()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self._retiring = []
+
+    def __len__(self):
+        return len(self.workers)
+
+
+def celery_worker(name: str, threads: int):
+    return [sys.executable, '-m', 'celery', '-A', 'celeryapp', 'worker', '--concurrency', '1',
+            '--loglevel', 'info', '-n', f'{name}@%h']
+
+
+class Autoscaler:
+    """
+    Measures the load and resizes the pool, see plan.
+    """
+
+    def __init__(self, pool: WorkerPool, store: Store = None, broker_url: str = BROKER_URL,
+                 api_url: str = AUTOSCALE_API_URL, cooldown: float = AUTOSCALE_COOLDOWN, **limits):
+        self.pool = pool
+        self.store = store or Store()
+        self.broker_url = broker_url
+        self.api_url = api_url
+        self.cooldown = cooldown
+        self.limits = limits
+        self.cpus = os.cpu_count() or 1
+        self._last_change = 0.0
+
+    def queue_depth(self) -> int:
+        """
+        Chunks waiting in RabbitMQ (shared and node queues) and, when the API is known, in its scheduler.
+        """
+        with Connection(self.broker_url) as connection:
+            _, depth, _ = connection.default_channel.queue_declare(queue=TASK_QUEUE, passive=True)
+            # chunks kept for the workers of this node, the queue exists once one of them started
+            try:
+                _, local, _ = connection.channel().queue_declare(queue=node_queue(), passive=True)
+                depth += local
+            except Exception:
+                pass
+        if self.api_url:
+            try:
+                with urllib.request.urlopen(self.api_url, timeout=2) as response:
+                    depth += json.load(response)["pending"]
+            except (OSError, ValueError, KeyError) as e:
+                print(f'Could not read the scheduler of the API: {e}')
+        return depth
+
+    def chunk_time(self) -> float:
+        times = self.store.recent_job_times()
+        return sum(times) / len(times) if times else AUTOSCALE_DEFAULT_CHUNK_TIME
+
+    def step(self):
+        self.pool.reap()
+        try:
+            depth = self.queue_depth()
+        except Exception as e:
+            print(f'Could not read the queue: {e}')
+            return
+        # chunks being separated right now are part of the backlog too
+        backlog = depth + len(self.pool)
+        workers = len(self.pool)
+        desired, threads = plan(backlog, self.chunk_time(), workers, self.cpus, os.getloadavg()[0], **self.limits)
+
+        now = time.time()
+        if desired > workers:
+            for _ in range(desired - workers):
+                self.pool.spawn(threads)
+            self._last_change = now
+        elif desired < workers and now - self._last_change >= self.cooldown:
+            self.pool.retire()
+            self._last_change = now
+        else:
+            # replace, one per step, the workers using a stale number of threads
+            stale = [i for i, (_, t) in enumerate(self.pool.workers) if t != threads]
+            if stale and now - self._last_change >= self.cooldown:
+                self.pool.retire(stale[0])
+                self.pool.spawn(threads)
+                self._last_change = now
+
+    def run(self, interval: float = AUTOSCALE_INTERVAL):
+        try:
+            while True:
+                self.step()
+                time.sleep(interval)
+        finally:
+            self.pool.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--broker', default=BROKER_URL)
+    parser.add_argument('--api', default=AUTOSCALE_API_URL, help='URL of GET /scheduler of the API')
+    parser.add_argument('--min', type=int, default=AUTOSCALE_MIN_WORKERS)
+    parser.add_argument('--max', type=int, default=AUTOSCALE_MAX_WORKERS)
+    parser.add_argument('--target', type=float, default=AUTOSCALE_TARGET_MAKESPAN)
+    parser.add_argument('--interval', type=float, default=AUTOSCALE_INTERVAL)
+    parser.add_argument('--store', default=STORE_PATH, help='database of the API, for the time taken per chunk')
+    args = parser.parse_args()
+
+    pool = WorkerPool(celery_worker, cwd=os.path.dirname(os.path.abspath(__file__)), env={'CELERY_BROKER_URL': args.broker})
+    if not os.path.exists(args.store):
+        print(f'No database at {args.store}, the time per chunk is estimated until the API writes one')
+    autoscaler = Autoscaler(pool, Store(args.store), broker_url=args.broker, api_url=args.api,
+                            target=args.target, min_workers=args.min, max_workers=args.max)
+    try:
+        autoscaler.run(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+# shared between the API and the workers, so it must live on a path both can reach
+DEFAULT_ROOT = os.environ.get(
+    'BLOB_STORE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'DATA_FILES', 'blobs')
+)
+
+
+class BlobStore:
+    """
+    Content-addressed store of binary blobs kept in a local (or shared) directory.
+    Blobs are named after the sha256 of their content, so writing the same
+    content twice is a no-op.
+    """
+
+    def __init__(self, root: str = DEFAULT_ROOT):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def put(self, data: bytes) -> str:
+        key = hashlib.sha256(data).hexdigest()
+        path = self.path(key)
+        if os.path.exists(path):
+            # refresh the mtime so prune() keeps it around
+            os.utime(path)
+            return key
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so readers never see a partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return key
+
+    def get(self, key: str) -> bytes:
+        with open(self.path(key), 'rb') as f:
+            return f.read()
+
+    def copy_to(self, key: str, destination: str):
+        """
+        Copy a blob to destination without loading it in memory.
+        """
+        shutil.copyfile(self.path(key), destination)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def prune(self, max_age: float):
+        """
+        Remove every blob that was not written for max_age seconds.
+        """
+        limit = time.time() - max_age
+        for folder in os.listdir(self.root):
+            folder = os.path.join(self.root, folder)
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                path = os.path.join(folder, name)
+                try:
+                    if os.path.getmtime(path) < limit:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
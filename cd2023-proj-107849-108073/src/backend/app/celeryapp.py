@@ -1,75 +1,105 @@
-import base64
-
 from celery import Celery, current_task
+from celery.signals import celeryd_after_setup, worker_init, worker_process_init
 from multiprocessing import current_process
 from celery.exceptions import Retry
 
-from demucs.apply import apply_model
-from demucs.pretrained import get_model
-from demucs.audio import AudioFile, save_audio
+from inference import load_model, preload, separate_file, separate_pcm, get_batcher, DEFAULT_MODEL, DEMUCS_BATCH_SIZE
+from transport import decode_payload, encode_payload, reply_mode, CHUNK_TRANSPORT
+from affinity import NODE_ID, node_queue
 
 import torch
 import os 
 import time
 import shutil
 
-torch.set_num_threads(1)
-os.environ['OMP_NUM_THREADS'] = '1'
+# one thread per worker by default, the autoscaler splits the cores between its workers
+TORCH_NUM_THREADS = int(os.environ.get('TORCH_NUM_THREADS', '1'))
+torch.set_num_threads(TORCH_NUM_THREADS)
+os.environ['OMP_NUM_THREADS'] = str(TORCH_NUM_THREADS)
 
 CELERY_IMPORTS = [
 'app.tasks',
 ]
-tasks = Celery('tasks', broker='amqp://192.168.0.100:5672', backend='rpc://192.168.0.100:5672')
+BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'amqp://192.168.0.100:5672')
+RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND', 'rpc://')
+tasks = Celery('tasks', broker=BROKER_URL, backend=RESULT_BACKEND)
+tasks.conf.update(
+    # a chunk takes seconds, workers should not hold chunks another worker could start
+    worker_prefetch_multiplier=1,
+    accept_content=['json', 'pickle'],
+    result_accept_content=['json', 'pickle'],
+    # raw bytes stems can only be sent back with pickle
+    result_serializer='pickle' if CHUNK_TRANSPORT == 'bytes' else 'json',
+)
+
+# chunks of concurrent tasks are separated together, turned off by init_worker when the pool cannot run them at once
+batching = DEMUCS_BATCH_SIZE > 1
+
+@celeryd_after_setup.connect
+def listen_node_queue(sender, instance, **kwargs):
+    # besides the shared queue, chunks of songs decoded on this node
+    instance.app.amqp.queues.select_add(node_queue())
+    print(f'Worker {sender} of node {NODE_ID}')
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    # load the models once per worker process instead of once per chunk
+    preload()
+
+@worker_init.connect
+def init_worker(sender=None, **kwargs):
+    global batching
+    pool = str(getattr(sender, 'pool_cls', 'prefork'))
+    # with --pool threads (batching) the tasks run in the main process, which has no worker_process_init
+    if 'prefork' not in pool:
+        preload()
+    concurrency = getattr(sender, 'concurrency', 1) or 1
+    if batching and ('thread' not in pool or concurrency < DEMUCS_BATCH_SIZE):
+        # every process runs one task at a time, a batch would never fill and only add its wait
+        print(f'DEMUCS_BATCH_SIZE={DEMUCS_BATCH_SIZE} needs --pool threads --concurrency {DEMUCS_BATCH_SIZE} or more '
+              f'(pool {pool}, concurrency {concurrency}), batching is disabled')
+        batching = False
+
 
 @tasks.task(bind=True, default_retry_delay=5)
-def process_wave(self, wave_data, id, job_id):
+def process_wave(self, wave_data, id, job_id, model_name=DEFAULT_MODEL, audio=None, stems=None):
+    """
+    Separate one chunk.
+    When audio describes the chunk format, wave_data carries raw PCM and everything
+    happens in memory; otherwise wave_data is a WAV file processed through temp/.
+    Only the stems listed in stems (all of them when empty) are sent back.
+    """
     start_time = time.time()
     try:
 
         worker_name = current_process().pid    
-        wave_bytes = base64.b64decode(wave_data)
-        # save file
-        if not os.path.exists('temp'):
-            os.makedirs('temp')
+        wave_bytes = decode_payload(wave_data)
+        decode_time = time.time() - start_time
+        # stems go back through the blob store when this worker shares it with the API
+        # (chunks read from the disk of the node or from the blob store), inside the result otherwise
+        mode = reply_mode(wave_data)
         
-        if not os.path.exists(f'temp/{worker_name}'):
-            os.makedirs(f'temp/{worker_name}')
+        # get the model (cached for the lifetime of the worker process)
+        model, load_time = load_model(model_name)
     
-        # remove every file in the folder
-        # IT SHOULD BE EMPTY
-        for file in os.listdir(f'temp/{worker_name}'):
-            os.remove(f'temp/{worker_name}/{file}')
+        if audio is not None:
+            # chunks of tasks running in other threads are separated in the same model call
+            batcher = get_batcher(model_name) if batching else None
+            output, inference_time = separate_pcm(model, wave_bytes, audio, batcher, stems)
+        else:
+            folder = f'temp/{worker_name}'
+            # remove every file in the folder
+            # IT SHOULD BE EMPTY
+            shutil.rmtree(folder, ignore_errors=True)
+            output, inference_time = separate_file(model, wave_bytes, folder, stems)
 
-        with open(f'temp/{worker_name}/task.wav', 'wb') as f:
-            f.write(wave_bytes)
-        
-        # get the model
-        model = get_model(name='htdemucs')
-        model.cpu()
-        model.eval()
-    
-        # load the audio file
-        wav = AudioFile(f"temp/{worker_name}/task.wav").read(streams=0, samplerate=model.samplerate, channels=model.audio_channels)
-        ref = wav.mean(0)
-        wav = (wav - ref.mean()) / ref.std()
-        
-        # apply the model
-        sources = apply_model(model, wav[None], device='cpu', progress=True, num_workers=1)[0]
-        sources = sources * ref.std() + ref.mean()
-        output_binary = {}
-    
-        # store the model
-        for source, name in zip(sources, model.sources):
-            stem = f'temp/{worker_name}/{name}.wav'
-            print(stem)
-            save_audio(source, str(stem), samplerate=model.samplerate)
-            with open(stem, 'rb') as f:
-                output_binary[name] = base64.b64encode(f.read())
+        encode_start = time.time()
+        output_binary = {name: encode_payload(data, mode) for name, data in output.items()}
 
-        # remove the file
-        shutil.rmtree(f'temp/{worker_name}')
         end_time = time.time()
-        return [id, output_binary, end_time - start_time, job_id]
+        timings = {"load": load_time, "inference": inference_time, "decode": decode_time,
+                   "encode": end_time - encode_start, "total": end_time - start_time}
+        return [id, output_binary, end_time - start_time, job_id, timings]
     except AssertionError as e:
         current_task.retry(exc=e, countdown=3)
         
@@ -77,4 +107,3 @@ def process_wave(self, wave_data, id, job_id):
         print(f'Error: {e}')
 
         raise self.retry(exc=e)
-    
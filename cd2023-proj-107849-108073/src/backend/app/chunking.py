@@ -0,0 +1,213 @@
+import os
+import threading
+import wave
+
+import numpy as np
+
+from pcm import read_wav, to_pcm
+
+# seconds; "auto" picks the length from the song duration and the number of workers
+CHUNK_LENGTH = os.environ.get('CHUNK_LENGTH', 'auto')
+CHUNK_OVERLAP = float(os.environ.get('CHUNK_OVERLAP', '1.0'))
+CHUNK_CROSSFADE = os.environ.get('CHUNK_CROSSFADE', 'cosine')
+# sample format of the raw PCM chunks sent to the workers (see pcm.PCM_FORMATS)
+CHUNK_PCM_FORMAT = os.environ.get('CHUNK_PCM_FORMAT', 's16')
+
+MIN_CHUNK_LENGTH = 5.0
+MAX_CHUNK_LENGTH = 60.0
+CHUNKS_PER_WORKER = 2
+
+CROSSFADES = ('linear', 'cosine', 'equal_power')
+
+
+def auto_chunk_length(duration: float, workers: int, overlap: float = CHUNK_OVERLAP) -> float:
+    """
+    Pick a chunk length so every worker gets about CHUNKS_PER_WORKER chunks,
+    keeping chunks long enough to give the model context and to amortize the overlap.
+    """
+    workers = max(1, workers)
+    length = duration / (workers * CHUNKS_PER_WORKER) + overlap
+    return min(MAX_CHUNK_LENGTH, max(MIN_CHUNK_LENGTH, overlap * 2, length))
+
+
+def plan_chunks(total_frames: int, chunk_frames: int, overlap_frames: int):
+    """
+    Split total_frames into overlapping windows.
+    Returns a list of (start, length) in frames; consecutive windows overlap by
+    overlap_frames and only the last one may be shorter than chunk_frames.
+    The overlap is at most half a chunk: more and three windows overlap, which
+    the pairwise crossfades of chunk_window cannot sum to 1.
+    """
+    if chunk_frames <= overlap_frames:
+        raise ValueError("The chunk length must be larger than the overlap")
+    if overlap_frames * 2 > chunk_frames:
+        raise ValueError("The overlap must be at most half the chunk length")
+
+    step = chunk_frames - overlap_frames
+    chunks = []
+    start = 0
+    while True:
+        length = min(chunk_frames, total_frames - start)
+        chunks.append((start, length))
+        if start + length >= total_frames:
+            return chunks
+        start += step
+
+
+def fade_in(length: int, shape: str = CHUNK_CROSSFADE) -> np.ndarray:
+    """
+    Gain curve going from 0 to 1 over length frames.
+    """
+    t = (np.arange(length, dtype=np.float32) + 0.5) / max(1, length)
+    if shape == 'linear':
+        return t
+    elif shape == 'cosine':
+        return (0.5 - 0.5 * np.cos(np.pi * t)).astype(np.float32)
+    elif shape == 'equal_power':
+        return np.sin(0.5 * np.pi * t).astype(np.float32)
+    raise ValueError(f"Unknown crossfade {shape}, expected one of {CROSSFADES}")
+
+
+def fade_out(length: int, shape: str = CHUNK_CROSSFADE) -> np.ndarray:
+    """
+    Gain curve going from 1 to 0 over length frames, complementary to fade_in.
+    """
+    if shape == 'equal_power':
+        return np.cos(0.5 * np.pi * ((np.arange(length, dtype=np.float32) + 0.5) / max(1, length))).astype(np.float32)
+    return (1 - fade_in(length, shape)).astype(np.float32)
+
+
+def chunk_window(index: int, chunks, shape: str = CHUNK_CROSSFADE) -> np.ndarray:
+    """
+    Gain applied to every frame of chunk index before it is added to the output.
+    """
+    start, length = chunks[index]
+    window = np.ones(length, dtype=np.float32)
+    if index > 0:
+        previous_start, previous_length = chunks[index - 1]
+        overlap = previous_start + previous_length - start
+        window[:overlap] = fade_in(overlap, shape)
+    if index < len(chunks) - 1:
+        overlap = start + length - chunks[index + 1][0]
+        window[length - overlap:] *= fade_out(overlap, shape)
+    return window
+
+
+def iter_chunks(FileLocation: str, chunks):
+    """
+    Yield the raw PCM frames of every chunk of a WAV file, in order.
+    """
+    with wave.open(FileLocation, 'rb') as source:
+        for start, length in chunks:
+            source.setpos(start)
+            yield source.readframes(length)
+
+
+def read_chunk(FileLocation: str, start: int, length: int) -> bytes:
+    """
+    Raw PCM frames of one chunk of a WAV file.
+    """
+    with wave.open(FileLocation, 'rb') as source:
+        source.setpos(start)
+        return source.readframes(length)
+
+
+def split_wav(FileLocation: str, OutputLocation: str, chunks):
+    """
+    Write every chunk of a WAV file to OutputLocation as splitted-<index>.wav.
+    Returns the list of chunk files, in order.
+    """
+    os.makedirs(OutputLocation, exist_ok=True)
+    with wave.open(FileLocation, 'rb') as source:
+        params = source.getparams()
+
+    files = []
+    for index, data in enumerate(iter_chunks(FileLocation, chunks)):
+        chunk_file = os.path.join(OutputLocation, f"splitted-{index:05d}.wav")
+        with wave.open(chunk_file, 'wb') as out:
+            out.setparams(params)
+            out.writeframes(data)
+        files.append(chunk_file)
+    return files
+
+
+class OverlapAddWriter:
+    """
+    Rebuilds a track from processed overlapping chunks, crossfading each overlap.
+
+    Chunks can be added in any order; every time the next chunks in line are
+    available they are written to OutputFile, so the file always holds the
+    longest finished prefix of the track (frames_written). Only one chunk plus
+    the overlapping tail of the previous one is kept in memory.
+    """
+
+    def __init__(self, OutputFile: str, chunks, shape: str = CHUNK_CROSSFADE):
+        self.output_file = OutputFile
+        self.chunks = chunks
+        self.shape = shape
+        self.frames_written = 0
+        self._ready = {}
+        self._next = 0
+        self._carry = None
+        self._out = None
+        self._lock = threading.Lock()
+
+    def add(self, index: int, chunk_file: str):
+        """
+        Add the processed chunk index and write whatever became final.
+        """
+        with self._lock:
+            self._ready[index] = chunk_file
+            while self._next in self._ready:
+                self._write(self._next, self._ready.pop(self._next))
+                self._next += 1
+            if self.done:
+                self._close()
+
+    @property
+    def done(self) -> bool:
+        return self._next == len(self.chunks)
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+
+    def _write(self, index: int, chunk_file: str):
+        samples, params = read_wav(chunk_file)
+        if self._out is None:
+            self._out = wave.open(self.output_file, 'wb')
+            self._out.setnchannels(params.nchannels)
+            self._out.setsampwidth(params.sampwidth)
+            self._out.setframerate(params.framerate)
+
+        start, length = self.chunks[index]
+        # the model may return a few frames less or more than it got
+        if len(samples) < length:
+            samples = np.pad(samples, ((0, length - len(samples)), (0, 0)))
+        samples = samples[:length] * chunk_window(index, self.chunks, self.shape)[:, None]
+
+        if self._carry is not None:
+            samples[:len(self._carry)] += self._carry
+
+        if index < len(self.chunks) - 1:
+            # frames overlapping the next chunk are only final once it is added
+            ready = self.chunks[index + 1][0] - start
+            self._carry = samples[ready:]
+            samples = samples[:ready]
+        self._out.writeframes(to_pcm(samples, params.sampwidth))
+        self.frames_written += len(samples)
+
+
+def overlap_add(chunk_files, chunks, OutputFile: str, shape: str = CHUNK_CROSSFADE):
+    """
+    Rebuild a track from all its processed overlapping chunks, see OverlapAddWriter.
+    """
+    writer = OverlapAddWriter(OutputFile, chunks, shape)
+    for index, chunk_file in enumerate(chunk_files):
+        writer.add(index, chunk_file)
+    writer.close()
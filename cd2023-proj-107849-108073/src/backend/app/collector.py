@@ -0,0 +1,185 @@
+import os
+import queue
+import socket
+import threading
+import time
+
+# bytes of stems the pending results may carry inside their messages before no more chunks are sent
+COLLECTOR_MEMORY_LIMIT = int(os.environ.get('COLLECTOR_MEMORY_LIMIT', str(512 << 20)))
+
+
+class ResultCollector:
+    """
+    Single consumer of task results for every job running in the API.
+
+    Results are registered with a callback and the callback is called, in the
+    collector thread, as soon as the result message arrives.
+    The collector thread is the only one touching the result consumer, so the
+    broker connection is never shared between threads. With the rpc:// backend
+    every thread has its own reply queue: tasks must be sent with
+    reply_to=collector.reply_to() so their results come to the collector,
+    whatever thread sends them.
+
+    Results carrying their stems inside the message are held in memory until
+    their callback returns. Every result reserves the bytes it may carry when
+    it is added; has_room tells when memory_limit is reached, and on_release
+    is called whenever a reservation is freed, so the sender can resume.
+    """
+
+    def __init__(self, celery_app, drain_timeout: float = 0.5, memory_limit: int = COLLECTOR_MEMORY_LIMIT, on_release=None):
+        self.celery_app = celery_app
+        self.drain_timeout = drain_timeout
+        self.memory_limit = memory_limit
+        self.on_release = on_release
+        # task id -> bytes reserved for its result
+        self._sizes = {}
+        self._held = 0
+        self._registrations = queue.Queue()
+        self._discards = queue.Queue()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        # backend of the collector thread and its reply queue, set once the thread runs
+        self._backend = None
+        self._reply_to = None
+        self._started = threading.Event()
+
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="result-collector", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._started.clear()
+
+    def reply_to(self) -> str:
+        """
+        Queue the results must be sent to (reply_to of apply_async) for the collector to get them.
+        """
+        self.start()
+        self._started.wait()
+        return self._reply_to
+
+    def add(self, async_result, callback, size: int = 0):
+        """
+        Call callback(async_result) once the task finishes (successfully or not).
+        size is the number of bytes the result may carry, held until the callback returns.
+        """
+        with self._lock:
+            self._held += size - self._sizes.get(async_result.id, 0)
+            self._sizes[async_result.id] = size
+        self.start()
+        self._registrations.put((async_result, callback))
+
+    def discard(self, async_result):
+        """
+        Forget one pending result; its callback will not be called.
+        """
+        with self._lock:
+            self._pending.pop(async_result.id, None)
+        self._release(async_result.id)
+        self._discards.put(async_result)
+
+    def has_room(self, size: int = 0) -> bool:
+        """
+        Whether a result of size bytes fits under the memory limit.
+        With nothing held, one result always fits.
+        """
+        with self._lock:
+            return self._held == 0 or self._held + size <= self.memory_limit
+
+    def memory(self) -> int:
+        """
+        Bytes reserved by the pending results.
+        """
+        with self._lock:
+            return self._held
+
+    def _release(self, task_id):
+        with self._lock:
+            size = self._sizes.pop(task_id, 0)
+            self._held -= size
+        if size and self.on_release is not None:
+            self.on_release()
+
+    def clear(self):
+        """
+        Forget every pending result; their callbacks will not be called.
+        """
+        with self._lock:
+            self._pending.clear()
+            self._sizes.clear()
+            self._held = 0
+        while True:
+            try:
+                self._registrations.get_nowait()
+            except queue.Empty:
+                break
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending) + self._registrations.qsize()
+
+    def _register(self):
+        while True:
+            try:
+                async_result, callback = self._registrations.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._pending[async_result.id] = callback
+            # the result sent from another thread is bound to the backend of that thread,
+            # only the consumer of the collector thread receives it
+            async_result = self.celery_app.AsyncResult(async_result.id, backend=self._backend)
+            # results that already arrived are resolved right away by then()
+            async_result.then(self._on_ready)
+
+        while True:
+            try:
+                async_result = self._discards.get_nowait()
+            except queue.Empty:
+                return
+            with self._lock:
+                self._pending.pop(async_result.id, None)
+            try:
+                # the result consumer would otherwise keep waiting for it
+                self._backend.remove_pending_result(async_result)
+            except Exception:
+                pass
+
+    def _on_ready(self, async_result):
+        with self._lock:
+            callback = self._pending.pop(async_result.id, None)
+        if callback is None:
+            return
+        try:
+            callback(async_result)
+        except Exception as e:
+            print(f'Error handling result {async_result.id}: {e}')
+        finally:
+            self._release(async_result.id)
+
+    def _run(self):
+        # the backend and the reply queue (oid) of the app are per thread
+        self._backend = self.celery_app.backend
+        self._reply_to = self._backend.oid
+        self._started.set()
+        consumer = self._backend.result_consumer
+        while self._running:
+            self._register()
+            try:
+                # blocks until a result message arrives (or the timeout expires)
+                consumer.drain_events(timeout=self.drain_timeout)
+            except socket.timeout:
+                pass
+            except Exception as e:
+                print(f'Error draining results: {e}')
+                time.sleep(self.drain_timeout)
@@ -0,0 +1,216 @@
+import asyncio
+import os
+import struct
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from email.utils import formatdate
+
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, Response, StreamingResponse
+
+from ffmpeg_utils import encodeAudio
+
+# format -> (media type, ffmpeg output options), wav is served as is
+DELIVERY_FORMATS = {
+    "wav": ("audio/wav", None),
+    "mp3": ("audio/mpeg", ["-codec:a", "libmp3lame", "-qscale:a", "2"]),
+    "opus": ("audio/ogg", ["-codec:a", "libopus", "-b:a", "128k"]),
+}
+# ffmpeg processes encoding downloads at once
+TRANSCODE_WORKERS = int(os.environ.get("TRANSCODE_WORKERS", "2"))
+# folder, next to the WAV files, keeping their encoded copies
+DELIVERY_DIR = ".delivery"
+RANGE_BLOCK_SIZE = 64 * 1024
+# seconds between checks for new audio while streaming a stem that is being separated
+STREAM_POLL_INTERVAL = float(os.environ.get("STREAM_POLL_INTERVAL", "0.5"))
+STREAM_BLOCK_SIZE = 64 * 1024
+
+
+class Transcoder:
+    """
+    Encodes WAV files to the delivery formats on demand, at most workers at a
+    time, and keeps the encoded files next to them. A file requested again is
+    only encoded again when the WAV changed; requested by several clients at
+    once it is encoded once.
+    """
+
+    def __init__(self, workers: int = TRANSCODE_WORKERS):
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        # target file -> Future of the encoding
+        self._pending = {}
+
+    @staticmethod
+    def target(FileLocation: str, fmt: str) -> str:
+        name = os.path.splitext(os.path.basename(FileLocation))[0]
+        return os.path.join(os.path.dirname(FileLocation), DELIVERY_DIR, name + "." + fmt)
+
+    def submit(self, FileLocation: str, fmt: str) -> Future:
+        """
+        Future of the path of FileLocation encoded in fmt.
+        """
+        options = DELIVERY_FORMATS[fmt][1]
+        target = self.target(FileLocation, fmt)
+        if options is None or self._fresh(FileLocation, target):
+            future = Future()
+            future.set_result(FileLocation if options is None else target)
+            return future
+        with self._lock:
+            future = self._pending.get(target)
+            if future is None:
+                future = self._pending[target] = self._pool.submit(self._encode, FileLocation, target, options)
+                future.add_done_callback(lambda _: self._forget(target))
+            return future
+
+    def _forget(self, target: str):
+        with self._lock:
+            self._pending.pop(target, None)
+
+    @staticmethod
+    def _fresh(FileLocation: str, target: str) -> bool:
+        try:
+            return os.stat(target).st_mtime_ns >= os.stat(FileLocation).st_mtime_ns
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _encode(FileLocation: str, target: str, options) -> str:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # ffmpeg picks the container from the extension, the temporary file keeps it
+        name, extension = os.path.splitext(target)
+        tmp_file = name + ".part" + extension
+        try:
+            encodeAudio(FileLocation, tmp_file, options)
+            os.replace(tmp_file, target)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        return target
+
+
+def etag_of(stat_result: os.stat_result) -> str:
+    return f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """
+    Whether an If-None-Match header matches etag (weak comparison).
+    """
+    tags = [x.strip() for x in header.split(",")]
+    return any(x == "*" or (x[2:] if x.startswith("W/") else x) == etag for x in tags)
+
+
+def parse_range(header: str, size: int):
+    """
+    (first, last) byte, inclusive, of a "bytes=" Range header.
+    None when the header is to be ignored (malformed, other unit or several ranges),
+    raises ValueError when the range is outside of the file.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first:
+            first, last = int(first), int(last) if last else size - 1
+        else:
+            # the last bytes of the file
+            first, last = size - int(last), size - 1
+    except ValueError:
+        return None
+    if first >= size or last < first:
+        raise ValueError("Range outside of the file")
+    return max(0, first), min(last, size - 1)
+
+
+def _read(FileLocation: str, first: int, last: int):
+    with open(FileLocation, "rb") as f:
+        f.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            data = f.read(min(remaining, RANGE_BLOCK_SIZE))
+            if not data:
+                return
+            remaining -= len(data)
+            yield data
+
+
+def file_response(request, FileLocation: str, media_type: str) -> Response:
+    """
+    Serve a file with conditional GET (ETag, If-None-Match) and a single byte range (Range, If-Range).
+    """
+    stat_result = os.stat(FileLocation)
+    size = stat_result.st_size
+    etag = etag_of(stat_result)
+    headers = {
+        "accept-ranges": "bytes",
+        "etag": etag,
+        "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+        # cached by the client, but checked with the ETag before every use
+        "cache-control": "no-cache",
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() == etag):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "content-range": f"bytes */{size}"})
+        if byte_range is not None:
+            first, last = byte_range
+            headers.update({"content-range": f"bytes {first}-{last}/{size}", "content-length": str(last - first + 1)})
+            return StreamingResponse(_read(FileLocation, first, last), status_code=206, media_type=media_type, headers=headers)
+
+    return FileResponse(FileLocation, media_type=media_type, headers=headers, stat_result=stat_result)
+
+
+async def follow_wav(partial: str, output: str, processing, poll_interval: float = STREAM_POLL_INTERVAL):
+    """
+    Stream a WAV file growing at partial, which is moved to output once complete.
+    The header is sent with an unknown length, as players expect for live streams.
+    processing (called in a thread) tells whether the file can still grow.
+    """
+    f = None
+    while f is None:
+        for path in (partial, output):
+            try:
+                f = open(path, "rb")
+                break
+            except FileNotFoundError:
+                pass
+        if f is None:
+            if not await run_in_threadpool(processing):
+                return
+            await asyncio.sleep(poll_interval)
+
+    with f:
+        # the header is written with the first stitched frames
+        while os.fstat(f.fileno()).st_size < 44:
+            if not await run_in_threadpool(processing):
+                return
+            await asyncio.sleep(poll_interval)
+        header = bytearray(f.read(44))
+        struct.pack_into("<I", header, 4, 0xFFFFFFFF)
+        struct.pack_into("<I", header, 40, 0xFFFFFFFF)
+        frame_size = struct.unpack_from("<H", header, 32)[0]
+        yield bytes(header)
+
+        position = 44
+        while True:
+            # the file is complete once moved to output, read what is left and stop
+            done = not os.path.exists(partial) or not await run_in_threadpool(processing)
+            available = (os.fstat(f.fileno()).st_size - position) // frame_size * frame_size
+            while available > 0:
+                f.seek(position)
+                data = await run_in_threadpool(f.read, min(available, STREAM_BLOCK_SIZE))
+                position += len(data)
+                available -= len(data)
+                yield data
+            if done:
+                return
+            await asyncio.sleep(poll_interval)
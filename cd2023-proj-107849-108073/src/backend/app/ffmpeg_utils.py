@@ -1,6 +1,11 @@
 import ffmpeg
 import subprocess
+import tempfile
 import os
+import wave
+
+# frames read from ffmpeg at a time when decoding over a pipe
+PIPE_BLOCK_FRAMES = 1 << 16
 
 def mp3ToWav(FileLocation: str, OutputLocation: str):
     """
@@ -23,6 +28,103 @@ def mp3ToWav(FileLocation: str, OutputLocation: str):
 
 # mp3ToWav("./tracks/test.mp3", "./tracks/wavs/")
 
+def decodeToWav(FileLocation: str, OutputFile: str, samplerate: int = 44100, channels: int = 2):
+    """
+    Decode any audio file to a 16 bit PCM wav file with the given sample rate and channels,
+    streamed from a single ffmpeg process (see decodePcm). The file appears once complete.
+    """
+    tmp_file = OutputFile + ".part"
+    try:
+        with wave.open(tmp_file, "wb") as out:
+            out.setnchannels(channels)
+            out.setsampwidth(2)
+            out.setframerate(samplerate)
+            for block in decodePcm(FileLocation, samplerate, channels):
+                # the header is written once, when the file is closed
+                out.writeframesraw(block)
+        os.replace(tmp_file, OutputFile)
+    except RuntimeError as e:
+        print(e)
+        raise
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def decodePcm(FileLocation: str, samplerate: int = 44100, channels: int = 2, block_frames: int = PIPE_BLOCK_FRAMES):
+    """
+    Decode any audio file to raw 16 bit PCM at the given sample rate and channels,
+    with a single ffmpeg process writing to a pipe. Yields blocks of whole frames.
+    """
+    frame_size = 2 * channels
+    with tempfile.TemporaryFile() as errors:
+        process = subprocess.Popen([
+            "ffmpeg", "-loglevel", "error",
+            "-i", FileLocation,
+            "-f", "s16le", "-acodec", "pcm_s16le", "-ar", str(samplerate), "-ac", str(channels),
+            "pipe:1"
+        ], stdout=subprocess.PIPE, stderr=errors)
+        try:
+            while True:
+                block = process.stdout.read(block_frames * frame_size)
+                if not block:
+                    break
+                yield block
+        finally:
+            # when the caller stops early, ffmpeg ends with a broken pipe
+            process.stdout.close()
+            returncode = process.wait()
+        if returncode != 0:
+            errors.seek(0)
+            raise RuntimeError(f"An error occurred during decoding: {errors.read().decode(errors='replace')}")
+
+
+class PcmEncoder:
+    """
+    Encode raw PCM blocks (16 bit, or sample_format), written to the stdin of a single
+    ffmpeg process, into OutputFile. The format follows the extension of OutputFile (e.g. mp3);
+    options are extra ffmpeg output options (e.g. ["-qscale:a", "2"]).
+    """
+
+    def __init__(self, OutputFile: str, samplerate: int = 44100, channels: int = 2, options=(), sample_format: str = "s16le"):
+        self.OutputFile = OutputFile
+        self._errors = tempfile.TemporaryFile()
+        self.process = subprocess.Popen([
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", sample_format, "-ar", str(samplerate), "-ac", str(channels), "-i", "pipe:0",
+            *options,
+            OutputFile
+        ], stdin=subprocess.PIPE, stderr=self._errors)
+
+    def write(self, block: bytes):
+        self.process.stdin.write(block)
+
+    def close(self):
+        """
+        Wait for ffmpeg to write the end of the file.
+        """
+        try:
+            self.process.stdin.close()
+            if self.process.wait() != 0:
+                self._errors.seek(0)
+                raise RuntimeError(f"An error occurred during encoding: {self._errors.read().decode(errors='replace')}")
+        finally:
+            self._errors.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+        self._errors.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.kill()
+
 
 def getDuration(FileLocation: str) -> float:
     """
@@ -95,23 +197,25 @@ def stitchAudio(FileLocation: str, OutputFile: str):
         chunk_files.sort()
 
         # Generate a text file with the list of chunk files
-        input_list_file = "input_list.txt"
-        with open(input_list_file, "w") as f:
+        # (a temporary file, concurrent stitches must not share it)
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+            input_list_file = f.name
             for chunk_file in chunk_files:
-                f.write(f"file '{os.path.join(FileLocation, chunk_file)}'\n")
+                f.write(f"file '{os.path.abspath(os.path.join(FileLocation, chunk_file))}'\n")
 
         # Run FFmpeg to concatenate the WAV chunks into a single file
-        subprocess.run([
-            "ffmpeg",
-            "-f", "concat",
-            "-safe", "0",
-            "-i", input_list_file,
-            "-c", "copy",
-            OutputFile
-        ])
-
-        # Delete the input list file
-        # os.remove(input_list_file)
+        try:
+            subprocess.run([
+                "ffmpeg",
+                "-f", "concat",
+                "-safe", "0",
+                "-i", input_list_file,
+                "-c", "copy",
+                OutputFile
+            ])
+        finally:
+            # Delete the input list file
+            os.remove(input_list_file)
 
         print(f"WAV chunks stitched together successfully. Output file: {OutputFile}")
     except subprocess.CalledProcessError as e:
@@ -141,5 +245,22 @@ def wavToMp3(FileLocation: str, OutputLocation: str):
     except subprocess.CalledProcessError as e:
         print(f"An error occurred during conversion: {e.stderr}")
 
+# ffmpeg raw formats of the WAV sample widths
+PCM_SAMPLE_FORMATS = {2: "s16le", 4: "s32le"}
+
+def encodeAudio(FileLocation: str, OutputFile: str, options=()):
+    """
+    Encode a WAV file into OutputFile, the format follows its extension (e.g. mp3, opus);
+    options are extra ffmpeg output options (e.g. ["-codec:a", "libopus", "-b:a", "128k"]).
+    The frames are streamed to a single ffmpeg process, see PcmEncoder.
+    """
+    with wave.open(FileLocation, "rb") as f:
+        with PcmEncoder(OutputFile, f.getframerate(), f.getnchannels(), options, PCM_SAMPLE_FORMATS[f.getsampwidth()]) as encoder:
+            while True:
+                block = f.readframes(PIPE_BLOCK_FRAMES)
+                if not block:
+                    break
+                encoder.write(block)
+
 # Example usage
 # wavToMp3("./tracks/wavs/test.wav", "./tracks/mp3/")
\ No newline at end of file
@@ -0,0 +1,278 @@
+import os
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import Future
+
+from demucs.apply import apply_model
+from demucs.pretrained import get_model
+from demucs.audio import AudioFile, save_audio, convert_audio
+
+import torch
+
+from mixer import select_stems
+from pcm import decode_pcm, wav_bytes
+
+# models loaded by this worker process, keyed by name and backend
+_models = {}
+_models_lock = threading.Lock()
+# batchers of this worker process, keyed by model name
+_batchers = {}
+
+DEFAULT_MODEL = os.environ.get('DEMUCS_MODEL', 'htdemucs')
+# extra model variants to load when the worker process starts (comma separated)
+PRELOAD_MODELS = [x.strip() for x in os.environ.get('DEMUCS_PRELOAD_MODELS', DEFAULT_MODEL).split(',') if x.strip()]
+WARMUP_SECONDS = float(os.environ.get('DEMUCS_WARMUP_SECONDS', '1.0'))
+# chunks separated together in one model call, see BatchInferencer (1 disables batching)
+DEMUCS_BATCH_SIZE = int(os.environ.get('DEMUCS_BATCH_SIZE', '1'))
+# seconds the first chunk of a batch waits for the others
+DEMUCS_BATCH_WAIT = float(os.environ.get('DEMUCS_BATCH_WAIT', '0.05'))
+# how the model runs: "eager" (float32), "int8" (dynamic int8 quantization of
+# the linear and LSTM layers) or "compiled" (torch.compile of every sub-model)
+DEMUCS_BACKEND = os.environ.get('DEMUCS_BACKEND', 'eager')
+BACKENDS = ('eager', 'int8', 'compiled')
+
+
+class StubModel:
+    """
+    Stand-in for the separation model, used by tests and benchmarks.
+    It splits the mix evenly between the sources, so the stems add up to the input.
+    """
+    samplerate = 44100
+    audio_channels = 2
+    sources = ['drums', 'bass', 'other', 'vocals']
+
+
+def load_model(name: str = DEFAULT_MODEL, backend: str = DEMUCS_BACKEND):
+    """
+    Return the model with the given name, run with the given backend, loading it only the first time.
+    Returns the model and the time spent loading it (0 when already cached).
+    """
+    key = (name, backend)
+    if key in _models:
+        return _models[key], 0.0
+
+    # tasks running in threads (--pool threads) must not load it twice
+    with _models_lock:
+        if key in _models:
+            return _models[key], 0.0
+        start = time.time()
+        if name == 'stub':
+            model = StubModel()
+        else:
+            model = get_model(name=name)
+            model.cpu()
+            model.eval()
+            model = apply_backend(model, backend)
+        _models[key] = model
+    return model, time.time() - start
+
+
+def apply_backend(model, backend: str):
+    """
+    Prepare a float32 model to run with backend, see DEMUCS_BACKEND.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, expected one of {', '.join(BACKENDS)}")
+    if backend == 'int8':
+        # weights are stored as int8 and activations quantized on the fly, the convolutions stay float32
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8)
+    if backend == 'compiled':
+        # apply_model needs the attributes of the models (segment, samplerate...), only their forward is replaced
+        for sub_model in getattr(model, 'models', [model]):
+            sub_model.forward = torch.compile(sub_model.forward, dynamic=False)
+    return model
+
+
+def warmup(model, seconds: float = WARMUP_SECONDS):
+    """
+    Run one inference on silence so the first real chunk does not pay
+    for lazy allocations.
+    """
+    if isinstance(model, StubModel):
+        return
+    length = int(seconds * model.samplerate)
+    wav = torch.zeros(model.audio_channels, length)
+    with torch.no_grad():
+        apply_model(model, wav[None], device='cpu', progress=False, num_workers=1)
+
+
+def preload(names=None):
+    """
+    Load and warm up every model in names (defaults to PRELOAD_MODELS).
+    """
+    for name in names or PRELOAD_MODELS:
+        model, load_time = load_model(name)
+        start = time.time()
+        warmup(model)
+        print(f'Loaded model {name} ({DEMUCS_BACKEND}) in {load_time:.2f}s (warm-up {time.time() - start:.2f}s)')
+
+
+def separate(model, wav):
+    """
+    Apply the model to a (channels, samples) tensor and return the sources
+    as a (sources, channels, samples) tensor.
+    """
+    if isinstance(model, StubModel):
+        return wav[None].repeat(len(model.sources), 1, 1) / len(model.sources)
+
+    ref = wav.mean(0)
+    wav = (wav - ref.mean()) / ref.std()
+
+    with torch.no_grad():
+        sources = apply_model(model, wav[None], device='cpu', progress=False, num_workers=1)[0]
+    return sources * ref.std() + ref.mean()
+
+
+def separate_batch(model, wavs):
+    """
+    Apply the model to several (channels, samples) tensors in a single call.
+    Shorter chunks are padded with silence for the call and trimmed back after.
+    Returns a (sources, channels, samples) tensor per chunk.
+    """
+    if isinstance(model, StubModel):
+        return [separate(model, wav) for wav in wavs]
+
+    length = max(wav.shape[-1] for wav in wavs)
+    batch = torch.zeros(len(wavs), model.audio_channels, length)
+    stats = []
+    for i, wav in enumerate(wavs):
+        # every chunk is normalized on its own, as in separate
+        ref = wav.mean(0)
+        stats.append((ref.mean(), ref.std()))
+        batch[i, :, :wav.shape[-1]] = (wav - stats[i][0]) / stats[i][1]
+
+    with torch.no_grad():
+        sources = apply_model(model, batch, device='cpu', progress=False, num_workers=1)
+    return [sources[i, :, :, :wav.shape[-1]] * std + mean for i, (wav, (mean, std)) in enumerate(zip(wavs, stats))]
+
+
+class BatchInferencer:
+    """
+    Separates the chunks of tasks running at the same time (celery --pool threads)
+    in batches: the first chunk waits up to max_wait seconds for up to
+    batch_size - 1 others, and all of them go through the model in one call.
+    """
+
+    def __init__(self, model, batch_size: int = DEMUCS_BATCH_SIZE, max_wait: float = DEMUCS_BATCH_WAIT):
+        self.model = model
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.chunks = 0
+        self.batches = 0
+        self.busy_time = 0.0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def separate(self, wav):
+        """
+        Separate one (channels, samples) tensor, blocking until its batch went through the model.
+        """
+        future = Future()
+        self._queue.put((wav, future))
+        return future.result()
+
+    @property
+    def throughput(self) -> float:
+        """
+        Chunks per second of model time so far.
+        """
+        return self.chunks / self.busy_time if self.busy_time else 0.0
+
+    def _collect(self):
+        items = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(items) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                items.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while True:
+            items = self._collect()
+            start = time.time()
+            try:
+                results = separate_batch(self.model, [wav for wav, _ in items])
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+            elapsed = time.time() - start
+
+            self.chunks += len(items)
+            self.batches += 1
+            self.busy_time += elapsed
+            for (_, future), sources in zip(items, results):
+                future.set_result(sources)
+            print(f'Batch of {len(items)} chunks in {elapsed:.2f}s ({len(items) / max(elapsed, 1e-9):.2f} chunks/s, '
+                  f'{self.throughput:.2f} chunks/s over {self.batches} batches)')
+
+
+def get_batcher(model_name: str = DEFAULT_MODEL):
+    """
+    The batcher of a model, shared by every task of this worker process.
+    """
+    with _models_lock:
+        batcher = _batchers.get(model_name)
+    if batcher is None:
+        model, _ = load_model(model_name)
+        with _models_lock:
+            batcher = _batchers.setdefault(model_name, BatchInferencer(model))
+    return batcher
+
+
+def separate_file(model, wave_bytes: bytes, folder: str, stems=None):
+    """
+    Separate a chunk sent as a WAV file going through the disk:
+    the chunk and the requested stems (see select_stems) are written to folder and read back.
+    Returns the stems as WAV bytes by name and the inference time.
+    """
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, 'task.wav'), 'wb') as f:
+        f.write(wave_bytes)
+
+    wav = AudioFile(os.path.join(folder, 'task.wav')).read(streams=0, samplerate=model.samplerate, channels=model.audio_channels)
+
+    inference_start = time.time()
+    sources = separate(model, wav)
+    inference_time = time.time() - inference_start
+
+    output = {}
+    for name, source in select_stems(model, wav, sources, stems).items():
+        stem = os.path.join(folder, f'{name}.wav')
+        save_audio(source, stem, samplerate=model.samplerate)
+        with open(stem, 'rb') as f:
+            output[name] = f.read()
+
+    shutil.rmtree(folder)
+    return output, inference_time
+
+
+def separate_pcm(model, pcm_bytes: bytes, audio: dict, batcher: BatchInferencer = None, stems=None):
+    """
+    Separate a chunk sent as raw PCM without touching the disk.
+    audio describes the chunk: {"format": "s16", "samplerate": 44100, "channels": 2}.
+    With a batcher the chunk goes through the model together with the chunks of other tasks.
+    Returns the requested stems (see select_stems) as WAV bytes (encoded in memory) by name
+    and the inference time.
+    """
+    samples = decode_pcm(pcm_bytes, audio["format"], audio["channels"])
+    wav = torch.from_numpy(samples.T.copy())
+    if audio["samplerate"] != model.samplerate or audio["channels"] != model.audio_channels:
+        wav = convert_audio(wav, audio["samplerate"], model.samplerate, model.audio_channels)
+
+    inference_start = time.time()
+    sources = batcher.separate(wav) if batcher else separate(model, wav)
+    inference_time = time.time() - inference_start
+
+    output = {}
+    for name, source in select_stems(model, wav, sources, stems).items():
+        output[name] = wav_bytes(source.numpy().T, model.samplerate)
+    return output, inference_time
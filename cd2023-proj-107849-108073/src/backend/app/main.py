@@ -2,30 +2,46 @@
 from fastapi import FastAPI
 
 from fastapi.middleware.cors import CORSMiddleware
-import json
 import os
-from fastapi import File, UploadFile, BackgroundTasks
-from starlette.responses import FileResponse
+from fastapi import BackgroundTasks, HTTPException, Request, WebSocket, WebSocketDisconnect
+from starlette.responses import StreamingResponse, Response
+from starlette.concurrency import run_in_threadpool
+from starlette.websockets import WebSocketState
 
 from app.ffmpeg_utils import *
 import sys
 sys.path.append('app')
 from celeryapp import process_wave, tasks
-from pydub import AudioSegment
+from inference import DEFAULT_MODEL
+from transport import encode_payload, file_payload, save_payload, serializer_for, result_size, get_blob_store
+from affinity import NodeRouter, NODE_ID, node_queue
 
-from typing import List
+from typing import Dict, List
 import time
 import math
+import wave
 
-from app.schemas import Music, Progress, Track, Instrument, Job
-from tinytag import TinyTag
+from app.schemas import Music, Progress, Track, Instrument, Job, CacheStats, SchedulerStats, StageTiming
 import shutil
 from celery.result import AsyncResult
-import base64
-
-# used to cancel tasks
-global cancel_tasks
-cancel_tasks = False
+from app.collector import ResultCollector
+from app.chunking import plan_chunks, auto_chunk_length, read_chunk, OverlapAddWriter, CHUNK_LENGTH, CHUNK_OVERLAP, CHUNK_CROSSFADE, CHUNK_PCM_FORMAT
+from app.pcm import decode_pcm, encode_pcm
+from app.mixer import mix_stems
+from app.stem_cache import StemCache, audio_key, file_key, files_key
+from app.upload import StreamingUpload, UploadError
+from app.store import Store, CHUNK_PENDING, CHUNK_DISPATCHED, CHUNK_DONE, RUN_LEASE
+from app.scheduler import ChunkScheduler, SCHEDULER_PREFETCH, SCHEDULER_REFRESH
+from app.speculation import StragglerMonitor, SPECULATION_INTERVAL, SPECULATION_MAX_COPIES
+from app.metrics import Registry, Histogram, Gauge, CONTENT_TYPE
+from app.progress_hub import ProgressHub
+from app.delivery import Transcoder, DELIVERY_FORMATS, file_response, follow_wav
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+from functools import partial
+import threading
+import asyncio
+import uuid
 
 app = FastAPI(title="Distributed Music Editor - Advanced Sound Systems")
 
@@ -40,100 +56,191 @@ app.add_middleware(
 if not os.path.exists("DATA_FILES"):
     os.makedirs("DATA_FILES")
 
-if not os.path.exists("DATA_FILES/music.json"):
-    with open("DATA_FILES/music.json", "w") as json_file:
-        json.dump([], json_file)
-
-data_file_path = os.path.join("DATA_FILES", "music.json")
-# Load existing JSON data from file
-existing_json_data = []
-if os.path.exists(data_file_path):
-    with open(data_file_path, "r") as json_file:
-        existing_json_data = json.load(json_file)
+# music, jobs and progress
+store = Store()
+# music uploaded before the store existed
+store.import_json(os.path.join("DATA_FILES", "music.json"))
     
 absbackend_path = os.path.abspath("backend")
 
-jobs = []
-ongoing_jobs = {}
+# state of the music being processed, updated by the result collector
+processing = {}
+processing_lock = threading.Lock()
+# music between POST /music/{music_id} and the start of its chunks
+starting = set()
+# instrument names by track id, no_<instrument> is the music without that instrument
+INSTRUMENTS = ["bass", "drums", "vocals", "other", "no_bass", "no_drums", "no_vocals", "no_other"]
+# sample rate of the separation model, chunks are cut at this rate
+SAMPLE_RATE = 44100
+# processes hashing and mixing songs, so that CPU work never holds the GIL of the API
+OFFLOAD_PROCESSES = int(os.environ.get("OFFLOAD_PROCESSES", "2"))
+# POST /music reads the body itself, so the file field is documented by hand
+UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {"multipart/form-data": {"schema": {
+            "type": "object",
+            "properties": {"file": {"type": "string", "format": "binary"}},
+            "required": ["file"],
+        }}},
+    }
+}
+
+# one collector handles the results of every job, chunks are held back while
+# the results it waits for could take more than COLLECTOR_MEMORY_LIMIT
+collector = ResultCollector(tasks, on_release=lambda: scheduler.resume())
+# stitches and mixes finished jobs
+finisher = ThreadPoolExecutor(max_workers=2)
+# runs the CPU heavy steps, see offload. Spawned lazily (not forked, the API has threads running)
+cpu_pool = None
+cpu_pool_lock = threading.Lock()
+# stems of songs and chunks already separated, by audio hash
+stem_cache = StemCache()
+# compressed copies of the stems and mixes downloaded
+transcoder = Transcoder()
+# decides which chunk goes to the workers next, across every song being processed
+scheduler = ChunkScheduler(lambda id, i: send_chunk(id, i), admit=collector.has_room,
+                           on_error=lambda id, i: chunk_finished(id, i, failed=True))
+# when the number of worker slots was last checked
+capacity_checked = 0
+# tasks the workers online can run at once
+worker_slots = 1
+# spots chunks running much longer than the others, see speculate
+monitor = StragglerMonitor()
+# sends chunks to the workers of this node while they have room, see send_chunk
+router = NodeRouter()
+# owner of the runs started by this process, see resume_processing
+OWNER = uuid.uuid4().hex
+# pushes the progress of every music to the clients watching it, see watch_music
+hub = ProgressHub()
+# served by GET /metrics
+metrics = Registry()
+stage_seconds = metrics.register(Histogram("separation_stage_seconds", "Seconds spent in each stage of the separation", ["stage"]))
+metrics.register(Gauge("scheduler_pending_chunks", "Chunks waiting in the scheduler", scheduler.pending))
+metrics.register(Gauge("scheduler_in_flight_chunks", "Chunks sent to the workers and not back yet", scheduler.in_flight))
+metrics.register(Gauge("worker_slots", "Tasks the workers online can run at once", lambda: worker_slots))
+metrics.register(Gauge("result_memory_bytes", "Bytes of stems the pending results may carry in memory", collector.memory))
+
+@app.on_event("startup")
+def startup():
+    # waiting for the workers can take a while, do not hold the API back
+    threading.Thread(target=resume_processing, daemon=True).start()
+    threading.Thread(target=renew_runs, daemon=True).start()
+    if SPECULATION_MAX_COPIES > 0:
+        threading.Thread(target=speculate, daemon=True).start()
+
+@app.on_event("startup")
+async def bind_hub():
+    # events are published from the collector and finisher threads
+    hub.bind(asyncio.get_running_loop())
+
+@app.on_event("shutdown")
+def shutdown():
+    if cpu_pool is not None:
+        cpu_pool.shutdown(wait=False, cancel_futures=True)
+
+def get_cpu_pool() -> ProcessPoolExecutor:
+    global cpu_pool
+    with cpu_pool_lock:
+        if cpu_pool is None:
+            cpu_pool = ProcessPoolExecutor(OFFLOAD_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+        return cpu_pool
+
+async def offload(func, *args):
+    """
+    Await func(*args) run in the process pool, for CPU heavy work (hashing, mixing).
+    """
+    return await asyncio.get_running_loop().run_in_executor(get_cpu_pool(), partial(func, *args))
+
+def offload_sync(func, *args):
+    """
+    Same as offload, from a thread.
+    """
+    return get_cpu_pool().submit(func, *args).result()
+
+# handlers only reading the store are async: reads never wait for a lock in WAL mode,
+# so they answer right away, even when every thread of the API is busy
 @app.get("/music", status_code=200 ,response_model=List[Music])
-def get_music():
-    #len(tasks.control.inspect().stats().keys())) get number of workers
-    arr = [x["METADATA"] for x in existing_json_data]
-    print(arr)
-    mus_arr = []
-    for x in arr:
-        x = json.loads(x)
-        mus_arr.append(Music(
-            music_id=x["music_id"],
-            music_name=x["music_name"],
-            music_band=x["music_band"],
-            music_tracks=x["music_tracks"]
-        ))
-
-    return mus_arr
-
-@app.post("/music", status_code=200, response_model=Music)
-def post_music(file: UploadFile = File(...)):
-
-    # with open(file.filename, "wb") as buffer:
-    #     buffer.write(file.file.read())
-    id = selectID()
+async def get_music():
+    return [Music(**x) for x in store.list_music()]
+
+@app.post("/music", status_code=200, response_model=Music, openapi_extra=UPLOAD_OPENAPI)
+async def post_music(request: Request):
+    """
+    Receive an mp3 as multipart/form-data ("file" field).
+    The upload is streamed to disk and decoded to WAV while it arrives.
+    Writes to the store wait for the other writers, they run in threads.
+    """
+    id = await run_in_threadpool(store.create_music)
+    received = time.time()
     
     # write file to folder with id as name in DATA_FILES
-    
-    os.makedirs(os.path.join("DATA_FILES", str(id)), exist_ok=True)
-    with open(os.path.join("DATA_FILES", str(id), "original.mp3"), "wb") as buffer:
-        buffer.write(file.file.read())
-    
-    tag = TinyTag.get(os.path.join("DATA_FILES", str(id), "original.mp3"))
+    folder = os.path.join("DATA_FILES", str(id))
+    os.makedirs(folder, exist_ok=True)
+    mp3_file = os.path.join(folder, "original.mp3")
+    wav_file = os.path.join(folder, "original.wav")
+
+    try:
+        upload = await StreamingUpload(mp3_file, wav_file, SAMPLE_RATE).receive(request)
+    except UploadError as e:
+        await run_in_threadpool(discard_upload, id, folder)
+        raise HTTPException(status_code=400, detail=str(e))
+    except BaseException:
+        await run_in_threadpool(discard_upload, id, folder)
+        raise
+
+    tag = upload.tag
 
     music = Music(
         music_id=id,  # Set the appropriate music_id
-        music_name=tag.title if tag.title else "Unknown",
-        music_band=tag.artist if tag.artist else "Unknown",  # Set the appropriate band/artist name
+        music_name=tag.title if tag and tag.title else "Unknown",
+        music_band=tag.artist if tag and tag.artist else "Unknown",  # Set the appropriate band/artist name
         music_tracks=[],  # Set the appropriate track list
     )
 
-    
-    saveFile(file, id)
-
-    ## save in json
-    music_json = music.json()
-    
-    # Append new JSON data to the list
-    obj = {"ID": id, "STATUS" : "WAITING", "METADATA" : music_json}
-    existing_json_data.append(obj)
-
-    # Save updated JSON data to file
-    with open(data_file_path, "w") as json_file:
-        json.dump(existing_json_data, json_file)
+    await run_in_threadpool(partial(store.update_music, id, name=music.music_name, band=music.music_band,
+                                    status="WAITING"))
+    await run_in_threadpool(observe, id, "upload", time.time() - received)
 
     return music
 
+def discard_upload(id: int, folder: str):
+    shutil.rmtree(folder, ignore_errors=True)
+    store.delete_music(id)
+
 @app.post("/music/{music_id}", status_code=200, response_model=List[int])
-def post_music(music_id: int, tracks: List[int], background_tasks: BackgroundTasks):
+async def post_music(music_id: int, tracks: List[int], background_tasks: BackgroundTasks, priority: int = 0, weight: float = 1.0):
+    """
+    Separate a music. Songs with a higher priority get the workers first,
+    songs of the same priority share them according to their weight.
+    """
+    if weight <= 0:
+        raise HTTPException(status_code=400, detail="weight must be positive")
+    if not tracks or any(x < 0 or x >= len(INSTRUMENTS) for x in tracks):
+        raise HTTPException(status_code=400, detail=f"tracks must be ids between 0 and {len(INSTRUMENTS) - 1}")
     # file_path = os.path.join("DATA_FILES", str(music_id))
     # if not os.path.exists(file_path):
     #     return {"error": "Music not found"}
     # # epa ya, é o q da pra fazer por enquanto
     # stitchAudio(file_path, file_path + "/stitched.wav")    
-    background_tasks.add_task(start_processing, music_id, tracks)
+    background_tasks.add_task(start_processing, music_id, tracks, priority, weight)
     return tracks
 
 @app.get("/music/{music_id}", status_code=200, response_model=Progress)
-def get_music(music_id: int):
-    job_info = ongoing_jobs[music_id]
+async def get_music(music_id: int):
+    progress = progress_of(music_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Music is not being processed")
+    return progress
+
+def progress_of(music_id: int):
+    job_info = store.get_progress(music_id)
+    if job_info is None:
+        return None
+    job_info = (music_id, job_info["progress"], job_info["instruments"])
     instrumentArr = []
     for x in job_info[2]:
-        name = ""
-        if x == 0:
-            name = "bass"
-        elif x == 1:
-            name = "drums"
-        elif x == 2:
-            name = "vocals"
-        elif x == 3:
-            name = "other"
+        name = INSTRUMENTS[x]
         instrumentArr.append(Instrument(
             name=name,
             track=absbackend_path + "/DATA_FILES/" + str(music_id) + "/output/" + name + ".wav"
@@ -150,178 +257,626 @@ def get_music(music_id: int):
             final=absbackend_path + "/DATA_FILES/" + str(music_id) + "/output/final.wav",
             instruments=instrumentArr
         )
-    
-    
-
-
-
-def saveFile(file: UploadFile, music_id: int):
-    dir_path = os.path.join("DATA_FILES", str(music_id))
-    file_name = "original.mp3"
-    mp3ToWav(file_name, dir_path)
-
 
-def selectID():
-        if len(existing_json_data) == 0:
-            return 1
-        else:
-            return existing_json_data[-1]["ID"] + 1
-
-jobs = []
+@app.websocket("/music/{music_id}/ws")
+async def watch_music(websocket: WebSocket, music_id: int):
+    """
+    Push the progress of a music: the current progress first, then an event
+    per finished chunk and one when the final mix is ready (or the music failed).
+    """
+    await websocket.accept()
+    # subscribed before reading the progress, so no event falls in between
+    # (events published meanwhile are kept until they are read)
+    events = hub.subscribe(music_id)
+    next_events = asyncio.ensure_future(events.__anext__())
+    closed = asyncio.ensure_future(wait_closed(websocket))
+    try:
+        await websocket.send_json(progress_event(music_id))
+        music = store.get_music(music_id)
+        if music is None or music["status"] == "FAILED" or os.path.exists(final_file(music_id)):
+            return
+        while True:
+            done, _ = await asyncio.wait({next_events, closed}, return_when=asyncio.FIRST_COMPLETED)
+            if closed in done:
+                return
+            for event in next_events.result():
+                # a watcher too slow to keep up gets the current progress instead of the missed events
+                event = event or progress_event(music_id)
+                await websocket.send_json(event)
+                if event["type"] in ("done", "failed"):
+                    return
+            next_events = asyncio.ensure_future(events.__anext__())
+    except WebSocketDisconnect:
+        return
+    finally:
+        next_events.cancel()
+        closed.cancel()
+        # the cancelled task must be done waiting before the subscription is closed
+        await asyncio.wait({next_events, closed})
+        await events.aclose()
+        # a client that went away has nothing left to close
+        if websocket.client_state == WebSocketState.CONNECTED:
+            await websocket.close()
+
+async def wait_closed(websocket: WebSocket):
+    # watchers send nothing, only their disconnection is expected
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
+
+def progress_event(music_id: int) -> dict:
+    music = store.get_music(music_id)
+    progress = progress_of(music_id)
+    event = progress.dict() if progress else {"progress": 0, "final": "", "instruments": []}
+    return {"type": "progress", "status": music["status"] if music else None, **event}
+
+def final_file(music_id: int) -> str:
+    return os.path.join("DATA_FILES", str(music_id), "output", "final.wav")
+
+def count_workers():
+    """
+    Number of celery workers currently online, the number of tasks
+    they can run at once (at least 1 each) and how many of those run
+    on this node (workers consuming its queue)
+    """
+    inspect = tasks.control.inspect(timeout=1)
+    try:
+        stats = inspect.stats()
+        queues = inspect.active_queues()
+    except Exception:
+        stats = queues = None
+    stats = stats or {}
+    queues = queues or {}
+    concurrency = {name: x.get("pool", {}).get("max-concurrency", 1) for name, x in stats.items()}
+    slots = sum(concurrency.values())
+    local = sum(concurrency.get(name, 1) for name, x in queues.items() if any(q.get("name") == node_queue() for q in x))
+    return max(1, len(stats)), max(1, slots), local
+
+def refresh_capacity():
+    """
+    Match the chunks in flight to the worker slots online. Returns the number of workers.
+    """
+    global capacity_checked, worker_slots
+    capacity_checked = time.time()
+    workers, slots, local_slots = count_workers()
+    worker_slots = slots
+    # enough chunks in flight to keep every worker busy, the rest waits in the scheduler
+    scheduler.set_capacity(slots * SCHEDULER_PREFETCH)
+    router.set_capacity(local_slots * SCHEDULER_PREFETCH)
+    return workers
+
+@app.get("/scheduler", status_code=200, response_model=SchedulerStats)
+async def get_scheduler():
+    return SchedulerStats(pending=scheduler.pending(), in_flight=scheduler.in_flight(), capacity=scheduler.capacity, slots=worker_slots,
+                          speculated=monitor.speculated, speculation_won=monitor.won, node=NODE_ID,
+                          local_capacity=router.capacity, local_in_flight=router.local_in_flight(),
+                          sent_local=router.local, sent_remote=router.remote,
+                          result_memory=collector.memory(), result_memory_limit=collector.memory_limit)
 
 @app.get("/job", status_code=200 ,response_model=List[Job])
-def get_jobs():
-    return jobs
+async def get_jobs():
+    return [Job(**x) for x in store.list_jobs()]
 
 @app.get("/job/{job_id}", status_code=200, response_model=Job)
-def get_job(job_id: int):
-    return jobs[job_id-1]
+async def get_job(job_id: int):
+    job = store.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return Job(**job)
 
 @app.post("/reset", status_code=200, response_model=None)
 def post_reset():
     # stop every celery task
-    cancel_tasks = True
-
     tasks.control.revoke(None, terminate=True)
     tasks.control.purge()
     
-    # delete every file in DATA_FILES 
+    # delete every folder in DATA_FILES 
     folders = os.listdir("DATA_FILES")
     for folder in folders:
-        if folder != "music.json":
+        if os.path.isdir(os.path.join("DATA_FILES", folder)):
             shutil.rmtree(os.path.join("DATA_FILES", folder))
     
-    jobs.clear()
-    ongoing_jobs.clear()
-
-    while len(existing_json_data) > 0:
-        existing_json_data.pop()
-    
-    with open(data_file_path, "w") as json_file:
-        json.dump(existing_json_data, json_file)
-    time.sleep(1)
-    cancel_tasks = False
+    collector.clear()
+    scheduler.clear()
+    monitor.clear()
+    router.clear()
+    with processing_lock:
+        for state in processing.values():
+            for writer in state["writers"].values():
+                writer.close()
+        processing.clear()
+    stem_cache.clear()
+    store.reset()
     return None
 
-def start_processing(id: int, instruments: List[int]):
-    #print("Starting processing")
+async def start_processing(id: int, instruments: List[int], priority: int = 0, weight: float = 1.0):
+    """
+    Split the music and queue its chunks in the scheduler, which sends them
+    to the workers (see send_chunk) interleaved with the chunks of other songs.
+    Results are handled by the collector as they arrive, see on_chunk_done.
+    Runs on the event loop, blocking steps go to threads and CPU heavy ones to processes.
+    """
     start = time.time()
     
     print(instruments)
-    existing_json_data[id-1]["STATUS"] = "PROCESSING"
+    if id in processing or id in starting:
+        print(f"Music {id} is already being processed")
+        return
+    starting.add(id)
+    try:
+        await prepare_processing(id, instruments, priority, weight, start)
+    finally:
+        starting.discard(id)
+
+async def prepare_processing(id: int, instruments: List[int], priority: int, weight: float, start: float):
+    await run_in_threadpool(store.set_status, id, "PROCESSING")
+    await run_in_threadpool(store.clear_timings, id)
+    # only the selected stems are separated, sent back and stitched
+    stems = list(dict.fromkeys(INSTRUMENTS[x] for x in instruments))
 
     file_path = os.path.join("DATA_FILES", str(id))
-    if not os.path.exists(os.path.join(file_path, "output")):
-        ongoing_jobs[id] = (id, 0, instruments)
-        splitAudio(file_path+ "/original.mp3", file_path +"/splitted", 1.5) 
-        
-        splitted_files = os.listdir(file_path +"/splitted")
-        splitted_files.sort()
-        splitted_files = [[os.path.join(file_path +"/splitted", x), "WAITING"] for x in splitted_files]
-        task_ids = []
-    # print(len(splitted_files))
-        for i in range(len(splitted_files)):
-            file = splitted_files[i]
-            if file[1] == "WAITING":
-                file[1] = "PROCESSING"
-                # open file and send to celery
-            
-                with open(file[0], "rb") as buffer:
-                    wavedata = buffer.read()   
-                file_size = os.path.getsize(file[0])
-                temp_id = len(jobs)+1
-                job = Job(job_id=temp_id, size=file_size, time=0, music_id=id, track_id=instruments)     
-                jobs.append(job)
-                b64data = base64.b64encode(wavedata).decode("utf-8")
-                task_ids.append(process_wave.delay(b64data, i, temp_id))
+    output_path = os.path.join(file_path, "output")
+    if all(os.path.exists(os.path.join(output_path, x + ".wav")) for x in stems):
+        # already separated, only the final mix has to be redone
+        finisher.submit(finish_processing, id, instruments, start)
+        return
+    # stems separated for an earlier selection are kept
+    stems = [x for x in stems if not os.path.exists(os.path.join(output_path, x + ".wav"))]
+
+    await run_in_threadpool(store.set_progress, id, 0, instruments)
+    # decode once at the model sample rate so chunks can be cut at exact frames
+    wav_file = os.path.join(file_path, "original.wav")
+    if not os.path.exists(wav_file):
+        # normally decoded during the upload
+        await run_in_threadpool(decodeToWav, os.path.join(file_path, "original.mp3"), wav_file, SAMPLE_RATE)
+    with wave.open(wav_file, "rb") as f:
+        total_frames = f.getnframes()
+
+    os.makedirs(output_path, exist_ok=True)
+    song_key = await offload(file_key, wav_file, DEFAULT_MODEL)
+    destinations = {x: os.path.join(output_path, x + ".wav") for x in stems}
+    if await run_in_threadpool(stem_cache.copy, song_key, destinations):
+        # the same song was already separated
+        await run_in_threadpool(store.set_progress, id, 100, instruments)
+        finisher.submit(finish_processing, id, instruments, start)
+        return
+
+    run = await run_in_threadpool(store.get_run, id)
+    if (run is not None and run["stems"] == stems and run["song_key"] == song_key
+            and await run_in_threadpool(store.claim_run, id, OWNER, run["owner"])):
+        # a failed or interrupted run of the same separation, only its missing chunks are sent
+        run["instruments"] = instruments
+        await run_in_threadpool(resume_run, id, run)
+        return
+
+    # asking the workers and sending the first chunks wait on the network
+    workers = await run_in_threadpool(refresh_capacity)
+    if CHUNK_LENGTH == "auto":
+        chunk_length = auto_chunk_length(total_frames / SAMPLE_RATE, workers)
+    else:
+        chunk_length = float(CHUNK_LENGTH)
+    try:
+        chunks = plan_chunks(total_frames, int(chunk_length * SAMPLE_RATE), int(CHUNK_OVERLAP * SAMPLE_RATE))
+    except ValueError as e:
+        # CHUNK_LENGTH and CHUNK_OVERLAP do not fit together
+        print(f"Cannot split music {id}: {e}")
+        await run_in_threadpool(store.set_status, id, "FAILED")
+        return
+
+    # every chunk is checkpointed in the store, so a restart resumes where it stopped
+    await run_in_threadpool(store.start_run, id, instruments, stems, song_key, chunks, priority, weight, OWNER)
+    await run_in_threadpool(run_chunks, id, instruments, stems, chunks, song_key, wav_file, start, priority, weight)
+
+def run_chunks(id: int, instruments: List[int], stems: List[str], chunks, song_key: str, wav_file: str, start: float,
+               priority: int = 0, weight: float = 1.0, done=()):
+    """
+    Stitch the chunks already done and queue the others in the scheduler.
+    """
+    file_path = os.path.join("DATA_FILES", str(id))
+    for instrument_type in stems:
+        os.makedirs(os.path.join(file_path, "proccessed", instrument_type), exist_ok=True)
+    # stems grow in partial while the chunks come back, see stream_stem
+    os.makedirs(os.path.join(file_path, "partial"), exist_ok=True)
+    writers = {x: OverlapAddWriter(os.path.join(file_path, "partial", x + ".wav"), chunks, CHUNK_CROSSFADE) for x in stems}
+
+    processing[id] = {"completed": 0, "failed": 0, "total": len(chunks), "instruments": instruments, "start": start,
+                      "song_key": song_key, "chunk_keys": {}, "writers": writers, "chunks": chunks, "wav_file": wav_file,
+                      "jobs": {}}
+    for i in done:
+        chunk_finished(id, i, failed=False, checkpoint=False)
+    scheduler.add_job(id, [i for i in range(len(chunks)) if i not in done], weight, priority)
+
+def resume_processing():
+    """
+    Continue the separations interrupted by a restart of the API.
+    Chunks done before the restart are kept when their stems are intact, the others are sent again.
+    """
+    waiting = store.list_runs()
+    while waiting:
+        left = []
+        for id in waiting:
+            run = store.get_run(id)
+            music = store.get_music(id)
+            if run is None:
+                continue
+            if music is None or music["status"] != "PROCESSING":
+                store.end_run(id)
+                continue
+            # the lease of the previous process has to run out first, see renew_runs
+            if not store.claim_run(id, OWNER, run["owner"]):
+                left.append(id)
+                continue
+            try:
+                resume_run(id, run)
+            except Exception as e:
+                print(f"Could not resume music {id}: {e}")
+                store.set_status(id, "FAILED")
+        waiting = left
+        if waiting:
+            time.sleep(RUN_LEASE / 3)
+
+def renew_runs():
+    """
+    Renew the lease of the runs of this process, so they are only taken over once it is dead.
+    """
+    while True:
+        try:
+            store.renew_runs(OWNER)
+        except Exception as e:
+            print(f"Could not renew the runs: {e}")
+        time.sleep(RUN_LEASE / 3)
+
+def resume_run(id: int, run: dict):
+    file_path = os.path.join("DATA_FILES", str(id))
+    wav_file = os.path.join(file_path, "original.wav")
+    if not os.path.exists(wav_file):
+        decodeToWav(os.path.join(file_path, "original.mp3"), wav_file, SAMPLE_RATE)
+
+    chunks = [(x["start"], x["length"]) for x in run["chunks"]]
+    done = []
+    for chunk in run["chunks"]:
+        if chunk["status"] == CHUNK_DONE and chunk_intact(chunk, run["stems"]):
+            done.append(chunk["chunk"])
+        elif chunk["status"] != CHUNK_PENDING:
+            # the results of chunks sent before the restart never reach this process
+            store.set_chunk(id, chunk["chunk"], CHUNK_PENDING)
+    print(f"Resuming music {id}: {len(done)} of {len(chunks)} chunks already done")
+
+    refresh_capacity()
+    run_chunks(id, run["instruments"], run["stems"], chunks, run["song_key"], wav_file, time.time(),
+               run["priority"], run["weight"], set(done))
+
+def chunk_intact(chunk: dict, stems: List[str]) -> bool:
+    """
+    Whether the stems of a done chunk are still on disk, unchanged.
+    """
+    location = chunk["location"] or {}
+    if any(x not in location for x in stems):
+        return False
+    try:
+        return files_key(*[location[x] for x in stems]) == chunk["checksum"]
+    except OSError:
+        return False
+
+def send_chunk(id: int, i: int, speculative: bool = False) -> bool:
+    """
+    Send chunk i of music id to the workers, called by the scheduler when there is room,
+    or to send a copy of a late chunk (speculative).
+    Returns False when the chunk was not sent (cached, or the job was reset).
+    """
+    state = processing.get(id)
+    if state is None:
+        return False
+
+    # chunks are sent as raw PCM read straight from the decoded song
+    split = time.time()
+    start, length = state["chunks"][i]
+    wavedata = read_chunk(state["wav_file"], start, length)
+    if CHUNK_PCM_FORMAT != "s16":
+        wavedata = encode_pcm(decode_pcm(wavedata, "s16"), CHUNK_PCM_FORMAT)
+
+    # identical chunks (silence, repeated intros, ...) are not separated twice
+    if not speculative:
+        chunk_key = audio_key(DEFAULT_MODEL, CHUNK_PCM_FORMAT, wavedata)
+        destinations = {x: os.path.join("DATA_FILES", str(id), "proccessed", x, str(i) + ".wav") for x in state["writers"]}
+        if stem_cache.copy(chunk_key, destinations):
+            chunk_finished(id, i, failed=False)
+            return False
+        state["chunk_keys"][i] = chunk_key
+
+    job = {}
+    encode = time.time()
+    observe(id, "split", encode - split, job)
+    temp_id = store.add_job(id, i, len(wavedata), state["instruments"])
+    # workers of this node read the chunk from the decoded song, the others get its bytes
+    task_id = str(uuid.uuid4())
+    queue, local = router.route(task_id)
+    if local:
+        payload = file_payload(state["wav_file"], start, length)
+        audio = {"format": "s16", "samplerate": SAMPLE_RATE, "channels": 2}
+    else:
+        payload = encode_payload(wavedata)
+        audio = {"format": CHUNK_PCM_FORMAT, "samplerate": SAMPLE_RATE, "channels": 2}
+    enqueue = time.time()
+    observe(id, "encode", enqueue - encode, job)
+    kwargs = {"audio": audio, "stems": list(state["writers"])}
+    try:
+        result = process_wave.apply_async((payload, i, temp_id, DEFAULT_MODEL), kwargs, serializer=serializer_for(),
+                                          task_id=task_id, queue=queue, reply_to=collector.reply_to())
+    except BaseException:
+        router.release(task_id)
+        raise
+    sent = time.time()
+    observe(id, "enqueue", sent - enqueue, job)
+    # the rest of the breakdown is added when the result comes back, see handle_chunk_result
+    state["jobs"][result.id] = (sent, job)
+    monitor.dispatched((id, i), result.id, speculative)
+    collector.add(result, partial(on_chunk_done, id, i), result_size(payload, len(wavedata), len(state["writers"])))
+    if not speculative:
+        store.set_chunk(id, i, CHUNK_DISPATCHED, task_id=result.id)
+    return True
+
+def speculate():
+    """
+    Send copies of the late chunks (see StragglerMonitor) to idle workers.
+    Whichever copy finishes first is used, see on_chunk_done.
+    """
+    while True:
+        time.sleep(SPECULATION_INTERVAL)
+        try:
+            # only once every chunk was sent, copies must not delay chunks still waiting
+            idle = worker_slots - scheduler.in_flight() - monitor.copies_in_flight()
+            if idle <= 0 or scheduler.pending():
+                continue
+            for id, i in monitor.stragglers()[:idle]:
+                if send_chunk(id, i, speculative=True):
+                    print(f"Chunk {i} of music {id} is late, sent a copy")
+        except Exception as e:
+            print(f"Error sending copies of late chunks: {e}")
+
+def on_chunk_done(id: int, i: int, result: AsyncResult):
+    """
+    Called by the collector as soon as a copy of chunk i of music id is processed.
+    """
+    global capacity_checked
+    router.release(result.id)
+    ok = result.successful()
+    use, losers = monitor.resolve((id, i), result.id, ok, result.result[2] if ok else None)
+    if losers:
+        # the chunk is done, the other copies would only keep workers busy
+        tasks.control.revoke(losers, terminate=True)
+        for task_id in losers:
+            collector.discard(tasks.AsyncResult(task_id))
+            router.release(task_id)
+    state = processing.get(id)
+    if state is not None:
+        for task_id in losers if use else [result.id]:
+            state["jobs"].pop(task_id, None)
+    if not use:
+        # a copy that lost, or failed while another copy is still running
+        return
+
+    try:
+        handle_chunk_result(id, i, result)
+    except Exception as e:
+        # the stems could not be saved (missing blob, bad payload, disk full, ...)
+        print(f"Error handling chunk {i} of music {id}: {e}")
+        chunk_finished(id, i, failed=True)
+    finally:
+        # the worker is free, let the scheduler send the next chunk
+        scheduler.task_done(id)
+        if time.time() - capacity_checked > SCHEDULER_REFRESH:
+            # workers come and go (see autoscaler.py), asking them takes a while
+            capacity_checked = time.time()
+            finisher.submit(refresh_capacity)
+
+def handle_chunk_result(id: int, i: int, result: AsyncResult):
+    state = processing.get(id)
+    if state is None:
+        # the job was reset meanwhile
+        return
+
+    received = time.time()
+    sent, job = state["jobs"].pop(result.id, (received, {}))
+    if result.failed():
+        print(f"Chunk {result.id} of music {id} failed: {result.result}")
+        chunk_finished(id, i, failed=True)
+        return
+
+    res = result.result
+    timings = res[4] if len(res) > 4 else {}
+    # time in RabbitMQ both ways, measured on this clock only
+    observe(id, "queue_wait", max(0.0, received - sent - res[2]), job)
+    observe(id, "model_load", timings.get("load", 0), job)
+    observe(id, "inference", timings.get("inference", res[2]), job)
+
+    decode = time.time()
+    stem_files = {}
+    for instrument_type in res[1]:
+        if instrument_type in state["writers"]:
+            stem_files[instrument_type] = os.path.join("DATA_FILES", str(id), "proccessed", instrument_type, str(i) + ".wav")
+            save_payload(res[1][instrument_type], stem_files[instrument_type])
+    observe(id, "result_decode", time.time() - decode, job)
+    try:
+        stem_cache.put(state["chunk_keys"].pop(i), stem_files)
+    except Exception as e:
+        # the stems are in place, only the next identical chunk misses the cache
+        print(f"Error caching chunk {i} of music {id}: {e}")
+
+    chunk_finished(id, i, failed=False, job=job)
+    try:
+        store.finish_job(res[3], res[2], timings.get("load", 0), timings.get("inference", 0), job)
+    except Exception as e:
+        # the chunk was already counted, only its timings are lost
+        print(f"Error recording job {res[3]} of music {id}: {e}")
+
+def chunk_finished(id: int, index: int, failed: bool, checkpoint: bool = True, job: dict = None):
+    """
+    Count a finished chunk of music id, record it in the store (checkpoint),
+    add it to the partial stems and finish the music after the last one.
+    The stitching time is added to the timings of the job.
+    """
+    state = processing.get(id)
+    if state is None:
+        return
+    if not failed:
+        try:
+            stem_files = {x: os.path.join("DATA_FILES", str(id), "proccessed", x, str(index) + ".wav") for x in state["writers"]}
+            if checkpoint:
+                store.set_chunk(id, index, CHUNK_DONE, location=stem_files, checksum=files_key(*stem_files.values()))
+            stitch = time.time()
+            for instrument_type, writer in state["writers"].items():
+                writer.add(index, stem_files[instrument_type])
+            observe(id, "stitch", time.time() - stitch, job)
+        except Exception as e:
+            print(f"Error stitching chunk {index} of music {id}: {e}")
+            failed = True
+
+    with processing_lock:
+        state = processing.get(id)
+        if state is None:
+            return
+        state["failed" if failed else "completed"] += 1
+        progress = min(100, math.floor(state["completed"]/state["total"]*100))
+        if progress != state.get("progress"):
+            state["progress"] = progress
+            store.set_progress(id, progress, state["instruments"])
+        if not failed:
+            hub.publish(id, {"type": "chunk", "chunk": index, "completed": state["completed"],
+                             "total": state["total"], "progress": progress})
+
+        if state["completed"] + state["failed"] < state["total"]:
+            return
+        del processing[id]
+
+    scheduler.remove_job(id)
+    if state["failed"]:
+        for writer in state["writers"].values():
+            writer.close()
+        store.set_status(id, "FAILED")
+        hub.publish(id, {"type": "failed"})
+        return
+
+    # mixing is slow, keep it out of the collector thread
+    finisher.submit(finish_processing, id, state["instruments"], state["start"], list(state["writers"]), state["song_key"])
+
+def finish_processing(id: int, instruments: List[int], start: float, separated=None, song_key=None):
+    """
+    Move the stems stitched while the chunks came back (the separated stem names)
+    to output and mix the selected instruments. The stems are cached under song_key.
+    """
+    try:
+        if separated:
+            os.makedirs(os.path.join("DATA_FILES", str(id), "output"), exist_ok=True)
+            for instrument_type in separated:
+                # readers streaming the partial stem keep their open file
+                os.replace(os.path.join("DATA_FILES", str(id), "partial", instrument_type + ".wav"),
+                           os.path.join("DATA_FILES", str(id), "output", instrument_type + ".wav"))
+            shutil.rmtree(os.path.join("DATA_FILES", str(id), "partial"), ignore_errors=True)
+            if song_key:
+                stem_cache.put(song_key, {x: os.path.join("DATA_FILES", str(id), "output", x + ".wav") for x in separated})
+            # the stems are in output, nothing is left to resume
+            store.end_run(id)
         
-        os.makedirs(os.path.join("DATA_FILES", str(id), "proccessed", "drums"), exist_ok=True)
-        os.makedirs(os.path.join("DATA_FILES", str(id), "proccessed", "bass"), exist_ok=True)
-        os.makedirs(os.path.join("DATA_FILES", str(id), "proccessed", "vocals"), exist_ok=True)
-        os.makedirs(os.path.join("DATA_FILES", str(id), "proccessed", "other"), exist_ok=True)
-        is_done = False
-        completed = 0
-        n_jobs = len(splitted_files)
-        while not is_done:
-            if cancel_tasks:
-                return
-            for i in task_ids:
-                if i.ready():
-                    completed += 1
-                    res = i.result
-                    if type(res) == AssertionError:
-                        print(i)
-                    else:
-                        for instrument_type in res[1]:
-                            if instrument_type == "bass":
-                                # save bass
-                                with open(os.path.join("DATA_FILES", str(id), "proccessed", "bass", str(res[0]) + ".wav"), "wb") as buffer:
-                                    buffer.write(base64.b64decode(res[1][instrument_type]))
-                            elif instrument_type == "drums":
-                                # save drums
-                                with open(os.path.join("DATA_FILES", str(id), "proccessed", "drums", str(res[0]) + ".wav"), "wb") as buffer:
-                                    buffer.write(base64.b64decode(res[1][instrument_type]))
-                            elif instrument_type == "vocals":
-                                # save vocals
-                                with open(os.path.join("DATA_FILES", str(id), "proccessed", "vocals", str(res[0]) + ".wav"), "wb") as buffer:
-                                    buffer.write(base64.b64decode(res[1][instrument_type]))
-                            elif instrument_type == "other":
-                                # save other
-                                with open(os.path.join("DATA_FILES", str(id), "proccessed", "other", str(res[0]) + ".wav"), "wb") as buffer:
-                                    buffer.write(base64.b64decode(res[1][instrument_type]))
-                        task_ids.remove(i)
-                        job = jobs[res[3]-1]
-                        new_job = Job(job_id=job.job_id, size=job.size, time=res[2], music_id=job.music_id, track_id=job.track_id)
-                        jobs[res[3]-1] = new_job
-                        progress = math.floor(completed/n_jobs*100)
-                        if progress >= 100:
-                            progress = 100
-                        ongoing_jobs[id] = (id, progress, instruments)
-                        if completed/n_jobs >= 1:
-                            is_done = True
-            time.sleep(1)
-        os.makedirs(os.path.join("DATA_FILES", str(id), "output"), exist_ok=True)
-        for instrument_type in ["bass", "drums", "vocals", "other"]:
-            files = os.path.join("DATA_FILES", str(id), "proccessed", instrument_type)
-            stitchAudio(files, os.path.join("DATA_FILES", str(id), "output", instrument_type + ".wav"))
-    
-    existing_json_data[id-1]["status"] = "DONE"
-
-    Audioarr = []
-    
-    for i in instruments:
-        if i == 0:
-            filepath = os.path.join("DATA_FILES", str(id), "output", "bass.wav")
-            Audioarr.append(AudioSegment.from_wav(filepath))
-        elif i == 1:
-            filepath = os.path.join("DATA_FILES", str(id), "output", "drums.wav")
-            Audioarr.append(AudioSegment.from_wav(filepath))
-        elif i == 2:
-            filepath = os.path.join("DATA_FILES", str(id), "output", "vocals.wav")
-            Audioarr.append(AudioSegment.from_wav(filepath))
-        elif i == 3:
-            filepath = os.path.join("DATA_FILES", str(id), "output", "other.wav")
-            Audioarr.append(AudioSegment.from_wav(filepath))
-    # remove final.wav if exists
-    if os.path.exists(os.path.join("DATA_FILES", str(id), "output", "final.wav")):
-        os.remove(os.path.join("DATA_FILES", str(id), "output", "final.wav"))
-    
-    combined = Audioarr[0]
-    for i in range(1, len(Audioarr)):
-        combined = combined.overlay(Audioarr[i])
-
-    combined.export(os.path.join("DATA_FILES", str(id), "output" ,"final.wav"), format="wav") 
-    # remove proccessed files
-    shutil.rmtree(os.path.join("DATA_FILES", str(id), "proccessed"))
-    # remove splitted files
-    shutil.rmtree(os.path.join("DATA_FILES", str(id), "splitted"))
+        store.set_status(id, "DONE")
+
+        stem_files = [os.path.join("DATA_FILES", str(id), "output", INSTRUMENTS[i] + ".wav") for i in instruments]
+        # summed block by block from memory mapped stems, next to final.wav so a half mixed file is never served
+        mix = time.time()
+        offload_sync(mix_stems, stem_files, os.path.join("DATA_FILES", str(id), "output" ,"final.part.wav"))
+        os.replace(os.path.join("DATA_FILES", str(id), "output" ,"final.part.wav"), final_file(id))
+        observe(id, "mix", time.time() - mix)
+        hub.publish(id, {"type": "done", "download": f"/download/{id}/final",
+                         "instruments": [INSTRUMENTS[i] for i in instruments]})
+        # remove proccessed files
+        shutil.rmtree(os.path.join("DATA_FILES", str(id), "proccessed"), ignore_errors=True)
+        if os.path.exists(os.path.join("DATA_FILES", str(id), "original.wav")):
+            os.remove(os.path.join("DATA_FILES", str(id), "original.wav"))
+        # drop chunks and stems nobody asked for in the last hour
+        get_blob_store().prune(3600)
+    except Exception as e:
+        print(f"Error finishing music {id}: {e}")
+        store.set_status(id, "FAILED")
+        hub.publish(id, {"type": "failed"})
+        return
 
     end = time.time()
+    observe(id, "total", end - start)
     print("Time taken in seconds : ", (end-start))
 
+def observe(id: int, stage: str, seconds: float, job: dict = None):
+    """
+    Record the seconds spent in a stage of music id, in the histograms of
+    GET /metrics, the timings of the music and the timings of a job.
+    """
+    stage_seconds.observe(seconds, stage=stage)
+    store.add_timing(id, stage, seconds)
+    if job is not None:
+        job[stage] = seconds
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Stage histograms and scheduler gauges in the Prometheus text format.
+    """
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
+
+@app.get("/music/{music_id}/timings", status_code=200, response_model=Dict[str, StageTiming])
+async def get_timings(music_id: int):
+    """
+    Seconds spent in each stage of a music: upload, split, encode, enqueue,
+    queue_wait, model_load and inference (as reported by the workers),
+    result_decode, stitch, mix and total.
+    """
+    return {stage: StageTiming(**x) for stage, x in store.get_timings(music_id).items()}
+
+@app.get("/cache", status_code=200, response_model=CacheStats)
+async def get_cache():
+    return CacheStats(**stem_cache.stats())
+
+@app.get("/music/{music_id}/stream/{instrument}")
+async def stream_stem(request: Request, music_id: int, instrument: str):
+    """
+    Stream a stem as WAV while the music is being separated.
+    The audio of every finished run of chunks is sent as soon as it is stitched,
+    and the response ends when the whole stem was sent.
+    """
+    if instrument not in INSTRUMENTS:
+        raise HTTPException(status_code=404, detail="Unknown instrument")
+    output = os.path.join("DATA_FILES", str(music_id), "output", instrument + ".wav")
+    if os.path.exists(output):
+        # players seek with range requests once the stem is complete
+        return file_response(request, output, "audio/wav")
+    music = store.get_music(music_id)
+    if music is None or music["status"] != "PROCESSING":
+        raise HTTPException(status_code=404, detail="Music is not being processed")
+    return StreamingResponse(stream_wav(music_id, instrument), media_type="audio/wav")
+
+def still_processing(music_id: int) -> bool:
+    music = store.get_music(music_id)
+    return music is not None and music["status"] == "PROCESSING"
+
+def stream_wav(music_id: int, instrument: str):
+    """
+    Follow the partial stem of an instrument as it grows, until it is moved to output.
+    """
+    partial = os.path.join("DATA_FILES", str(music_id), "partial", instrument + ".wav")
+    output = os.path.join("DATA_FILES", str(music_id), "output", instrument + ".wav")
+    return follow_wav(partial, output, lambda: still_processing(music_id))
+
 @app.get('/download/{id}/{instrument}')
-async def download(id: int, instrument: str):
-    if os.path.exists(os.path.join("DATA_FILES", str(id), "output", instrument + ".wav")):
-        return FileResponse(os.path.join("DATA_FILES", str(id), "output", instrument + ".wav"))
-    else:
-        return {"error": "file not found"}
\ No newline at end of file
+async def download(request: Request, id: int, instrument: str, format: str = "wav"):
+    """
+    Download a stem or the final mix as wav, mp3 or opus (encoded on the first request).
+    Supports range requests and conditional GET (ETag).
+    """
+    if format not in DELIVERY_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(DELIVERY_FORMATS)}")
+    path = os.path.join("DATA_FILES", str(id), "output", instrument + ".wav")
+    if not os.path.exists(path):
+        return {"error": "file not found"}
+    try:
+        path = await asyncio.wrap_future(transcoder.submit(path, format))
+    except Exception as e:
+        print(f"Error encoding {instrument} of music {id} to {format}: {e}")
+        raise HTTPException(status_code=500, detail=f"Could not encode the file to {format}")
+    return file_response(request, path, DELIVERY_FORMATS[format][0])
\ No newline at end of file
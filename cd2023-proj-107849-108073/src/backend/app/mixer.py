@@ -0,0 +1,133 @@
+import os
+import struct
+import wave
+
+import numpy as np
+
+from pcm import PCM_FORMATS, SAMPLE_WIDTHS, encode_pcm
+
+# frames mixed at a time, bounds the memory used whatever the song length
+MIX_BLOCK_FRAMES = int(os.environ.get('MIX_BLOCK_FRAMES', str(1 << 18)))
+# what to do when the mix goes over full scale: "normalize" (scale the whole mix down) or "clip"
+MIX_PROTECTION = os.environ.get('MIX_PROTECTION', 'normalize')
+# stems named no_<source> are the mixture without that source
+RESIDUAL_PREFIX = 'no_'
+
+
+def wav_data_offset(FileLocation: str):
+    """
+    Find the PCM samples of a WAV file.
+    Returns the offset of the data chunk, its size in bytes and the wave params.
+    """
+    with wave.open(FileLocation, 'rb') as f:
+        params = f.getparams()
+
+    with open(FileLocation, 'rb') as f:
+        riff, _, fmt = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or fmt != b'WAVE':
+            raise ValueError(f"{FileLocation} is not a WAV file")
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f"{FileLocation} has no data chunk")
+            name, size = struct.unpack('<4sI', header)
+            if name == b'data':
+                return f.tell(), size, params
+            # chunks are padded to an even size
+            f.seek(size + (size & 1), os.SEEK_CUR)
+
+
+def open_stem(FileLocation: str):
+    """
+    Memory map the samples of a PCM WAV file as a (frames, channels) array.
+    """
+    offset, size, params = wav_data_offset(FileLocation)
+    dtype, scale = PCM_FORMATS[SAMPLE_WIDTHS[params.sampwidth]]
+    frame_size = params.sampwidth * params.nchannels
+    # the header may claim more data than was written
+    frames = min(size, os.path.getsize(FileLocation) - offset) // frame_size
+    if frames == 0:
+        return np.zeros((0, params.nchannels), dtype=dtype), scale, params
+    samples = np.memmap(FileLocation, dtype=dtype, mode='r', offset=offset, shape=(frames, params.nchannels))
+    return samples, scale, params
+
+
+def _blocks(stems, gains, frames: int, channels: int, block_frames: int):
+    """
+    Yield (start, mixed block) over the whole length of the stems.
+    """
+    for start in range(0, frames, block_frames):
+        end = min(frames, start + block_frames)
+        block = np.zeros((end - start, channels), dtype=np.float32)
+        for (samples, scale), gain in zip(stems, gains):
+            part = samples[start:end]
+            if len(part):
+                block[:len(part)] += part.astype(np.float32) * (gain / scale)
+        yield start, block
+
+
+def mix_stems(stem_files, OutputFile: str, gains=None, block_frames: int = MIX_BLOCK_FRAMES, protection: str = MIX_PROTECTION):
+    """
+    Sum the stems (each multiplied by its gain) into OutputFile, block by block.
+    The stems are memory mapped, so only one block of each is in memory at a time.
+    Returns the gain applied to the whole mix to avoid clipping (1 when none was needed).
+    """
+    if not stem_files:
+        raise ValueError("There are no stems to mix")
+    if gains is None:
+        gains = [1.0] * len(stem_files)
+
+    stems = []
+    params = None
+    for stem_file in stem_files:
+        samples, scale, stem_params = open_stem(stem_file)
+        if params is None:
+            params = stem_params
+        elif (stem_params.nchannels, stem_params.framerate) != (params.nchannels, params.framerate):
+            raise ValueError(f"{stem_file} does not match the format of {stem_files[0]}")
+        stems.append((samples, scale))
+
+    frames = max(len(samples) for samples, _ in stems)
+    channels = params.nchannels
+
+    master = 1.0
+    if protection == 'normalize':
+        # first pass only looks for the peak, the mix is never held in memory
+        peak = 0.0
+        for _, block in _blocks(stems, gains, frames, channels, block_frames):
+            if len(block):
+                peak = max(peak, float(np.abs(block).max()))
+        if peak > 1.0:
+            master = 1.0 / peak
+    elif protection != 'clip':
+        raise ValueError(f"Unknown protection {protection}, expected normalize or clip")
+
+    fmt = SAMPLE_WIDTHS[params.sampwidth]
+    with wave.open(OutputFile, 'wb') as out:
+        out.setnchannels(channels)
+        out.setsampwidth(params.sampwidth)
+        out.setframerate(params.framerate)
+        for _, block in _blocks(stems, gains, frames, channels, block_frames):
+            if master != 1.0:
+                block *= master
+            # encode_pcm clips whatever is still over full scale
+            out.writeframes(encode_pcm(block, fmt))
+    return master
+
+
+def select_stems(model, mix, sources, stems=None):
+    """
+    The requested stems (every source when stems is empty) by name.
+    "no_<source>" is the mixture minus that source, e.g. no_vocals for a karaoke track.
+    """
+    if not stems:
+        return dict(zip(model.sources, sources))
+    selected = {}
+    for name in stems:
+        if name in model.sources:
+            selected[name] = sources[model.sources.index(name)]
+        elif name.startswith(RESIDUAL_PREFIX) and name[len(RESIDUAL_PREFIX):] in model.sources:
+            selected[name] = mix - sources[model.sources.index(name[len(RESIDUAL_PREFIX):])]
+        else:
+            raise ValueError(f'Unknown stem {name}, the model separates {", ".join(model.sources)}')
+    return selected
@@ -0,0 +1,72 @@
+import io
+import wave
+
+import numpy as np
+
+# raw sample formats chunks can travel in: numpy dtype and full scale
+PCM_FORMATS = {
+    's16': (np.dtype('<i2'), 32768.0),
+    's32': (np.dtype('<i4'), 2147483648.0),
+    'f32': (np.dtype('<f4'), 1.0),
+}
+# wav sample width of each integer format
+SAMPLE_WIDTHS = {2: 's16', 4: 's32'}
+
+
+def decode_pcm(data: bytes, fmt: str = 's16', channels: int = 2) -> np.ndarray:
+    """
+    Raw interleaved PCM bytes to a float32 (frames, channels) array.
+    """
+    dtype, scale = PCM_FORMATS[fmt]
+    samples = np.frombuffer(data, dtype=dtype).astype(np.float32)
+    if scale != 1.0:
+        samples /= scale
+    return samples.reshape(-1, channels)
+
+
+def encode_pcm(samples: np.ndarray, fmt: str = 's16') -> bytes:
+    """
+    Float samples in [-1, 1] with shape (frames, channels) to raw interleaved PCM bytes.
+    """
+    dtype, scale = PCM_FORMATS[fmt]
+    if dtype.kind == 'f':
+        return np.ascontiguousarray(samples, dtype=dtype).tobytes()
+    info = np.iinfo(dtype)
+    return np.clip(np.round(samples * scale), info.min, info.max).astype(dtype).tobytes()
+
+
+def read_wav(FileLocation):
+    """
+    Read a 16 or 32 bit PCM WAV file (path or file object).
+    Returns the samples as a float32 (frames, channels) array and the wave params.
+    """
+    with wave.open(FileLocation, 'rb') as f:
+        params = f.getparams()
+        data = f.readframes(params.nframes)
+    return decode_pcm(data, _wav_format(params.sampwidth), params.nchannels), params
+
+
+def to_pcm(samples: np.ndarray, sampwidth: int = 2) -> bytes:
+    """
+    Convert float samples in [-1, 1] to the PCM bytes stored in a WAV file of the given sample width.
+    """
+    return encode_pcm(samples, _wav_format(sampwidth))
+
+
+def wav_bytes(samples: np.ndarray, samplerate: int, sampwidth: int = 2) -> bytes:
+    """
+    Encode a (frames, channels) array as a WAV file in memory.
+    """
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(samples.shape[1])
+        f.setsampwidth(sampwidth)
+        f.setframerate(samplerate)
+        f.writeframes(to_pcm(samples, sampwidth))
+    return buffer.getvalue()
+
+
+def _wav_format(sampwidth: int) -> str:
+    if sampwidth not in SAMPLE_WIDTHS:
+        raise ValueError(f"Unsupported sample width {sampwidth}")
+    return SAMPLE_WIDTHS[sampwidth]
@@ -0,0 +1,116 @@
+import asyncio
+import threading
+from collections import deque
+
+# events kept per music for watchers that fell behind
+PROGRESS_HISTORY = 256
+
+
+class _Topic:
+    def __init__(self, history: int):
+        self.seq = 0
+        self.events = deque(maxlen=history)
+        self.changed = asyncio.Event()
+        self.watchers = 0
+
+
+class ProgressHub:
+    """
+    Fans the events of every music (finished chunks, progress, final mix) out
+    to the clients watching it.
+
+    Events are published from any thread and handed to the event loop once;
+    every watcher then wakes up and reads the events it did not see yet.
+    Nothing is kept, or done, for the music nobody is watching.
+    """
+
+    def __init__(self, history: int = PROGRESS_HISTORY):
+        self.history = history
+        self._loop = None
+        self._lock = threading.Lock()
+        # music id -> _Topic, only touched from the event loop
+        self._topics = {}
+        # music ids watched, read by publish from other threads
+        self._watched = set()
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+
+    def publish(self, music_id: int, event: dict):
+        """
+        Send event to the watchers of music_id. Safe to call from any thread.
+        """
+        with self._lock:
+            if self._loop is None or music_id not in self._watched:
+                return
+        try:
+            self._loop.call_soon_threadsafe(self._publish, music_id, event)
+        except RuntimeError:
+            # the loop was closed, the API is shutting down
+            pass
+
+    def _publish(self, music_id: int, event: dict):
+        topic = self._topics.get(music_id)
+        if topic is None:
+            return
+        topic.seq += 1
+        topic.events.append((topic.seq, event))
+        changed, topic.changed = topic.changed, asyncio.Event()
+        changed.set()
+
+    def watchers(self, music_id: int = None) -> int:
+        if music_id is not None:
+            topic = self._topics.get(music_id)
+            return topic.watchers if topic else 0
+        return sum(topic.watchers for topic in self._topics.values())
+
+    def subscribe(self, music_id: int) -> "_Subscription":
+        """
+        Watch music_id from now on: events published after this call are kept
+        for the watcher, even before it starts iterating. Iterate it to get,
+        as a list, the events published since the last ones; a None in the list
+        means events were missed (the watcher was too slow). aclose() stops watching.
+        """
+        topic = self._topics.get(music_id)
+        if topic is None:
+            topic = self._topics[music_id] = _Topic(self.history)
+            with self._lock:
+                self._watched.add(music_id)
+        topic.watchers += 1
+        return _Subscription(self, music_id, topic)
+
+    def _unsubscribe(self, music_id: int, topic: _Topic):
+        topic.watchers -= 1
+        if topic.watchers == 0:
+            del self._topics[music_id]
+            with self._lock:
+                self._watched.discard(music_id)
+
+
+class _Subscription:
+    def __init__(self, hub: ProgressHub, music_id: int, topic: _Topic):
+        self._hub = hub
+        self._music_id = music_id
+        self._topic = topic
+        self._cursor = topic.seq
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._closed:
+            raise StopAsyncIteration
+        topic = self._topic
+        while topic.seq == self._cursor:
+            await topic.changed.wait()
+        events = [event for seq, event in topic.events if seq > self._cursor]
+        if topic.events and topic.events[0][0] > self._cursor + 1:
+            events.insert(0, None)
+        self._cursor = topic.seq
+        return events
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            self._hub._unsubscribe(self._music_id, self._topic)
@@ -0,0 +1,201 @@
+import os
+import threading
+from collections import deque
+
+# how the next chunk is picked among songs of the same priority:
+# "wfq" (weighted fair queuing), "srpt" (shortest remaining work first) or "fifo"
+SCHEDULER_POLICY = os.environ.get('SCHEDULER_POLICY', 'wfq')
+# chunks kept in flight per worker slot, so a worker never waits for the next one
+SCHEDULER_PREFETCH = int(os.environ.get('SCHEDULER_PREFETCH', '2'))
+# seconds between checks of the worker slots online while songs are processed
+SCHEDULER_REFRESH = float(os.environ.get('SCHEDULER_REFRESH', '10'))
+# times a chunk that could not be sent (submit raised) is queued again before giving up on it
+SCHEDULER_RETRIES = int(os.environ.get('SCHEDULER_RETRIES', '2'))
+
+POLICIES = ('wfq', 'srpt', 'fifo')
+
+
+class _Job:
+    def __init__(self, job_id, items, weight: float, priority: int, order: int, start_tag: float):
+        self.id = job_id
+        self.queue = deque(items)
+        self.weight = weight
+        self.priority = priority
+        self.order = order
+        # virtual finish tag of the last chunk sent
+        self.tag = start_tag
+        self.in_flight = 0
+        # item -> times submit raised for it
+        self.attempts = {}
+
+    @property
+    def remaining(self) -> int:
+        return len(self.queue) + self.in_flight
+
+
+class ChunkScheduler:
+    """
+    Interleaves the chunks of every song being processed and hands them to
+    submit only while fewer than capacity are in flight, so a long song
+    submitted first does not hold back the songs that come after it.
+
+    Songs with a higher priority always go first. Among songs of the same
+    priority the next chunk comes from the song with the smallest virtual
+    finish tag (wfq, each chunk costs 1 / weight), the song with the least
+    remaining chunks (srpt) or the oldest song (fifo).
+
+    submit(job_id, item) sends a chunk and returns True when it is now in
+    flight; task_done(job_id) must then be called once it finished. A falsy
+    return (e.g. the chunk was cached) frees the slot right away. When
+    submit raises, the chunk is queued again, at most retries times, then
+    handed to on_error(job_id, item) so the job can count it as failed.
+
+    admit(), when given, is asked before every chunk sent: while it returns
+    False the chunks are held back even if there is room (backpressure), until
+    task_done or resume is called.
+    """
+
+    def __init__(self, submit, capacity: int = 1, policy: str = SCHEDULER_POLICY, admit=None,
+                 on_error=None, retries: int = SCHEDULER_RETRIES):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown scheduling policy {policy}, expected one of {', '.join(POLICIES)}")
+        self.submit = submit
+        self.admit = admit
+        self.on_error = on_error
+        self.retries = retries
+        self.capacity = max(1, capacity)
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._in_flight = 0
+        self._order = 0
+        # virtual time, the tag of the last chunk sent
+        self._virtual = 0.0
+
+    def add_job(self, job_id, items, weight: float = 1.0, priority: int = 0):
+        """
+        Queue the items (chunks) of a job and send what fits.
+        """
+        if weight <= 0:
+            raise ValueError("The weight of a job must be positive")
+        items = list(items)
+        if not items:
+            return
+        with self._lock:
+            self._order += 1
+            # a new job starts at the current virtual time, it gets no credit for the past
+            self._jobs[job_id] = _Job(job_id, items, weight, priority, self._order, self._virtual)
+        self._pump()
+
+    def task_done(self, job_id):
+        """
+        A chunk of job_id left the workers, send the next ones.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.in_flight == 0:
+                return
+            job.in_flight -= 1
+            self._in_flight -= 1
+            self._forget(job)
+        self._pump()
+
+    def remove_job(self, job_id):
+        """
+        Drop the queued chunks of a job. Chunks in flight still free their slot through task_done.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.queue.clear()
+                self._forget(job)
+
+    def set_capacity(self, capacity: int):
+        with self._lock:
+            self.capacity = max(1, capacity)
+        self._pump()
+
+    def resume(self):
+        """
+        Send what fits, after admit changed its mind.
+        """
+        self._pump()
+
+    def clear(self):
+        with self._lock:
+            self._jobs.clear()
+            self._in_flight = 0
+            self._virtual = 0.0
+
+    def pending(self, job_id=None) -> int:
+        """
+        Chunks not sent yet, of one job or of every job.
+        """
+        with self._lock:
+            if job_id is not None:
+                job = self._jobs.get(job_id)
+                return len(job.queue) if job else 0
+            return sum(len(job.queue) for job in self._jobs.values())
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return self._in_flight
+
+    def _forget(self, job):
+        if job.remaining == 0:
+            del self._jobs[job.id]
+
+    def _pick(self):
+        ready = [job for job in self._jobs.values() if job.queue]
+        if not ready or self._in_flight >= self.capacity:
+            return None
+        if self.admit is not None and not self.admit():
+            return None
+        if self.policy == 'wfq':
+            key = lambda job: (-job.priority, job.tag + 1 / job.weight, job.order)
+        elif self.policy == 'srpt':
+            key = lambda job: (-job.priority, job.remaining, job.order)
+        else:
+            key = lambda job: (-job.priority, job.order)
+        return min(ready, key=key)
+
+    def _pump(self):
+        while True:
+            with self._lock:
+                job = self._pick()
+                if job is None:
+                    return
+                item = job.queue.popleft()
+                job.tag += 1 / job.weight
+                self._virtual = max(self._virtual, job.tag)
+                job.in_flight += 1
+                self._in_flight += 1
+
+            failed = False
+            try:
+                sent = self.submit(job.id, item)
+            except Exception as e:
+                print(f'Error sending {item} of job {job.id}: {e}')
+                sent, failed = False, True
+            if sent:
+                continue
+
+            give_up = False
+            with self._lock:
+                if self._jobs.get(job.id) is job:
+                    job.in_flight -= 1
+                    self._in_flight -= 1
+                    if failed:
+                        attempts = job.attempts.get(item, 0) + 1
+                        if attempts <= self.retries:
+                            job.attempts[item] = attempts
+                            job.queue.appendleft(item)
+                        else:
+                            job.attempts.pop(item, None)
+                            give_up = True
+                    self._forget(job)
+            if give_up and self.on_error is not None:
+                try:
+                    self.on_error(job.id, item)
+                except Exception as e:
+                    print(f'Error failing {item} of job {job.id}: {e}')
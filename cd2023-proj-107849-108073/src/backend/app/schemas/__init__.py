@@ -3,3 +3,6 @@ from .job import Job
 from .music import Music
 from .progress import Progress
 from .track import Track
+from .cache import CacheStats
+from .scheduler import SchedulerStats
+from .timing import StageTiming
@@ -0,0 +1,8 @@
+from pydantic import BaseModel
+
+class CacheStats(BaseModel):
+    hits: int
+    misses: int
+    entries: int
+    size: int
+    max_size: int
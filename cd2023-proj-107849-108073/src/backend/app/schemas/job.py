@@ -1,9 +1,13 @@
 from pydantic import BaseModel
-from typing import List, Union
+from typing import Dict, List, Union
 
 class Job(BaseModel):
     job_id: int
     size: int
-    time: int
+    time: float
     music_id: int
-    track_id: Union[int, List[int]]
\ No newline at end of file
+    track_id: Union[int, List[int]]
+    load_time: float = 0
+    inference_time: float = 0
+    # seconds spent in each stage, from the split of the chunk to its stitching
+    timings: Dict[str, float] = {}
@@ -8,3 +8,5 @@ class Music(BaseModel):
     music_name: str
     music_band: str
     music_tracks: List[Track]
+    # WAITING, PROCESSING, DONE or FAILED
+    status: str = "WAITING"
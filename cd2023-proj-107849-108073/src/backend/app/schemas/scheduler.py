@@ -0,0 +1,16 @@
+from pydantic import BaseModel
+
+class SchedulerStats(BaseModel):
+    pending: int
+    in_flight: int
+    capacity: int
+    slots: int = 1
+    speculated: int = 0
+    speculation_won: int = 0
+    node: str = ""
+    local_capacity: int = 0
+    local_in_flight: int = 0
+    sent_local: int = 0
+    sent_remote: int = 0
+    result_memory: int = 0
+    result_memory_limit: int = 0
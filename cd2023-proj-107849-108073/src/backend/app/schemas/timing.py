@@ -0,0 +1,5 @@
+from pydantic import BaseModel
+
+class StageTiming(BaseModel):
+    seconds: float
+    count: int
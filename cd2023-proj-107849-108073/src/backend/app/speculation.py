@@ -0,0 +1,113 @@
+import os
+import statistics
+import threading
+import time
+from collections import deque
+
+# a chunk is late when it takes longer than SPECULATION_FACTOR times the median chunk
+SPECULATION_FACTOR = float(os.environ.get('SPECULATION_FACTOR', '2.0'))
+# chunks to observe before any chunk is considered late
+SPECULATION_MIN_SAMPLES = int(os.environ.get('SPECULATION_MIN_SAMPLES', '3'))
+# copies of a late chunk sent besides the original (0 disables speculation)
+SPECULATION_MAX_COPIES = int(os.environ.get('SPECULATION_MAX_COPIES', '1'))
+# seconds between checks for late chunks
+SPECULATION_INTERVAL = float(os.environ.get('SPECULATION_INTERVAL', '2.0'))
+# finished chunks the distribution is computed from
+SPECULATION_WINDOW = 200
+
+
+class StragglerMonitor:
+    """
+    Follows the chunks in flight to spot the ones running much longer than usual.
+
+    Every finished chunk adds its run time (measured by the worker) and the
+    time it waited in the queue to a sliding window. A chunk is late once it
+    was sent more than factor times the median run time, plus the median wait,
+    ago. Late chunks can be sent again; the first copy to finish wins and the
+    others are to be revoked.
+    """
+
+    def __init__(self, factor: float = SPECULATION_FACTOR, min_samples: int = SPECULATION_MIN_SAMPLES,
+                 max_copies: int = SPECULATION_MAX_COPIES, window: int = SPECULATION_WINDOW):
+        self.factor = factor
+        self.min_samples = min_samples
+        self.max_copies = max_copies
+        self.speculated = 0
+        self.won = 0
+        self._lock = threading.Lock()
+        # key -> {task_id: (sent at, speculative)}
+        self._flights = {}
+        self._run_times = deque(maxlen=window)
+        self._waits = deque(maxlen=window)
+
+    def dispatched(self, key, task_id: str, speculative: bool = False, now: float = None):
+        with self._lock:
+            self._flights.setdefault(key, {})[task_id] = (now or time.time(), speculative)
+            if speculative:
+                self.speculated += 1
+
+    def resolve(self, key, task_id: str, ok: bool, run_time: float = None, now: float = None):
+        """
+        A copy of the chunk key finished (ok) or failed.
+        Returns whether this result is the one to use, and the other copies to revoke.
+        A failure is only reported when no other copy is still running.
+        """
+        now = now or time.time()
+        with self._lock:
+            flights = self._flights.get(key)
+            if flights is None or task_id not in flights:
+                # the chunk was already resolved by another copy
+                return False, []
+            sent, speculative = flights.pop(task_id)
+            if not ok and flights:
+                return False, []
+            del self._flights[key]
+            if ok:
+                if speculative:
+                    self.won += 1
+                if run_time is not None:
+                    self._run_times.append(run_time)
+                    self._waits.append(max(0.0, now - sent - run_time))
+            return True, list(flights)
+
+    def forget(self, key):
+        with self._lock:
+            self._flights.pop(key, None)
+
+    def threshold(self):
+        """
+        Seconds after which a chunk in flight is late, None until enough chunks finished.
+        """
+        with self._lock:
+            if len(self._run_times) < self.min_samples:
+                return None
+            return self.factor * statistics.median(self._run_times) + statistics.median(self._waits)
+
+    def stragglers(self, now: float = None):
+        """
+        Late chunks that can still get another copy, the longest running first.
+        """
+        threshold = self.threshold()
+        if threshold is None or self.max_copies <= 0:
+            return []
+        now = now or time.time()
+        late = []
+        with self._lock:
+            for key, flights in self._flights.items():
+                copies = sum(1 for _, speculative in flights.values() if speculative)
+                first = min(sent for sent, _ in flights.values())
+                if copies < self.max_copies and now - first > threshold:
+                    late.append((first, key))
+        return [key for _, key in sorted(late)]
+
+    def copies_in_flight(self) -> int:
+        with self._lock:
+            return sum(1 for flights in self._flights.values() for _, speculative in flights.values() if speculative)
+
+    def clear(self):
+        with self._lock:
+            self._flights.clear()
+
+    def stats(self) -> dict:
+        return {"threshold": self.threshold(), "speculated": self.speculated, "won": self.won,
+                "copies_in_flight": self.copies_in_flight()}
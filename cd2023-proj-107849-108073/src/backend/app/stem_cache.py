@@ -0,0 +1,199 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+STEM_CACHE_DIR = os.environ.get('STEM_CACHE_DIR', os.path.join('DATA_FILES', 'stem_cache'))
+STEM_CACHE_MAX_BYTES = int(os.environ.get('STEM_CACHE_MAX_BYTES', str(2 << 30)))
+
+
+def _hasher(parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+        digest.update(b'\0')
+    return digest
+
+
+def audio_key(*parts) -> str:
+    """
+    Cache key of some audio: sha256 over the given parts (bytes or str).
+    """
+    return _hasher(parts).hexdigest()
+
+
+def file_key(FileLocation: str, *parts, block_size: int = 1 << 20) -> str:
+    """
+    Cache key of a file (and the given parts), read in blocks so big songs are never fully in memory.
+    """
+    digest = _hasher(parts)
+    with open(FileLocation, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def files_key(*FileLocations, block_size: int = 1 << 20) -> str:
+    """
+    Checksum of the content of several files, in the given order.
+    """
+    digest = _hasher(())
+    for FileLocation in FileLocations:
+        with open(FileLocation, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class StemCache:
+    """
+    Separated stems kept on disk, keyed by the hash of the audio they came from.
+    Each entry is a folder with one WAV per stem. When the cache grows over
+    max_bytes the least recently used entries are removed.
+    """
+
+    def __init__(self, root: str = STEM_CACHE_DIR, max_bytes: int = STEM_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> size in bytes, least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        self._load()
+
+    def _load(self):
+        os.makedirs(self.root, exist_ok=True)
+        entries = []
+        for key in os.listdir(self.root):
+            folder = os.path.join(self.root, key)
+            if not os.path.isdir(folder) or key.startswith('.'):
+                continue
+            size = sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder))
+            entries.append((os.path.getmtime(folder), key, size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._size += size
+
+    def get(self, key: str):
+        """
+        Stem files of an entry by stem name, or None when it is not cached.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+
+        folder = os.path.join(self.root, key)
+        try:
+            os.utime(folder)
+            return {os.path.splitext(name)[0]: os.path.join(folder, name) for name in os.listdir(folder)}
+        except FileNotFoundError:
+            # removed behind our back (e.g. a reset)
+            with self._lock:
+                self._size -= self._entries.pop(key, 0)
+            return None
+
+    def copy(self, key: str, destinations: dict) -> bool:
+        """
+        Copy the cached stems to destinations (stem name -> path).
+        Returns False, without copying anything, when some stem is not cached.
+        """
+        stems = self.get(key)
+        if stems is None or any(name not in stems for name in destinations):
+            return False
+        for name, destination in destinations.items():
+            # a copy cut short (e.g. by a restart) must not look like a stem
+            tmp_file = destination + '.part'
+            shutil.copyfile(stems[name], tmp_file)
+            os.replace(tmp_file, destination)
+        return True
+
+    def put(self, key: str, stem_files: dict):
+        """
+        Store a copy of stem_files (stem name -> path) under key.
+        Stems missing from an existing entry are added to it.
+        """
+        with self._lock:
+            cached = key in self._entries
+            if cached:
+                self._entries.move_to_end(key)
+        if cached:
+            self._add(key, stem_files)
+            return
+
+        # copy to a temporary folder first so a half written entry is never visible
+        tmp_folder = tempfile.mkdtemp(prefix='.', dir=self.root)
+        size = 0
+        for name, path in stem_files.items():
+            shutil.copyfile(path, os.path.join(tmp_folder, name + '.wav'))
+            size += os.path.getsize(path)
+        try:
+            os.rename(tmp_folder, os.path.join(self.root, key))
+        except OSError:
+            # stored meanwhile by someone else
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+            return
+
+        with self._lock:
+            self._entries[key] = size
+            self._size += size
+        self.evict()
+
+    def _add(self, key: str, stem_files: dict):
+        folder = os.path.join(self.root, key)
+        try:
+            names = {os.path.splitext(name)[0] for name in os.listdir(folder)}
+        except FileNotFoundError:
+            return
+        size = 0
+        for name, path in stem_files.items():
+            if name in names:
+                continue
+            # same as the folders in put, a half written stem is never visible
+            fd, tmp_file = tempfile.mkstemp(prefix='.', dir=self.root)
+            os.close(fd)
+            shutil.copyfile(path, tmp_file)
+            os.replace(tmp_file, os.path.join(folder, name + '.wav'))
+            size += os.path.getsize(path)
+        if size:
+            with self._lock:
+                if key in self._entries:
+                    self._entries[key] += size
+                    self._size += size
+            self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_bytes.
+        """
+        while True:
+            with self._lock:
+                if self._size <= self.max_bytes or not self._entries:
+                    return
+                key, size = self._entries.popitem(last=False)
+                self._size -= size
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "size": self._size,
+                "max_size": self.max_bytes,
+            }
@@ -0,0 +1,388 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# next to the package, so the API (run from backend) and the autoscaler (run from app) share it
+STORE_PATH = os.environ.get(
+    'STORE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'DATA_FILES', 'music.db')
+)
+
+# seconds without renew_runs after which the runs of a process are taken over
+RUN_LEASE = float(os.environ.get('RUN_LEASE', '30'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS music (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL DEFAULT 'Unknown',
+    band TEXT NOT NULL DEFAULT 'Unknown',
+    tracks TEXT NOT NULL DEFAULT '[]',
+    status TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS music_status ON music (status);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    music_id INTEGER NOT NULL,
+    chunk INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    time REAL NOT NULL DEFAULT 0,
+    track_id TEXT NOT NULL,
+    load_time REAL NOT NULL DEFAULT 0,
+    inference_time REAL NOT NULL DEFAULT 0,
+    timings TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_music ON jobs (music_id, chunk);
+
+CREATE TABLE IF NOT EXISTS progress (
+    music_id INTEGER PRIMARY KEY,
+    progress INTEGER NOT NULL,
+    instruments TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS runs (
+    music_id INTEGER PRIMARY KEY,
+    instruments TEXT NOT NULL,
+    stems TEXT NOT NULL,
+    song_key TEXT,
+    priority INTEGER NOT NULL DEFAULT 0,
+    weight REAL NOT NULL DEFAULT 1,
+    owner TEXT,
+    heartbeat REAL,
+    started REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS chunks (
+    music_id INTEGER NOT NULL,
+    chunk INTEGER NOT NULL,
+    start INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    task_id TEXT,
+    location TEXT,
+    checksum TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (music_id, chunk)
+);
+
+CREATE TABLE IF NOT EXISTS timings (
+    music_id INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    seconds REAL NOT NULL DEFAULT 0,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (music_id, stage)
+);
+"""
+
+# states of a chunk in the chunks table
+CHUNK_PENDING = 'pending'
+CHUNK_DISPATCHED = 'dispatched'
+CHUNK_DONE = 'done'
+
+
+class Store:
+    """
+    Music, jobs, progress and the state of every chunk being separated kept
+    in SQLite (WAL mode), so the autoscaler sees the same data and nothing is
+    lost on restart.
+    Each thread gets its own connection.
+    """
+
+    def __init__(self, path: str = STORE_PATH):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as db:
+            db.executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def _execute(self, query: str, params=()):
+        return self._connection().execute(query, params)
+
+    # music
+
+    def create_music(self, status: str = 'UPLOADING') -> int:
+        """
+        Allocate a new music id.
+        """
+        cursor = self._execute('INSERT INTO music (status, created) VALUES (?, ?)', (status, time.time()))
+        return cursor.lastrowid
+
+    def update_music(self, music_id: int, **fields):
+        """
+        Update some columns (name, band, tracks, status) of a music.
+        """
+        if 'tracks' in fields:
+            fields['tracks'] = json.dumps(fields['tracks'])
+        columns = ', '.join(f'{name} = ?' for name in fields)
+        self._execute(f'UPDATE music SET {columns} WHERE id = ?', (*fields.values(), music_id))
+
+    def set_status(self, music_id: int, status: str):
+        self._execute('UPDATE music SET status = ? WHERE id = ?', (status, music_id))
+
+    def delete_music(self, music_id: int):
+        self._execute('DELETE FROM music WHERE id = ?', (music_id,))
+
+    def get_music(self, music_id: int):
+        row = self._execute('SELECT * FROM music WHERE id = ?', (music_id,)).fetchone()
+        return _music(row) if row else None
+
+    def list_music(self, exclude_status: str = 'UPLOADING'):
+        rows = self._execute('SELECT * FROM music WHERE status != ? ORDER BY id', (exclude_status,))
+        return [_music(row) for row in rows]
+
+    def find_music_by_status(self, status: str):
+        rows = self._execute('SELECT * FROM music WHERE status = ? ORDER BY id', (status,))
+        return [_music(row) for row in rows]
+
+    # jobs
+
+    def add_job(self, music_id: int, chunk: int, size: int, track_id) -> int:
+        cursor = self._execute(
+            'INSERT INTO jobs (music_id, chunk, size, track_id) VALUES (?, ?, ?, ?)',
+            (music_id, chunk, size, json.dumps(track_id)),
+        )
+        return cursor.lastrowid
+
+    def finish_job(self, job_id: int, time: float, load_time: float = 0, inference_time: float = 0, timings: dict = None):
+        """
+        Record the worker time of a job and the seconds spent in each stage (timings).
+        """
+        self._execute(
+            'UPDATE jobs SET time = ?, load_time = ?, inference_time = ?, timings = ? WHERE job_id = ?',
+            (time, load_time, inference_time, json.dumps(timings or {}), job_id),
+        )
+
+    def get_job(self, job_id: int):
+        row = self._execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return _job(row) if row else None
+
+    def list_jobs(self, music_id: int = None):
+        if music_id is None:
+            rows = self._execute('SELECT * FROM jobs ORDER BY job_id')
+        else:
+            rows = self._execute('SELECT * FROM jobs WHERE music_id = ? ORDER BY job_id', (music_id,))
+        return [_job(row) for row in rows]
+
+    def recent_job_times(self, limit: int = 50):
+        """
+        Processing time of the last finished jobs, newest first.
+        """
+        rows = self._execute('SELECT time FROM jobs WHERE time > 0 ORDER BY job_id DESC LIMIT ?', (limit,))
+        return [row["time"] for row in rows]
+
+    # progress
+
+    def set_progress(self, music_id: int, progress: int, instruments):
+        self._execute(
+            'INSERT INTO progress (music_id, progress, instruments, updated) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (music_id) DO UPDATE SET progress = excluded.progress, '
+            'instruments = excluded.instruments, updated = excluded.updated',
+            (music_id, progress, json.dumps(instruments), time.time()),
+        )
+
+    def get_progress(self, music_id: int):
+        row = self._execute('SELECT * FROM progress WHERE music_id = ?', (music_id,)).fetchone()
+        if row is None:
+            return None
+        return {"music_id": row["music_id"], "progress": row["progress"], "instruments": json.loads(row["instruments"])}
+
+    # runs, the separation of a music and the state of its chunks
+
+    def start_run(self, music_id: int, instruments, stems, song_key: str, chunks,
+                  priority: int = 0, weight: float = 1.0, owner: str = None):
+        """
+        Record a new separation of music_id with every chunk (start, length) pending.
+        Replaces the previous run of the music.
+        """
+        now = time.time()
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM chunks WHERE music_id = ?', (music_id,))
+            db.execute(
+                'INSERT OR REPLACE INTO runs '
+                '(music_id, instruments, stems, song_key, priority, weight, owner, heartbeat, started) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (music_id, json.dumps(instruments), json.dumps(stems), song_key, priority, weight, owner, now, now),
+            )
+            db.executemany(
+                'INSERT INTO chunks (music_id, chunk, start, length, status, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                [(music_id, i, start, length, CHUNK_PENDING, now) for i, (start, length) in enumerate(chunks)],
+            )
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def get_run(self, music_id: int):
+        row = self._execute('SELECT * FROM runs WHERE music_id = ?', (music_id,)).fetchone()
+        if row is None:
+            return None
+        chunks = self._execute('SELECT * FROM chunks WHERE music_id = ? ORDER BY chunk', (music_id,))
+        return {
+            "music_id": row["music_id"],
+            "instruments": json.loads(row["instruments"]),
+            "stems": json.loads(row["stems"]),
+            "song_key": row["song_key"],
+            "priority": row["priority"],
+            "weight": row["weight"],
+            "owner": row["owner"],
+            "started": row["started"],
+            "chunks": [_chunk(chunk) for chunk in chunks],
+        }
+
+    def list_runs(self):
+        return [row["music_id"] for row in self._execute('SELECT music_id FROM runs ORDER BY started')]
+
+    def claim_run(self, music_id: int, owner: str, previous: str = None, lease: float = RUN_LEASE) -> bool:
+        """
+        Take over a run still owned by previous, once previous has not renewed
+        it for lease seconds (it is dead). Only one process wins.
+        """
+        now = time.time()
+        cursor = self._execute(
+            'UPDATE runs SET owner = ?, heartbeat = ? WHERE music_id = ? AND owner IS ? '
+            'AND (owner IS NULL OR owner = ? OR heartbeat IS NULL OR heartbeat < ?)',
+            (owner, now, music_id, previous, owner, now - lease),
+        )
+        return cursor.rowcount == 1
+
+    def renew_runs(self, owner: str):
+        """
+        Keep the runs of owner from being taken over while it is alive.
+        """
+        self._execute('UPDATE runs SET heartbeat = ? WHERE owner = ?', (time.time(), owner))
+
+    def end_run(self, music_id: int):
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM chunks WHERE music_id = ?', (music_id,))
+            db.execute('DELETE FROM runs WHERE music_id = ?', (music_id,))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def set_chunk(self, music_id: int, chunk: int, status: str, task_id: str = None, location=None, checksum: str = None):
+        """
+        Move a chunk to status; a done chunk records where its stems are (location) and their checksum.
+        """
+        self._execute(
+            'UPDATE chunks SET status = ?, task_id = ?, location = ?, checksum = ?, updated = ? WHERE music_id = ? AND chunk = ?',
+            (status, task_id, json.dumps(location) if location is not None else None, checksum, time.time(), music_id, chunk),
+        )
+
+    # timings, seconds spent by the API in each stage of a music
+
+    def add_timing(self, music_id: int, stage: str, seconds: float):
+        self._execute(
+            'INSERT INTO timings (music_id, stage, seconds, count) VALUES (?, ?, ?, 1) '
+            'ON CONFLICT (music_id, stage) DO UPDATE SET seconds = seconds + excluded.seconds, count = count + 1',
+            (music_id, stage, seconds),
+        )
+
+    def clear_timings(self, music_id: int, keep=('upload',)):
+        """
+        Forget the timings of an earlier separation of a music, except the stages in keep.
+        """
+        marks = ', '.join('?' * len(keep))
+        self._execute(f'DELETE FROM timings WHERE music_id = ? AND stage NOT IN ({marks})', (music_id, *keep))
+
+    def get_timings(self, music_id: int) -> dict:
+        """
+        Total seconds and number of measures of every stage of a music.
+        """
+        rows = self._execute('SELECT * FROM timings WHERE music_id = ?', (music_id,))
+        return {row["stage"]: {"seconds": row["seconds"], "count": row["count"]} for row in rows}
+
+    # maintenance
+
+    def import_json(self, FileLocation: str):
+        """
+        Import the music of the old music.json file, once, when the store is empty.
+        """
+        if not os.path.exists(FileLocation):
+            return
+        if self._execute('SELECT COUNT(*) FROM music').fetchone()[0] > 0:
+            return
+        with open(FileLocation, 'r') as json_file:
+            entries = json.load(json_file)
+
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for entry in entries:
+                metadata = json.loads(entry["METADATA"])
+                db.execute(
+                    'INSERT INTO music (id, name, band, tracks, status, created) VALUES (?, ?, ?, ?, ?, ?)',
+                    (entry["ID"], metadata["music_name"], metadata["music_band"], json.dumps(metadata["music_tracks"]),
+                     entry.get("STATUS", "WAITING"), time.time()),
+                )
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def reset(self):
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for table in ('music', 'jobs', 'progress', 'runs', 'chunks', 'timings'):
+                db.execute(f'DELETE FROM {table}')
+            # ids start from 1 again
+            db.execute("DELETE FROM sqlite_sequence WHERE name IN ('music', 'jobs')")
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+
+def _music(row) -> dict:
+    return {
+        "music_id": row["id"],
+        "music_name": row["name"],
+        "music_band": row["band"],
+        "music_tracks": json.loads(row["tracks"]),
+        "status": row["status"],
+    }
+
+
+def _chunk(row) -> dict:
+    return {
+        "chunk": row["chunk"],
+        "start": row["start"],
+        "length": row["length"],
+        "status": row["status"],
+        "task_id": row["task_id"],
+        "location": json.loads(row["location"]) if row["location"] else None,
+        "checksum": row["checksum"],
+    }
+
+
+def _job(row) -> dict:
+    return {
+        "job_id": row["job_id"],
+        "music_id": row["music_id"],
+        "chunk": row["chunk"],
+        "size": row["size"],
+        "time": row["time"],
+        "track_id": json.loads(row["track_id"]),
+        "load_time": row["load_time"],
+        "inference_time": row["inference_time"],
+        "timings": json.loads(row["timings"]) if row["timings"] else {},
+    }
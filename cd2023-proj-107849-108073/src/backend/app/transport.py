@@ -0,0 +1,123 @@
+import base64
+import os
+
+from blob_store import BlobStore
+from chunking import read_chunk
+
+# how chunks sent to the shared queue, which workers of any node take, travel:
+#   bytes  - the raw bytes are sent inside the message (pickle serializer)
+#   blob   - the bytes are written to the blob store and only the key is sent,
+#            every node must then mount the same BLOB_STORE_DIR
+#   base64 - the bytes are base64 encoded inside a JSON message (legacy)
+# chunks read by workers of the node of the API are sent as a file payload instead,
+# the location of the chunk in the decoded song (see file_payload)
+CHUNK_TRANSPORT = os.environ.get('CHUNK_TRANSPORT', 'bytes')
+TRANSPORT_MODES = ('blob', 'bytes', 'base64')
+# base64 characters decoded at a time when a stem is written to disk
+SAVE_BLOCK_SIZE = 4 * 64 * 1024
+
+if CHUNK_TRANSPORT not in TRANSPORT_MODES:
+    raise ValueError(f'Unknown CHUNK_TRANSPORT {CHUNK_TRANSPORT}, expected one of {TRANSPORT_MODES}')
+
+_store = None
+
+
+def get_blob_store() -> BlobStore:
+    global _store
+    if _store is None:
+        _store = BlobStore()
+    return _store
+
+
+def serializer_for(mode: str = CHUNK_TRANSPORT) -> str:
+    """
+    Celery serializer able to carry payloads of the given mode.
+    """
+    return 'pickle' if mode == 'bytes' else 'json'
+
+
+def encode_payload(data: bytes, mode: str = CHUNK_TRANSPORT) -> dict:
+    """
+    Wrap data so it can be sent through the broker.
+    """
+    if mode == 'blob':
+        return {"mode": "blob", "ref": get_blob_store().put(data)}
+    elif mode == 'bytes':
+        return {"mode": "bytes", "data": data}
+    elif mode == 'base64':
+        return {"mode": "base64", "data": base64.b64encode(data).decode("utf-8")}
+    raise ValueError(f'Unknown transport mode {mode}')
+
+
+def file_payload(FileLocation: str, start: int, length: int) -> dict:
+    """
+    Payload of the frames of a WAV file, for workers on the same machine.
+    """
+    return {"mode": "file", "path": os.path.abspath(FileLocation), "start": start, "length": length}
+
+
+def decode_payload(payload) -> bytes:
+    """
+    Get the bytes carried by a payload created with encode_payload.
+    """
+    # plain base64 strings are still accepted from older clients
+    if isinstance(payload, (str, bytes)):
+        return base64.b64decode(payload)
+
+    mode = payload["mode"]
+    if mode == 'blob':
+        return get_blob_store().get(payload["ref"])
+    elif mode == 'bytes':
+        return payload["data"]
+    elif mode == 'base64':
+        return base64.b64decode(payload["data"])
+    elif mode == 'file':
+        return read_chunk(payload["path"], payload["start"], payload["length"])
+    raise ValueError(f'Unknown transport mode {mode}')
+
+
+def reply_mode(payload) -> str:
+    """
+    Mode to send the stems of a chunk back with. Through the blob store when the
+    worker shares it with the API (the chunk was read from the disk of the node
+    or from the blob store), so results only carry keys; otherwise inside the
+    result, in the mode the chunk came with.
+    """
+    mode = payload_mode(payload)
+    return 'blob' if mode == 'file' else mode
+
+
+def result_size(payload, chunk_bytes: int, stems: int) -> int:
+    """
+    About how many bytes the stems of a chunk add to its result, 0 when they come back by reference.
+    """
+    mode = reply_mode(payload)
+    if mode == 'blob':
+        return 0
+    size = chunk_bytes * stems
+    return size * 4 // 3 if mode == 'base64' else size
+
+
+def payload_mode(payload) -> str:
+    if isinstance(payload, (str, bytes)):
+        return 'base64'
+    return payload["mode"]
+
+
+def save_payload(payload, destination: str):
+    """
+    Write the bytes carried by a payload to destination.
+    Blobs are copied file to file, without going through memory.
+    """
+    if payload_mode(payload) == 'blob':
+        get_blob_store().copy_to(payload["ref"], destination)
+        return
+
+    with open(destination, "wb") as buffer:
+        if payload_mode(payload) == 'base64':
+            # decoded a block at a time, never a second copy of the whole stem
+            data = payload if isinstance(payload, (str, bytes)) else payload["data"]
+            for i in range(0, len(data), SAVE_BLOCK_SIZE):
+                buffer.write(base64.b64decode(data[i:i + SAVE_BLOCK_SIZE]))
+            return
+        buffer.write(decode_payload(payload))
@@ -0,0 +1,160 @@
+import asyncio
+
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+from tinytag import TinyTag
+
+# bytes of the upload needed before the tags at the start of the file are probed
+TAG_PROBE_BYTES = 256 * 1024
+
+
+class UploadError(Exception):
+    pass
+
+
+class StreamingUpload:
+    """
+    Receives the file of a multipart/form-data request while it arrives.
+
+    Every block is written to disk and piped into an ffmpeg process
+    decoding it to WAV, so nothing but the current block is held in memory and
+    the transcoding is done by the time the upload ends. The tags at the start
+    of the file are probed as soon as enough of it arrived.
+    """
+
+    def __init__(self, destination: str, wav_file: str = None, samplerate: int = 44100, channels: int = 2):
+        self.destination = destination
+        self.wav_file = wav_file
+        self.samplerate = samplerate
+        self.channels = channels
+        self.size = 0
+        self.filename = None
+        self.tag = None
+
+        self._blocks = []
+        self._in_file = False
+        self._file_done = False
+        self._header_field = b""
+        self._header_value = b""
+        self._disposition = b""
+
+    # multipart parser callbacks, they only collect the file blocks
+
+    def _on_part_begin(self):
+        self._disposition = b""
+
+    def _on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        if self._header_field.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        # only the first file of the form is kept
+        self._in_file = b"filename" in options and not self._file_done
+        if self._in_file:
+            self.filename = options[b"filename"].decode("utf-8", "replace")
+
+    def _on_part_data(self, data, start, end):
+        if self._in_file:
+            self._blocks.append(data[start:end])
+
+    def _on_part_end(self):
+        if self._in_file:
+            self._file_done = True
+        self._in_file = False
+
+    async def receive(self, request):
+        """
+        Consume the request body. Returns once the file is on disk and decoded.
+        """
+        _, params = parse_options_header(request.headers.get("content-type", ""))
+        if b"boundary" not in params:
+            raise UploadError("Expected a multipart/form-data request")
+
+        parser = MultipartParser(params[b"boundary"], {
+            "on_part_begin": self._on_part_begin,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+        })
+
+        decoder = None
+        if self.wav_file:
+            decoder = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-y", "-loglevel", "error", "-i", "pipe:0",
+                "-f", "wav", "-acodec", "pcm_s16le", "-ar", str(self.samplerate), "-ac", str(self.channels),
+                self.wav_file,
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+            )
+
+        probe = None
+        decoder_broken = False
+        try:
+            with open(self.destination, "wb") as out:
+                async for chunk in request.stream():
+                    parser.write(chunk)
+                    if not self._blocks:
+                        continue
+                    data = b"".join(self._blocks)
+                    self._blocks.clear()
+
+                    self.size += len(data)
+                    await run_in_threadpool(out.write, data)
+                    if decoder is not None and not decoder_broken:
+                        try:
+                            decoder.stdin.write(data)
+                            # waits if ffmpeg falls behind, instead of buffering the upload
+                            await decoder.stdin.drain()
+                        except (BrokenPipeError, ConnectionResetError):
+                            # ffmpeg gave up, its error is reported once the upload ends
+                            decoder_broken = True
+
+                    if probe is None and self.size >= TAG_PROBE_BYTES:
+                        out.flush()
+                        probe = asyncio.ensure_future(run_in_threadpool(self._probe, False))
+            parser.finalize()
+        except BaseException:
+            if decoder is not None and decoder.returncode is None:
+                decoder.kill()
+                # reaped, so no ffmpeg process is left behind
+                await decoder.wait()
+            raise
+
+        if self.size == 0:
+            if decoder is not None:
+                decoder.kill()
+                await decoder.wait()
+            raise UploadError("No file in the request")
+
+        if decoder is not None:
+            if not decoder_broken:
+                decoder.stdin.close()
+            _, stderr = await decoder.communicate()
+            if decoder.returncode != 0:
+                raise UploadError(f"Could not decode the file: {stderr.decode(errors='replace')}")
+
+        if probe is not None:
+            self.tag = await probe
+        if self.tag is None or not (self.tag.title or self.tag.artist):
+            # tags can also be at the end of the file (ID3v1)
+            self.tag = await run_in_threadpool(self._probe, True)
+        return self
+
+    def _probe(self, whole_file: bool):
+        try:
+            return TinyTag.get(self.destination, duration=whole_file)
+        except Exception:
+            return None
+
+
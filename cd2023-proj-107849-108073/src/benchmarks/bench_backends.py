@@ -0,0 +1,93 @@
+"""
+Throughput and quality of the inference backends (DEMUCS_BACKEND) on a fixed clip.
+
+Every backend separates the same clip; its stems are compared to the ones of
+the float32 eager model (SDR, in dB, higher is closer) and the run fails when
+a backend falls under --min-sdr, so it can be used as a regression check.
+
+Run from the src folder:
+    python benchmarks/bench_backends.py --model htdemucs --length 10 --backends eager int8 compiled
+    python benchmarks/bench_backends.py --clip song.wav --offset 30 --length 10 --min-sdr 20
+"""
+import argparse
+import os
+import sys
+import time
+import wave
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend', 'app'))
+from inference import load_model, separate, warmup
+from pcm import decode_pcm
+from bench_chunk_io import synthetic_chunk
+
+
+def sdr(reference: np.ndarray, estimate: np.ndarray) -> float:
+    """
+    Signal to distortion ratio of estimate against reference, in dB.
+    """
+    noise = np.sum((reference - estimate) ** 2)
+    return float(10 * np.log10(np.sum(reference ** 2) / max(noise, 1e-12)))
+
+
+def load_clip(args, samplerate: int) -> torch.Tensor:
+    if args.clip:
+        with wave.open(args.clip, 'rb') as f:
+            if f.getframerate() != samplerate or f.getnchannels() != 2:
+                raise SystemExit(f'{args.clip} must be a stereo WAV at {samplerate} Hz')
+            f.setpos(int(args.offset * samplerate))
+            samples = decode_pcm(f.readframes(int(args.length * samplerate)), 's16', 2)
+    else:
+        samples = synthetic_chunk(args.length, samplerate, 0)
+    return torch.from_numpy(samples.T.copy())
+
+
+def run(model, clip, repeats: int):
+    separate(model, clip)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        sources = separate(model, clip)
+    return sources.numpy(), (time.perf_counter() - start) / repeats
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    reference = None
+    failed = []
+    for backend in ['eager'] + [x for x in args.backends if x != 'eager']:
+        model, load_time = load_model(args.model, backend)
+        warmup(model)
+        if reference is None:
+            clip = load_clip(args, model.samplerate)
+        sources, elapsed = run(model, clip, args.repeats)
+        if reference is None:
+            reference, baseline = sources, elapsed
+
+        scores = [sdr(reference[i], sources[i]) for i in range(len(model.sources))]
+        print(f'{backend:<9} load {load_time:6.2f}s  {elapsed:7.3f}s per clip  {args.length / elapsed:6.2f}x real time  '
+              f'{baseline / elapsed:5.2f}x eager')
+        if backend != 'eager':
+            print('          SDR ' + '  '.join(f'{name} {score:6.2f} dB' for name, score in zip(model.sources, scores)))
+            if min(scores) < args.min_sdr:
+                failed.append(backend)
+
+    if failed:
+        print(f'Under {args.min_sdr} dB of SDR against eager: {", ".join(failed)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the inference backends', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--model', type=str, help='model name', default='htdemucs')
+    parser.add_argument('--backends', type=str, nargs='+', help='backends to compare with eager', default=['int8', 'compiled'])
+    parser.add_argument('--clip', type=str, help='stereo 44.1 kHz WAV to separate, a synthetic clip when not given')
+    parser.add_argument('--offset', type=float, help='start of the clip in seconds', default=0.0)
+    parser.add_argument('--length', type=float, help='clip length in seconds', default=10.0)
+    parser.add_argument('--repeats', type=int, help='timed runs per backend', default=3)
+    parser.add_argument('--min-sdr', type=float, help='lowest SDR in dB accepted for every stem', default=20.0)
+    parser.add_argument('--threads', type=int, help='torch threads', default=os.cpu_count())
+    args = parser.parse_args()
+
+    main(args)
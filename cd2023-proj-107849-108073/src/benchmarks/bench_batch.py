@@ -0,0 +1,48 @@
+"""
+CPU throughput, in chunks per second, of separating chunks one at a time
+versus in batches of several chunks per model call (separate_batch).
+
+Run from the src folder:
+    python benchmarks/bench_batch.py --model htdemucs --chunks 16 --length 10 --batch-sizes 1 2 4 8
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend', 'app'))
+from inference import load_model, separate_batch, warmup
+from bench_chunk_io import synthetic_chunk
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    model, load_time = load_model(args.model)
+    warmup(model)
+    print(f'model {args.model} loaded in {load_time:.2f}s, {args.threads} threads')
+
+    chunks = [torch.from_numpy(synthetic_chunk(args.length, model.samplerate, i).T.copy()) for i in range(args.chunks)]
+
+    baseline = None
+    for batch_size in args.batch_sizes:
+        start = time.perf_counter()
+        for i in range(0, len(chunks), batch_size):
+            separate_batch(model, chunks[i:i + batch_size])
+        elapsed = time.perf_counter() - start
+        throughput = len(chunks) / elapsed
+        baseline = baseline or throughput
+        print(f'batch {batch_size:>3}  {throughput:8.3f} chunks/s  {throughput / baseline:5.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark batched inference', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--model', type=str, help='model name, "stub" skips the inference', default='htdemucs')
+    parser.add_argument('--chunks', type=int, help='number of chunks', default=16)
+    parser.add_argument('--length', type=float, help='chunk length in seconds', default=10.0)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', help='batch sizes to compare', default=[1, 2, 4, 8])
+    parser.add_argument('--threads', type=int, help='torch threads', default=os.cpu_count())
+    args = parser.parse_args()
+
+    main(args)
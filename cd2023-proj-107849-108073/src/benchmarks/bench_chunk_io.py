@@ -0,0 +1,75 @@
+"""
+Per-chunk latency of the worker going through temp files (separate_file)
+versus the in-memory raw PCM path (separate_pcm).
+
+Run from the src folder:
+    python benchmarks/bench_chunk_io.py --model stub --chunks 20 --length 10
+Use --model htdemucs to include the real inference time.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend', 'app'))
+from inference import load_model, separate_file, separate_pcm
+from pcm import encode_pcm, wav_bytes
+
+
+def synthetic_chunk(seconds: float, samplerate: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * samplerate)) / samplerate
+    tone = 0.3 * np.sin(2 * np.pi * 220 * t)
+    noise = 0.05 * rng.standard_normal(len(t))
+    return np.stack([tone + noise, tone - noise], axis=1).astype(np.float32)
+
+
+def bench(func, inputs):
+    latencies = []
+    for data in inputs:
+        start = time.perf_counter()
+        func(data)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(f'{name:<8} mean {statistics.mean(latencies) * 1000:8.2f} ms  '
+          f'median {statistics.median(latencies) * 1000:8.2f} ms  p95 {p95 * 1000:8.2f} ms')
+
+
+def main(args):
+    model, load_time = load_model(args.model)
+    print(f'model {args.model} loaded in {load_time:.2f}s')
+
+    samplerate = model.samplerate
+    chunks = [synthetic_chunk(args.length, samplerate, i) for i in range(args.chunks)]
+    audio = {"format": "s16", "samplerate": samplerate, "channels": 2}
+
+    wav_chunks = [wav_bytes(chunk, samplerate) for chunk in chunks]
+    pcm_chunks = [encode_pcm(chunk, "s16") for chunk in chunks]
+
+    with tempfile.TemporaryDirectory() as folder:
+        disk = bench(lambda data: separate_file(model, data, os.path.join(folder, 'worker')), wav_chunks)
+    memory = bench(lambda data: separate_pcm(model, data, audio), pcm_chunks)
+
+    print(f'{args.chunks} chunks of {args.length}s')
+    report('disk', disk)
+    report('memory', memory)
+    print(f'speedup  {statistics.mean(disk) / statistics.mean(memory):.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the disk and in-memory chunk paths', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--model', type=str, help='model name, "stub" skips the inference', default='stub')
+    parser.add_argument('--chunks', type=int, help='number of chunks', default=20)
+    parser.add_argument('--length', type=float, help='chunk length in seconds', default=10.0)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,250 @@
+"""
+End to end load test of the API and the workers.
+
+Uploads synthetic tracks concurrently (POST /music), asks for their
+separation (POST /music/{id}) and reports, per track and overall:
+upload latency, time to the first stitched chunk (first audio of the
+/stream endpoint), makespan (until the final mix can be downloaded), the
+seconds the API spent in each stage (GET /music/{id}/timings) and how busy
+the worker slots were.
+
+Against a running API (workers started with DEMUCS_MODEL=stub to skip the model):
+    python benchmarks/loadtest.py --api http://localhost:8000 --tracks 8 --length 60
+Or let it start the API and the workers itself, with the stub model:
+    python benchmarks/loadtest.py --spawn 4 --broker amqp://localhost:5672 --tracks 8
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+sys.path.append(os.path.join(BACKEND_DIR, 'app'))
+from pcm import wav_bytes
+
+INSTRUMENTS = ["bass", "drums", "vocals", "other", "no_bass", "no_drums", "no_vocals", "no_other"]
+STAGES = ('upload', 'split', 'encode', 'enqueue', 'queue_wait', 'model_load', 'inference', 'result_decode', 'stitch', 'mix', 'total')
+SAMPLE_RATE = 44100
+
+
+def synthetic_track(seconds: float, seed: int, samplerate: int = SAMPLE_RATE) -> bytes:
+    """
+    A WAV file of a few tones and noise, different for every seed so the stem cache never hits.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * samplerate)) / samplerate
+    tones = sum(0.1 * np.sin(2 * np.pi * f * t) for f in rng.uniform(80, 2000, 3))
+    noise = 0.05 * rng.standard_normal(len(t))
+    return wav_bytes(np.stack([tones + noise, tones - noise], axis=1).astype(np.float32), samplerate)
+
+
+class Client:
+    def __init__(self, api: str, timeout: float = 30):
+        self.api = api.rstrip('/')
+        self.timeout = timeout
+
+    def request(self, method: str, path: str, body: bytes = None, headers: dict = None):
+        request = urllib.request.Request(self.api + path, data=body, method=method, headers=headers or {})
+        return urllib.request.urlopen(request, timeout=self.timeout)
+
+    def json(self, method: str, path: str, payload=None):
+        body = json.dumps(payload).encode() if payload is not None else None
+        with self.request(method, path, body, {'Content-Type': 'application/json'}) as response:
+            return json.load(response)
+
+    def upload(self, filename: str, data: bytes) -> dict:
+        boundary = uuid.uuid4().hex
+        body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                f'Content-Type: audio/wav\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+        with self.request('POST', '/music', body, {'Content-Type': f'multipart/form-data; boundary={boundary}'}) as response:
+            return json.load(response)
+
+    def status(self, music_id: int):
+        for music in self.json('GET', '/music'):
+            if music['music_id'] == music_id:
+                return music.get('status')
+        return None
+
+
+def first_chunk(client: Client, music_id: int, stem: str, deadline: float, poll: float):
+    """
+    Time at which the first stitched audio of a stem could be streamed, None if it never was.
+    """
+    while time.time() < deadline:
+        try:
+            with client.request('GET', f'/music/{music_id}/stream/{stem}') as response:
+                response.read(44)
+                if response.read(1):
+                    return time.time()
+        except urllib.error.HTTPError as e:
+            # not processing yet, the separation starts after POST /music/{id} returned
+            if e.code != 404:
+                raise
+        except (TimeoutError, socket.timeout):
+            # no audio came within the client timeout, the sample is recorded as failed
+            return None
+        time.sleep(poll)
+    return None
+
+
+def final_ready(client: Client, music_id: int, deadline: float, poll: float):
+    """
+    Time at which the final mix could be downloaded, None if the music failed or the deadline passed.
+    """
+    while time.time() < deadline:
+        with client.request('GET', f'/download/{music_id}/final') as response:
+            # a missing file is answered with a json error
+            if response.headers.get('Content-Type', '').startswith('audio'):
+                return time.time()
+        if client.status(music_id) == 'FAILED':
+            return None
+        time.sleep(poll)
+    return None
+
+
+def run_track(client: Client, index: int, args) -> dict:
+    data = synthetic_track(args.length, args.seed + index)
+    result = {'index': index, 'seconds': args.length}
+
+    start = time.time()
+    music_id = client.upload(f'loadtest{index}.wav', data)['music_id']
+    uploaded = time.time()
+    client.json('POST', f'/music/{music_id}?priority=0&weight=1', args.instruments)
+    deadline = uploaded + args.timeout
+
+    first = first_chunk(client, music_id, INSTRUMENTS[args.instruments[0]], deadline, args.poll)
+    end = final_ready(client, music_id, deadline, args.poll)
+
+    jobs = [x for x in client.json('GET', '/job') if x['music_id'] == music_id]
+    result.update({
+        'music_id': music_id,
+        'start': start,
+        'end': end,
+        'upload': uploaded - start,
+        'first_chunk': first - uploaded if first else None,
+        'makespan': end - start if end else None,
+        'chunks': len(jobs),
+        'worker_seconds': sum(x['time'] for x in jobs),
+        'stages': {stage: x['seconds'] for stage, x in client.json('GET', f'/music/{music_id}/timings').items()},
+    })
+    return result
+
+
+def summary(values):
+    values = sorted(x for x in values if x is not None)
+    if not values:
+        return 'n/a'
+    p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+    return f'mean {statistics.mean(values):8.3f}s  median {statistics.median(values):8.3f}s  p95 {p95:8.3f}s'
+
+
+def report(results, slots: int):
+    print(f'{"track":>5} {"id":>5} {"upload":>8} {"1st chunk":>10} {"makespan":>9} {"chunks":>7}')
+    for x in results:
+        cells = [f'{x[k]:.3f}' if x[k] is not None else 'failed' for k in ('upload', 'first_chunk', 'makespan')]
+        print(f'{x["index"]:>5} {x["music_id"]:>5} {cells[0]:>8} {cells[1]:>10} {cells[2]:>9} {x["chunks"]:>7}')
+
+    print()
+    print(f'upload       {summary(x["upload"] for x in results)}')
+    print(f'first chunk  {summary(x["first_chunk"] for x in results)}')
+    print(f'makespan     {summary(x["makespan"] for x in results)}')
+
+    print()
+    print('seconds per stage, summed over every track')
+    for stage in STAGES:
+        print(f'  {stage:<14} {sum(x["stages"].get(stage, 0) for x in results):10.3f}')
+
+    done = [x for x in results if x['end']]
+    if done:
+        wall = max(x['end'] for x in done) - min(x['start'] for x in results)
+        busy = sum(x['worker_seconds'] for x in results)
+        audio = sum(x['seconds'] for x in done)
+        print()
+        print(f'overall makespan {wall:.3f}s for {len(done)}/{len(results)} tracks, {audio / wall:.2f} seconds of audio per second')
+        print(f'worker utilization {busy / (wall * slots):.1%} of {slots} slots')
+
+
+def spawn(args):
+    """
+    Start the API and args.spawn workers with the stub model. Returns the processes.
+    """
+    from autoscaler import WorkerPool, celery_worker
+
+    env = {'DEMUCS_MODEL': 'stub', 'CELERY_BROKER_URL': args.broker}
+    api = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'app.main:app', '--port', str(args.port)],
+                           cwd=BACKEND_DIR, env=dict(os.environ, **env))
+    pool = WorkerPool(celery_worker, cwd=os.path.join(BACKEND_DIR, 'app'), env=env)
+    for _ in range(args.spawn):
+        pool.spawn(max(1, (os.cpu_count() or 1) // args.spawn))
+    return api, pool
+
+
+def wait_for_api(client: Client, timeout: float):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            client.json('GET', '/music')
+            return
+        except (urllib.error.URLError, ConnectionError):
+            if time.time() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+def main(args):
+    api = pool = None
+    if args.spawn:
+        args.api = f'http://localhost:{args.port}'
+        api, pool = spawn(args)
+    client = Client(args.api)
+    try:
+        wait_for_api(client, 60)
+        if args.reset:
+            client.json('POST', '/reset')
+        # the workers take a while to show up after being started
+        time.sleep(args.settle)
+
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            results = list(executor.map(lambda i: run_track(client, i, args), range(args.tracks)))
+        slots = client.json('GET', '/scheduler').get('slots', 1)
+        report(results, slots)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'slots': slots, 'tracks': results}, f, indent=2)
+    finally:
+        if pool is not None:
+            pool.stop()
+        if api is not None:
+            api.terminate()
+            api.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the separation service', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--api', type=str, help='URL of the API', default='http://localhost:8000')
+    parser.add_argument('--tracks', type=int, help='number of tracks', default=4)
+    parser.add_argument('--length', type=float, help='track length in seconds', default=60.0)
+    parser.add_argument('--concurrency', type=int, help='tracks uploaded and processed at once', default=4)
+    parser.add_argument('--instruments', type=int, nargs='+', help='track ids to separate', default=[0, 1, 2, 3])
+    parser.add_argument('--seed', type=int, help='seed of the first synthetic track', default=0)
+    parser.add_argument('--poll', type=float, help='seconds between checks of a track', default=0.1)
+    parser.add_argument('--timeout', type=float, help='seconds a track may take', default=600.0)
+    parser.add_argument('--reset', action='store_true', help='POST /reset before starting')
+    parser.add_argument('--spawn', type=int, help='start the API and this many stub workers', default=0)
+    parser.add_argument('--broker', type=str, help='broker of the spawned workers', default='amqp://localhost:5672')
+    parser.add_argument('--port', type=int, help='port of the spawned API', default=8000)
+    parser.add_argument('--settle', type=float, help='seconds to wait for the workers before starting', default=2.0)
+    parser.add_argument('--json', type=str, help='also write the results to this file')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,47 @@
+import wave
+
+import numpy as np
+
+from affinity import NodeRouter, DEFAULT_QUEUE, node_queue
+from transport import file_payload, decode_payload, reply_mode
+
+def test_route_local_until_full():
+    router = NodeRouter("a", capacity=2)
+    assert router.route("1") == (node_queue("a"), True)
+    assert router.route("2") == (node_queue("a"), True)
+    # the workers of the node are busy, the next chunk goes to any node
+    assert router.route("3") == (DEFAULT_QUEUE, False)
+    assert router.local_in_flight() == 2
+    assert (router.local, router.remote) == (2, 1)
+
+def test_release_frees_local_slot():
+    router = NodeRouter("a", capacity=1)
+    router.route("1")
+    router.route("2")
+    # a remote chunk finishing does not make room on the node
+    router.release("2")
+    assert router.route("3")[1] is False
+    router.release("1")
+    assert router.route("4") == (node_queue("a"), True)
+
+def test_no_local_workers():
+    router = NodeRouter("a")
+    assert router.route("1") == (DEFAULT_QUEUE, False)
+    router.set_capacity(1)
+    assert router.route("2")[1] is True
+    router.clear()
+    assert router.local_in_flight() == 0
+
+def test_file_payload(tmp_path):
+    samples = np.arange(2000, dtype=np.int16).reshape(-1, 2)
+    path = tmp_path / "original.wav"
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(44100)
+        f.writeframes(samples.tobytes())
+
+    payload = file_payload(str(path), 100, 50)
+    assert decode_payload(payload) == samples[100:150].tobytes()
+    # stems of a chunk read from disk go back through the blob store
+    assert reply_mode(payload) == "blob"
@@ -0,0 +1,48 @@
+import sys
+from autoscaler import plan, WorkerPool, Autoscaler
+from store import Store
+
+LIMITS = {"target": 60, "min_workers": 1, "max_workers": 8, "max_load": 0.9}
+
+def test_plan_scale_up():
+    # 30 chunks of 10s should take a minute: 5 workers, sharing 8 cores
+    assert plan(30, 10, 1, 8, 0.5, **LIMITS) == (5, 1)
+    assert plan(1000, 10, 1, 8, 0.5, **LIMITS) == (8, 1)
+    assert plan(4, 10, 0, 8, 0.0, **LIMITS) == (1, 8)
+
+def test_plan_busy_cpu():
+    # the machine is saturated: keep the workers there are
+    assert plan(30, 10, 2, 8, 7.9, **LIMITS) == (2, 4)
+
+def test_plan_scale_down():
+    # one worker at a time
+    assert plan(0, 10, 5, 8, 0.5, **LIMITS) == (4, 2)
+    assert plan(0, 10, 1, 8, 0.5, **LIMITS) == (1, 8)
+
+class FakeAutoscaler(Autoscaler):
+    def __init__(self, pool, store, depths):
+        super().__init__(pool, store, cooldown=0, **LIMITS)
+        self.depths = depths
+        self.cpus = 10
+
+    def queue_depth(self):
+        return self.depths.pop(0)
+
+def sleeper(name, threads):
+    return [sys.executable, "-c", "import time; time.sleep(60)"]
+
+def test_autoscaler_steps(tmp_path):
+    store = Store(str(tmp_path / "music.db"))
+    store.finish_job(store.add_job(1, 0, 1024, [0]), 30)
+    pool = WorkerPool(sleeper)
+    autoscaler = FakeAutoscaler(pool, store, [10, 0, 0])
+    try:
+        autoscaler.step()
+        # 10 chunks of 30s in a minute
+        assert len(pool) == 5
+        autoscaler.step()
+        assert len(pool) == 4
+        assert pool.workers[0][1] == 2
+    finally:
+        pool.stop(timeout=5)
+    assert len(pool) == 0
@@ -0,0 +1,33 @@
+import os
+import time
+from blob_store import BlobStore
+
+def test_put_and_get(tmp_path):
+    store = BlobStore(str(tmp_path / "blobs"))
+    key = store.put(b"abc")
+    assert store.exists(key)
+    assert store.get(key) == b"abc"
+    assert store.path(key).startswith(str(tmp_path / "blobs" / key[:2]))
+
+    # the same content is stored once
+    assert store.put(b"abc") == key
+    assert store.put(b"abd") != key
+    assert not store.exists("0" * 64)
+
+    store.copy_to(key, str(tmp_path / "copy"))
+    assert (tmp_path / "copy").read_bytes() == b"abc"
+
+def test_prune(tmp_path):
+    store = BlobStore(str(tmp_path / "blobs"))
+    old = store.put(b"old")
+    kept = store.put(b"kept")
+    rewritten = store.put(b"rewritten")
+    past = time.time() - 100
+    for key in (old, rewritten):
+        os.utime(store.path(key), (past, past))
+
+    # writing a blob again keeps it around
+    store.put(b"rewritten")
+    store.prune(50)
+    assert not store.exists(old)
+    assert store.exists(kept) and store.exists(rewritten)
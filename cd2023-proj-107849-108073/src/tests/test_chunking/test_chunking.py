@@ -0,0 +1,82 @@
+import pytest
+import wave
+import numpy as np
+from chunking import plan_chunks, auto_chunk_length, chunk_window, split_wav, overlap_add, read_wav, to_pcm, OverlapAddWriter
+
+SAMPLE_RATE = 44100
+
+def write_wav(path, samples):
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(samples.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(to_pcm(samples))
+
+def test_plan_chunks_covers_track():
+    chunks = plan_chunks(1000, 300, 50)
+    assert chunks[0] == (0, 300)
+    assert chunks[-1][0] + chunks[-1][1] == 1000
+    for (start, length), (next_start, _) in zip(chunks, chunks[1:]):
+        assert length == 300
+        assert start + length - next_start == 50
+
+def test_plan_chunks_short_track():
+    assert plan_chunks(100, 300, 50) == [(0, 100)]
+
+def test_plan_chunks_invalid_overlap():
+    with pytest.raises(ValueError):
+        plan_chunks(1000, 50, 50)
+    # three windows would overlap, their crossfades would not sum to 1
+    with pytest.raises(ValueError):
+        plan_chunks(1000, 100, 60)
+
+def test_auto_chunk_length():
+    # long songs are bounded by the maximum length, short ones by the minimum
+    assert auto_chunk_length(3600, 4) == 60
+    assert auto_chunk_length(10, 4) == 5
+    assert auto_chunk_length(200, 4) == pytest.approx(26)
+
+@pytest.mark.parametrize("shape", ["linear", "cosine"])
+@pytest.mark.parametrize("chunk,overlap", [(300, 50), (100, 50), (150, 75)])
+def test_windows_sum_to_one(shape, chunk, overlap):
+    # up to an overlap of half a chunk, only two windows ever overlap
+    chunks = plan_chunks(1000, chunk, overlap)
+    total = np.zeros(1000, dtype=np.float32)
+    for i, (start, length) in enumerate(chunks):
+        total[start:start + length] += chunk_window(i, chunks, shape)
+    assert np.allclose(total, 1, atol=1e-6)
+
+def test_split_and_overlap_add(tmp_path):
+    rng = np.random.default_rng(0)
+    samples = rng.uniform(-0.5, 0.5, size=(SAMPLE_RATE * 3, 2)).astype(np.float32)
+    write_wav(tmp_path / "original.wav", samples)
+
+    chunks = plan_chunks(len(samples), SAMPLE_RATE, SAMPLE_RATE // 4)
+    files = split_wav(str(tmp_path / "original.wav"), str(tmp_path / "splitted"), chunks)
+    assert len(files) == len(chunks)
+
+    overlap_add(files, chunks, str(tmp_path / "stitched.wav"), "cosine")
+    stitched, params = read_wav(str(tmp_path / "stitched.wav"))
+    assert params.nframes == len(samples)
+    # only int16 rounding errors are allowed
+    assert np.abs(stitched - samples).max() < 3 / 32768
+
+def test_writer_out_of_order(tmp_path):
+    samples = np.full((SAMPLE_RATE, 2), 0.25, dtype=np.float32)
+    write_wav(tmp_path / "original.wav", samples)
+    chunks = plan_chunks(len(samples), SAMPLE_RATE // 4, SAMPLE_RATE // 20)
+    files = split_wav(str(tmp_path / "original.wav"), str(tmp_path / "splitted"), chunks)
+
+    writer = OverlapAddWriter(str(tmp_path / "stitched.wav"), chunks, "linear")
+    writer.add(1, files[1])
+    # nothing is final until the first chunk arrives
+    assert writer.frames_written == 0
+    writer.add(0, files[0])
+    assert writer.frames_written == chunks[2][0]
+    for i in range(len(files) - 1, 1, -1):
+        writer.add(i, files[i])
+    assert writer.done
+
+    stitched, params = read_wav(str(tmp_path / "stitched.wav"))
+    assert params.nframes == len(samples)
+    assert np.allclose(stitched, 0.25, atol=2 / 32768)
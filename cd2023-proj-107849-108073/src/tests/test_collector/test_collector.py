@@ -0,0 +1,105 @@
+import socket
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+from celery import Celery
+
+from collector import ResultCollector
+
+# results by id, the collector binds every result to its own backend again
+RESULTS = {}
+
+class Consumer:
+    def drain_events(self, timeout):
+        time.sleep(timeout)
+        raise socket.timeout()
+
+class Result:
+    def __init__(self, id):
+        self.id = id
+        self.ready = None
+        RESULTS[id] = self
+
+    def then(self, callback):
+        self.ready = callback
+
+def make_collector(memory_limit):
+    released = []
+    backend = SimpleNamespace(result_consumer=Consumer(), remove_pending_result=lambda result: None, oid="collector")
+    app = SimpleNamespace(backend=backend, AsyncResult=lambda id, backend=None: RESULTS[id])
+    collector = ResultCollector(app, drain_timeout=0.01, memory_limit=memory_limit, on_release=lambda: released.append(1))
+    return collector, released
+
+def wait_registered(result):
+    for _ in range(100):
+        if result.ready is not None:
+            return
+        time.sleep(0.01)
+    raise AssertionError("result never registered")
+
+def test_memory_limit():
+    collector, released = make_collector(100)
+    handled = []
+    first, second = Result("1"), Result("2")
+    try:
+        collector.add(first, handled.append, 60)
+        assert collector.has_room()
+        collector.add(second, handled.append, 60)
+        assert collector.memory() == 120
+        assert not collector.has_room()
+
+        wait_registered(first)
+        first.ready(first)
+        # freed once the callback returned, and the sender is told
+        assert handled == [first]
+        assert collector.memory() == 60 and collector.has_room()
+        assert released == [1]
+
+        collector.discard(second)
+        assert collector.memory() == 0
+        assert released == [1, 1]
+    finally:
+        collector.stop()
+
+def test_one_result_always_fits():
+    collector, released = make_collector(10)
+    assert collector.has_room(1000)
+    # results coming back by reference reserve nothing
+    collector.add(Result("1"), lambda result: None)
+    try:
+        assert collector.memory() == 0 and collector.has_room(1000)
+        collector.clear()
+        assert released == []
+    finally:
+        collector.stop()
+
+def test_result_sent_from_another_thread():
+    # every thread gets its own rpc:// reply queue, the results must still reach the collector
+    app = Celery("test_collector", broker="memory://", backend="rpc://")
+    collector = ResultCollector(app, drain_timeout=0.05)
+    values = []
+    sender_queues = []
+    arrived = threading.Event()
+
+    def send():
+        task_id = str(uuid.uuid4())
+        result = app.send_task("separate", task_id=task_id, reply_to=collector.reply_to())
+        collector.add(result, lambda result: values.append(result.result) or arrived.set())
+        sender_queues.append(app.backend.oid)
+        # what a worker does when the task is done: answer to reply_to
+        request = SimpleNamespace(id=task_id, reply_to=result_queue, correlation_id=task_id, chord=None,
+                                  group=None, ignore_result=False, delivery_info={}, errbacks=None)
+        app.backend.mark_as_done(task_id, 42, request=request)
+
+    result_queue = collector.reply_to()
+    try:
+        thread = threading.Thread(target=send)
+        thread.start()
+        thread.join()
+        assert arrived.wait(5)
+        assert values == [42]
+        assert sender_queues != [result_queue]
+    finally:
+        collector.stop()
@@ -0,0 +1,122 @@
+import asyncio
+import os
+import shutil
+import struct
+import wave
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from delivery import Transcoder, file_response, follow_wav, parse_range
+
+
+def test_parse_range():
+    assert parse_range("bytes=0-99", 1000) == (0, 99)
+    assert parse_range("bytes=900-", 1000) == (900, 999)
+    assert parse_range("bytes=-100", 1000) == (900, 999)
+    assert parse_range("bytes=-5000", 1000) == (0, 999)
+    assert parse_range("bytes=500-5000", 1000) == (500, 999)
+    # ignored, the whole file is sent
+    assert parse_range("bytes=0-1,5-6", 1000) is None
+    assert parse_range("items=0-1", 1000) is None
+    assert parse_range("bytes=a-b", 1000) is None
+    with pytest.raises(ValueError):
+        parse_range("bytes=1000-", 1000)
+    with pytest.raises(ValueError):
+        parse_range("bytes=10-5", 1000)
+
+
+@pytest.fixture
+def client(tmp_path):
+    path = tmp_path / "stem.wav"
+    path.write_bytes(bytes(range(256)) * 4)
+    app = FastAPI()
+
+    @app.get("/file")
+    def get_file(request: Request):
+        return file_response(request, str(path), "audio/wav")
+
+    return TestClient(app)
+
+
+def test_file_response(client):
+    response = client.get("/file")
+    assert response.status_code == 200 and len(response.content) == 1024
+    assert response.headers["accept-ranges"] == "bytes"
+    etag = response.headers["etag"]
+
+    response = client.get("/file", headers={"Range": "bytes=256-511"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == "bytes 256-511/1024"
+    assert response.content == bytes(range(256))
+
+    assert client.get("/file", headers={"Range": "bytes=2000-"}).status_code == 416
+    # the client copy is still good
+    assert client.get("/file", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/file", headers={"If-None-Match": '"other"'}).status_code == 200
+    # the file changed since the range was asked for, the whole file is sent
+    assert client.get("/file", headers={"Range": "bytes=0-9", "If-Range": '"other"'}).status_code == 200
+
+
+def test_follow_wav(tmp_path):
+    partial, output = str(tmp_path / "partial.wav"), str(tmp_path / "output.wav")
+    frames = bytes(range(256)) * 4
+    with wave.open(partial, "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(44100)
+        f.writeframes(frames[:40])
+    state = {"processing": True}
+
+    async def follow():
+        stream = follow_wav(partial, output, lambda: state["processing"], poll_interval=0.01)
+        received = [await stream.__anext__(), await stream.__anext__()]
+        # only whole frames are sent, the half frame at the end never is
+        with open(partial, "ab") as f:
+            f.write(frames[40:] + b"\x00\x00")
+        # complete, what was not sent yet follows and the stream ends
+        os.replace(partial, output)
+        state["processing"] = False
+        async for data in stream:
+            assert len(data) % 4 == 0
+            received.append(data)
+        return received
+
+    received = asyncio.run(follow())
+    header = received[0]
+    assert len(header) == 44 and struct.unpack_from("<I", header, 40)[0] == 0xFFFFFFFF
+    assert received[1] == frames[:40]
+    assert b"".join(received[1:]) == frames
+
+
+def test_follow_wav_not_processing(tmp_path):
+    async def follow():
+        return [x async for x in follow_wav(str(tmp_path / "partial.wav"), str(tmp_path / "output.wav"), lambda: False)]
+
+    assert asyncio.run(follow()) == []
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_transcoder(tmp_path):
+    wav = tmp_path / "final.wav"
+    with wave.open(str(wav), "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(44100)
+        f.writeframes(bytes(44100 * 4))
+    transcoder = Transcoder(workers=1)
+
+    assert transcoder.submit(str(wav), "wav").result() == str(wav)
+    # asked twice at once, encoded once
+    first, second = transcoder.submit(str(wav), "mp3"), transcoder.submit(str(wav), "mp3")
+    assert first is second
+    target = first.result()
+    assert target.endswith(".mp3") and os.path.getsize(target) > 0
+    assert os.listdir(os.path.dirname(target)) == ["final.mp3"]
+    # cached until the wav changes
+    assert transcoder.submit(str(wav), "mp3").done()
+    # (an encoding older than the wav)
+    os.utime(target, ns=(os.stat(wav).st_mtime_ns - 10**9,) * 2)
+    assert transcoder.submit(str(wav), "mp3").result() == target
+    assert os.stat(target).st_mtime_ns >= os.stat(wav).st_mtime_ns
@@ -0,0 +1,28 @@
+from metrics import Histogram, Gauge, Registry
+
+
+def test_histogram():
+    histogram = Histogram("stage_seconds", "Seconds per stage", ["stage"], buckets=(0.1, 1.0))
+    histogram.observe(0.05, stage="split")
+    histogram.observe(0.1, stage="split")
+    histogram.observe(5, stage="split")
+    histogram.observe(0.5, stage="mix")
+
+    lines = histogram.render().splitlines()
+    assert lines[:2] == ["# HELP stage_seconds Seconds per stage", "# TYPE stage_seconds histogram"]
+    # buckets are cumulative and a value equal to a bound falls in it
+    assert 'stage_seconds_bucket{stage="split",le="0.1"} 2' in lines
+    assert 'stage_seconds_bucket{stage="split",le="1.0"} 2' in lines
+    assert 'stage_seconds_bucket{stage="split",le="+Inf"} 3' in lines
+    assert 'stage_seconds_count{stage="split"} 3' in lines
+    assert 'stage_seconds_sum{stage="split"} 5.15' in lines
+    assert 'stage_seconds_bucket{stage="mix",le="0.1"} 0' in lines
+    assert 'stage_seconds_count{stage="mix"} 1' in lines
+
+
+def test_registry():
+    metrics = Registry()
+    metrics.register(Gauge("slots", "Worker slots", lambda: 4))
+    metrics.register(Histogram("empty", "Nothing observed"))
+    assert metrics.render() == ("# HELP slots Worker slots\n# TYPE slots gauge\nslots 4.0\n"
+                                "# HELP empty Nothing observed\n# TYPE empty histogram\n")
@@ -0,0 +1,74 @@
+import wave
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from mixer import mix_stems, open_stem, select_stems
+from pcm import read_wav, to_pcm
+
+SAMPLE_RATE = 44100
+
+def write_wav(path, samples):
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(samples.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(to_pcm(samples))
+    return str(path)
+
+def test_open_stem(tmp_path):
+    samples = np.full((1000, 2), 0.25, dtype=np.float32)
+    samples_map, scale, params = open_stem(write_wav(tmp_path / "a.wav", samples))
+    assert samples_map.shape == (1000, 2)
+    assert np.allclose(samples_map / scale, 0.25, atol=1e-4)
+
+def test_mix_with_gains_in_blocks(tmp_path):
+    a = np.full((1000, 2), 0.25, dtype=np.float32)
+    b = np.full((600, 2), 0.125, dtype=np.float32)
+    files = [write_wav(tmp_path / "a.wav", a), write_wav(tmp_path / "b.wav", b)]
+
+    master = mix_stems(files, str(tmp_path / "final.wav"), gains=[1.0, 2.0], block_frames=128)
+    mixed, params = read_wav(str(tmp_path / "final.wav"))
+
+    assert master == 1.0
+    assert params.nframes == 1000
+    assert np.allclose(mixed[:600], 0.5, atol=1e-4)
+    assert np.allclose(mixed[600:], 0.25, atol=1e-4)
+
+def test_mix_normalizes_instead_of_clipping(tmp_path):
+    a = np.full((1000, 2), 0.75, dtype=np.float32)
+    a[500:] = 0.25
+    files = [write_wav(tmp_path / "a.wav", a), write_wav(tmp_path / "b.wav", a)]
+
+    master = mix_stems(files, str(tmp_path / "final.wav"), block_frames=100)
+    mixed, _ = read_wav(str(tmp_path / "final.wav"))
+
+    assert np.isclose(master, 1 / 1.5, atol=1e-4)
+    assert np.allclose(mixed[:500], 1.0, atol=1e-3)
+    assert np.allclose(mixed[500:], 1 / 3, atol=1e-3)
+
+# order of the sources of the htdemucs models
+MODEL = SimpleNamespace(sources=["drums", "bass", "other", "vocals"])
+
+def separated():
+    rng = np.random.default_rng(0)
+    sources = rng.uniform(-0.2, 0.2, (4, 2, 100))
+    return sources.sum(axis=0), sources
+
+def test_select_every_source():
+    mix, sources = separated()
+    stems = select_stems(MODEL, mix, sources)
+    assert list(stems) == MODEL.sources
+    np.testing.assert_array_equal(stems["bass"], sources[1])
+
+def test_select_subset_with_residuals():
+    mix, sources = separated()
+    stems = select_stems(MODEL, mix, sources, ["no_vocals", "bass", "no_drums"])
+    assert list(stems) == ["no_vocals", "bass", "no_drums"]
+    np.testing.assert_allclose(stems["no_vocals"], sources[0] + sources[1] + sources[2])
+    np.testing.assert_allclose(stems["no_drums"], sources[1] + sources[2] + sources[3])
+    np.testing.assert_array_equal(stems["bass"], sources[1])
+
+def test_select_unknown_stem():
+    mix, sources = separated()
+    with pytest.raises(ValueError):
+        select_stems(MODEL, mix, sources, ["no_piano"])
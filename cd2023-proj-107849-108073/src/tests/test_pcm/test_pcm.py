@@ -0,0 +1,37 @@
+import io
+import numpy as np
+import pytest
+from pcm import PCM_FORMATS, decode_pcm, encode_pcm, read_wav, wav_bytes
+
+def samples(frames: int, channels: int) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    return rng.uniform(-0.9, 0.9, (frames, channels)).astype(np.float32)
+
+@pytest.mark.parametrize("fmt", ["s16", "s32", "f32"])
+@pytest.mark.parametrize("channels", [1, 2])
+def test_round_trip(fmt, channels):
+    original = samples(1000, channels)
+    data = encode_pcm(original, fmt)
+    assert len(data) == 1000 * channels * PCM_FORMATS[fmt][0].itemsize
+
+    decoded = decode_pcm(data, fmt, channels)
+    assert decoded.dtype == np.float32
+    assert decoded.shape == (1000, channels)
+    # within one step of the integer formats
+    np.testing.assert_allclose(decoded, original, atol=1 / PCM_FORMATS[fmt][1])
+
+def test_clipping():
+    decoded = decode_pcm(encode_pcm(np.array([[2.0, -2.0]]), "s16"), "s16")
+    np.testing.assert_allclose(decoded, [[32767 / 32768, -1.0]])
+
+@pytest.mark.parametrize("sampwidth", [2, 4])
+def test_wav_round_trip(sampwidth):
+    original = samples(500, 2)
+    decoded, params = read_wav(io.BytesIO(wav_bytes(original, 44100, sampwidth)))
+    assert (params.nchannels, params.sampwidth, params.framerate, params.nframes) == (2, sampwidth, 44100, 500)
+    assert decoded.dtype == np.float32 and decoded.shape == (500, 2)
+    np.testing.assert_allclose(decoded, original, atol=1 / 32768)
+
+def test_unsupported_sample_width():
+    with pytest.raises(ValueError):
+        wav_bytes(samples(10, 2), 44100, 3)
@@ -0,0 +1,68 @@
+import asyncio
+import threading
+
+from progress_hub import ProgressHub
+
+
+def test_fan_out():
+    async def main():
+        hub = ProgressHub()
+        hub.bind(asyncio.get_running_loop())
+        # nobody watches yet, nothing is kept
+        hub.publish(1, {"type": "chunk", "chunk": 0})
+
+        first, second = hub.subscribe(1), hub.subscribe(1)
+        waiting = [asyncio.ensure_future(first.__anext__()), asyncio.ensure_future(second.__anext__())]
+        await asyncio.sleep(0)
+        assert hub.watchers(1) == 2
+
+        # published from another thread, as the collector does
+        thread = threading.Thread(target=lambda: [hub.publish(1, {"type": "chunk", "chunk": i}) for i in (1, 2)])
+        thread.start()
+        thread.join()
+        hub.publish(2, {"type": "chunk", "chunk": 0})
+
+        events = await asyncio.gather(*waiting)
+        # both published before the watchers woke up, they come together
+        assert [[x["chunk"] for x in batch] for batch in events] == [[1, 2], [1, 2]]
+
+        await first.aclose()
+        await second.aclose()
+        assert hub.watchers() == 0
+
+    asyncio.run(main())
+
+
+def test_slow_watcher():
+    async def main():
+        hub = ProgressHub(history=2)
+        hub.bind(asyncio.get_running_loop())
+        events = hub.subscribe(1)
+        waiting = asyncio.ensure_future(events.__anext__())
+        await asyncio.sleep(0)
+        for i in range(5):
+            hub.publish(1, {"type": "chunk", "chunk": i})
+        await asyncio.sleep(0)
+        # only the last events are kept, None marks the ones missed
+        batch = await waiting
+        assert batch[0] is None and [x["chunk"] for x in batch[1:]] == [3, 4]
+        await events.aclose()
+
+    asyncio.run(main())
+
+
+def test_events_before_iterating():
+    async def main():
+        hub = ProgressHub()
+        hub.bind(asyncio.get_running_loop())
+        events = hub.subscribe(1)
+        # watching starts with subscribe, not with the first read
+        assert hub.watchers(1) == 1
+        hub.publish(1, {"type": "chunk", "chunk": 0})
+        await asyncio.sleep(0)
+        assert [x["chunk"] for x in await events.__anext__()] == [0]
+        await events.aclose()
+        await events.aclose()
+        assert hub.watchers() == 0
+
+    asyncio.run(main())
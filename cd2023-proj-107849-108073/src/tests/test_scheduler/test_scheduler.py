@@ -0,0 +1,89 @@
+from scheduler import ChunkScheduler
+
+def make_scheduler(capacity, policy="wfq"):
+    sent = []
+    scheduler = ChunkScheduler(lambda job, item: sent.append((job, item)) or True, capacity, policy)
+    return scheduler, sent
+
+def run(scheduler, sent):
+    # chunks finish in the order they were sent, until nothing is left
+    done = 0
+    while done < len(sent):
+        scheduler.task_done(sent[done][0])
+        done += 1
+
+def test_capacity():
+    scheduler, sent = make_scheduler(2)
+    scheduler.add_job("long", range(10))
+    assert len(sent) == 2
+    assert scheduler.pending() == 8
+    scheduler.task_done("long")
+    assert len(sent) == 3
+    assert scheduler.in_flight() == 2
+
+def test_wfq_interleaves():
+    scheduler, sent = make_scheduler(1)
+    scheduler.add_job("long", range(10))
+    scheduler.add_job("short", range(2))
+    run(scheduler, sent)
+    # the short song does not wait for the whole long one
+    assert [job for job, _ in sent[:5]] == ["long", "long", "short", "long", "short"]
+    assert len(sent) == 12
+    assert scheduler.pending() == 0 and scheduler.in_flight() == 0
+
+def test_weight_and_priority():
+    scheduler, sent = make_scheduler(1)
+    scheduler.add_job("a", range(6))
+    scheduler.add_job("b", range(6), weight=2)
+    scheduler.add_job("urgent", range(2), priority=1)
+    run(scheduler, sent)
+    jobs = [job for job, _ in sent]
+    assert jobs[1:3] == ["urgent", "urgent"]
+    # b gets twice the chunks of a while both are queued
+    assert jobs[:9].count("b") == 2 * jobs[1:9].count("a")
+
+def test_srpt():
+    scheduler, sent = make_scheduler(1, "srpt")
+    scheduler.add_job("long", range(5))
+    scheduler.add_job("short", range(2))
+    run(scheduler, sent)
+    assert [job for job, _ in sent] == ["long", "short", "short", "long", "long", "long", "long"]
+
+def test_not_sent():
+    sent = []
+    # odd chunks are "cached" and never go to the workers
+    scheduler = ChunkScheduler(lambda job, item: sent.append(item) or item % 2 == 0, 2)
+    scheduler.add_job("a", range(6))
+    assert sent == [0, 1, 2]
+    assert scheduler.in_flight() == 2
+
+def test_admit_holds_back():
+    room = [True]
+    sent = []
+    scheduler = ChunkScheduler(lambda job, item: sent.append(item) or True, 4, admit=lambda: room[0])
+    scheduler.add_job("a", range(6))
+    assert len(sent) == 4
+    room[0] = False
+    scheduler.task_done("a")
+    # a slot is free, but the chunks wait until there is room again
+    assert len(sent) == 4 and scheduler.pending() == 2
+    room[0] = True
+    scheduler.resume()
+    assert len(sent) == 5
+
+def test_submit_raises():
+    calls = []
+    failed = []
+
+    def submit(job, item):
+        calls.append(item)
+        if item == 1:
+            raise ConnectionError("broker down")
+        return True
+
+    scheduler = ChunkScheduler(submit, 4, on_error=lambda job, item: failed.append((job, item)), retries=2)
+    scheduler.add_job("a", range(3))
+    # chunk 1 is tried again twice, then given up instead of silently dropped
+    assert calls == [0, 1, 1, 1, 2]
+    assert failed == [("a", 1)]
+    assert scheduler.in_flight() == 2 and scheduler.pending() == 0
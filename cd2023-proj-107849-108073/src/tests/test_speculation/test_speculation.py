@@ -0,0 +1,38 @@
+from speculation import StragglerMonitor
+
+def finish_chunks(monitor, count, run_time):
+    for i in range(count):
+        monitor.dispatched(("song", i), f"task{i}", now=100.0)
+        assert monitor.resolve(("song", i), f"task{i}", True, run_time, now=100.0 + run_time + 1) == (True, [])
+
+def test_threshold():
+    monitor = StragglerMonitor(factor=2, min_samples=3)
+    finish_chunks(monitor, 2, 10)
+    assert monitor.threshold() is None
+    finish_chunks(monitor, 1, 10)
+    # twice the median run time plus the median wait in the queue
+    assert monitor.threshold() == 21
+
+def test_stragglers_and_first_copy_wins():
+    monitor = StragglerMonitor(factor=2, min_samples=3)
+    finish_chunks(monitor, 3, 10)
+    monitor.dispatched(("song", 7), "slow", now=200.0)
+    monitor.dispatched(("song", 8), "fine", now=215.0)
+    assert monitor.stragglers(now=225.0) == [("song", 7)]
+
+    monitor.dispatched(("song", 7), "copy", speculative=True, now=225.0)
+    # already has a copy
+    assert monitor.stragglers(now=230.0) == []
+    assert monitor.copies_in_flight() == 1
+
+    assert monitor.resolve(("song", 7), "copy", True, 9, now=235.0) == (True, ["slow"])
+    assert monitor.resolve(("song", 7), "slow", True, 30, now=240.0) == (False, [])
+    assert monitor.won == 1 and monitor.speculated == 1
+
+def test_failure_waits_for_other_copy():
+    monitor = StragglerMonitor(factor=2, min_samples=3)
+    monitor.dispatched(("song", 0), "original", now=0.0)
+    monitor.dispatched(("song", 0), "copy", speculative=True, now=50.0)
+    # the original failed, but the copy may still succeed
+    assert monitor.resolve(("song", 0), "original", False) == (False, [])
+    assert monitor.resolve(("song", 0), "copy", False) == (True, [])
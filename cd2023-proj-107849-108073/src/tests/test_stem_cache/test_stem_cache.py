@@ -0,0 +1,68 @@
+import os
+from stem_cache import StemCache, audio_key, file_key
+
+def write_stems(folder, name, size):
+    os.makedirs(folder, exist_ok=True)
+    files = {}
+    for stem in ["bass", "drums"]:
+        files[stem] = os.path.join(folder, f"{name}-{stem}.wav")
+        with open(files[stem], "wb") as f:
+            f.write(bytes([len(name)]) * size)
+    return files
+
+def test_keys():
+    assert audio_key("htdemucs", b"abc") == audio_key("htdemucs", b"abc")
+    assert audio_key("htdemucs", b"abc") != audio_key("htdemucs_ft", b"abc")
+
+def test_file_key(tmp_path):
+    path = tmp_path / "a.wav"
+    path.write_bytes(b"x" * 5000)
+    assert file_key(str(path), "htdemucs", block_size=1000) == file_key(str(path), "htdemucs")
+
+def test_hit_and_miss(tmp_path):
+    cache = StemCache(str(tmp_path / "cache"), max_bytes=10000)
+    assert cache.get("a") is None
+
+    cache.put("a", write_stems(str(tmp_path / "in"), "a", 100))
+    destinations = {"bass": str(tmp_path / "bass.wav")}
+    assert cache.copy("a", destinations)
+    assert (tmp_path / "bass.wav").read_bytes() == bytes([1]) * 100
+    assert not cache.copy("a", {"vocals": str(tmp_path / "vocals.wav")})
+
+    stats = cache.stats()
+    assert stats["misses"] == 1
+    assert stats["hits"] == 2
+    assert stats["entries"] == 1
+    assert stats["size"] == 200
+
+def test_lru_eviction(tmp_path):
+    cache = StemCache(str(tmp_path / "cache"), max_bytes=500)
+    cache.put("a", write_stems(str(tmp_path / "in"), "a", 100))
+    cache.put("bb", write_stems(str(tmp_path / "in"), "bb", 100))
+    # a is now the most recently used
+    assert cache.get("a") is not None
+    cache.put("ccc", write_stems(str(tmp_path / "in"), "ccc", 100))
+
+    assert cache.get("bb") is None
+    assert cache.get("a") is not None
+    assert cache.get("ccc") is not None
+    assert cache.stats()["size"] == 400
+
+def test_reload_from_disk(tmp_path):
+    cache = StemCache(str(tmp_path / "cache"))
+    cache.put("a", write_stems(str(tmp_path / "in"), "a", 100))
+    cache = StemCache(str(tmp_path / "cache"))
+    assert cache.stats()["entries"] == 1
+    assert cache.get("a") is not None
+
+def test_put_adds_missing_stems(tmp_path):
+    cache = StemCache(str(tmp_path / "cache"), max_bytes=10000)
+    stems = write_stems(str(tmp_path / "in"), "a", 100)
+    cache.put("a", {"bass": stems["bass"]})
+    assert not cache.copy("a", {"drums": str(tmp_path / "drums.wav")})
+
+    # another selection of the same audio completes the entry
+    cache.put("a", stems)
+    assert cache.copy("a", {"bass": str(tmp_path / "bass.wav"), "drums": str(tmp_path / "drums.wav")})
+    assert cache.stats()["size"] == 200
+    assert StemCache(str(tmp_path / "cache")).stats()["size"] == 200
@@ -0,0 +1,110 @@
+import json
+import threading
+from store import Store
+
+def test_music(tmp_path):
+    store = Store(str(tmp_path / "music.db"))
+    first = store.create_music()
+    second = store.create_music()
+    assert second == first + 1
+
+    # music still uploading is not listed
+    assert store.list_music() == []
+    store.update_music(first, name="Song", band="Band", status="WAITING")
+    assert [x["music_id"] for x in store.list_music()] == [first]
+    assert store.get_music(first)["music_name"] == "Song"
+
+    store.set_status(first, "DONE")
+    assert store.find_music_by_status("DONE")[0]["music_id"] == first
+    store.delete_music(second)
+    assert store.get_music(second) is None
+
+def test_jobs_and_progress(tmp_path):
+    store = Store(str(tmp_path / "music.db"))
+    job_id = store.add_job(1, 0, 1024, [0, 2])
+    store.finish_job(job_id, 3.5, 0.1, 3.2)
+    job = store.get_job(job_id)
+    assert job["track_id"] == [0, 2]
+    assert job["time"] == 3.5
+    assert job["inference_time"] == 3.2
+    assert store.get_job(job_id + 1) is None
+
+    assert store.get_progress(1) is None
+    store.set_progress(1, 10, [0, 2])
+    store.set_progress(1, 50, [0, 2])
+    assert store.get_progress(1) == {"music_id": 1, "progress": 50, "instruments": [0, 2]}
+
+def test_ids_are_unique_across_threads(tmp_path):
+    store = Store(str(tmp_path / "music.db"))
+    ids = []
+    def create():
+        for _ in range(20):
+            ids.append(store.create_music())
+    threads = [threading.Thread(target=create) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(ids)) == 80
+
+def test_import_json_and_reset(tmp_path):
+    metadata = {"music_id": 3, "music_name": "Unknown", "music_band": "Unknown", "music_tracks": []}
+    (tmp_path / "music.json").write_text(json.dumps([{"ID": 3, "STATUS": "WAITING", "METADATA": json.dumps(metadata)}]))
+    store = Store(str(tmp_path / "music.db"))
+    store.import_json(str(tmp_path / "music.json"))
+    assert store.get_music(3)["status"] == "WAITING"
+    assert store.create_music() == 4
+
+    store.reset()
+    assert store.list_music() == []
+    assert store.create_music() == 1
+
+def test_runs(tmp_path):
+    store = Store(str(tmp_path / "music.db"))
+    store.start_run(1, [0, 6], ["bass", "no_vocals"], "key", [(0, 100), (90, 100), (180, 20)], owner="a")
+    store.set_chunk(1, 0, "dispatched", task_id="task")
+    store.set_chunk(1, 1, "done", location={"bass": "b/1.wav"}, checksum="abc")
+
+    run = store.get_run(1)
+    assert run["stems"] == ["bass", "no_vocals"]
+    assert [x["status"] for x in run["chunks"]] == ["dispatched", "done", "pending"]
+    assert run["chunks"][1]["location"] == {"bass": "b/1.wav"}
+    assert (run["chunks"][2]["start"], run["chunks"][2]["length"]) == (180, 20)
+    assert store.list_runs() == [1]
+
+    # the run is not taken over while its owner renews it
+    assert not store.claim_run(1, "b", "a")
+    store.renew_runs("a")
+    assert not store.claim_run(1, "b", "a", lease=60)
+
+    # only one process takes over the run of a dead one
+    assert store.claim_run(1, "b", "a", lease=0)
+    assert not store.claim_run(1, "c", "a", lease=0)
+    assert store.get_run(1)["owner"] == "b"
+
+    # a new run of the same music starts from scratch
+    store.start_run(1, [0], ["bass"], "key", [(0, 100)])
+    assert [x["status"] for x in store.get_run(1)["chunks"]] == ["pending"]
+    store.end_run(1)
+    assert store.get_run(1) is None and store.list_runs() == []
+
+
+def test_timings(tmp_path):
+    store = Store(str(tmp_path / "music.db"))
+    store.add_timing(1, "upload", 0.5)
+    store.add_timing(1, "split", 0.25)
+    store.add_timing(1, "split", 0.5)
+    assert store.get_timings(1) == {"upload": {"seconds": 0.5, "count": 1}, "split": {"seconds": 0.75, "count": 2}}
+
+    # a new separation starts counting again, the upload is kept
+    store.clear_timings(1)
+    assert store.get_timings(1) == {"upload": {"seconds": 0.5, "count": 1}}
+    assert store.get_timings(2) == {}
+
+
+def test_job_timings(tmp_path):
+    store = Store(str(tmp_path / "music.db"))
+    job_id = store.add_job(1, 0, 100, [0])
+    assert store.get_job(job_id)["timings"] == {}
+    store.finish_job(job_id, 1.5, 0.0, 1.2, {"split": 0.01, "inference": 1.2})
+    assert store.get_job(job_id)["timings"] == {"split": 0.01, "inference": 1.2}
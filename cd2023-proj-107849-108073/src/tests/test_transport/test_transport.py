@@ -0,0 +1,61 @@
+import wave
+import pytest
+import transport
+from blob_store import BlobStore
+from transport import decode_payload, encode_payload, file_payload, reply_mode, result_size, save_payload
+
+@pytest.fixture(autouse=True)
+def blob_store(tmp_path, monkeypatch):
+    store = BlobStore(str(tmp_path / "blobs"))
+    monkeypatch.setattr(transport, "_store", store)
+    return store
+
+@pytest.mark.parametrize("mode", ["blob", "bytes", "base64"])
+def test_round_trip(tmp_path, mode):
+    data = bytes(range(256)) * 10
+    payload = encode_payload(data, mode)
+    assert payload["mode"] == mode
+    assert decode_payload(payload) == data
+
+    save_payload(payload, str(tmp_path / "out"))
+    assert (tmp_path / "out").read_bytes() == data
+
+def test_blob_payload_carries_a_key(blob_store):
+    payload = encode_payload(b"abc", "blob")
+    assert "data" not in payload
+    assert blob_store.get(payload["ref"]) == b"abc"
+
+def test_file_payload(tmp_path):
+    path = str(tmp_path / "song.wav")
+    frames = bytes(range(200)) * 4
+    with wave.open(path, "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(44100)
+        f.writeframes(frames)
+
+    # 4 bytes per frame
+    assert decode_payload(file_payload(path, 10, 20)) == frames[40:120]
+
+def test_legacy_base64_string():
+    assert decode_payload("YWJj") == b"abc"
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        encode_payload(b"abc", "inline")
+    with pytest.raises(ValueError):
+        decode_payload({"mode": "inline", "data": b"abc"})
+
+def test_reply_mode():
+    # workers reading the disk of the node share the blob store with the API
+    assert reply_mode(file_payload("song.wav", 0, 10)) == "blob"
+    assert reply_mode(encode_payload(b"abc", "blob")) == "blob"
+    # results of the shared queue come back the way the chunk came
+    assert reply_mode(encode_payload(b"abc", "bytes")) == "bytes"
+    assert reply_mode(encode_payload(b"abc", "base64")) == "base64"
+    assert reply_mode("YWJj") == "base64"
+
+def test_result_size():
+    assert result_size(file_payload("song.wav", 0, 10), 300, 4) == 0
+    assert result_size(encode_payload(b"abc", "bytes"), 300, 4) == 1200
+    assert result_size(encode_payload(b"abc", "base64"), 300, 4) == 1600
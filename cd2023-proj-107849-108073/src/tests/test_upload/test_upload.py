@@ -0,0 +1,44 @@
+import asyncio
+import pytest
+from upload import StreamingUpload, UploadError
+
+BOUNDARY = "b0undary"
+
+class FakeRequest:
+    def __init__(self, body: bytes, size: int, content_type: str = f"multipart/form-data; boundary={BOUNDARY}"):
+        self.headers = {"content-type": content_type}
+        self.body = body
+        self.size = size
+
+    async def stream(self):
+        for i in range(0, len(self.body), self.size):
+            yield self.body[i:i + self.size]
+
+def form(*parts) -> bytes:
+    body = b""
+    for disposition, data in parts:
+        body += f"--{BOUNDARY}\r\nContent-Disposition: form-data; {disposition}\r\n\r\n".encode() + data + b"\r\n"
+    return body + f"--{BOUNDARY}--\r\n".encode()
+
+def receive(tmp_path, body: bytes, size: int, **kwargs):
+    upload = StreamingUpload(str(tmp_path / "original.mp3"))
+    return asyncio.run(upload.receive(FakeRequest(body, size, **kwargs)))
+
+# blocks cut inside the boundaries and the headers
+@pytest.mark.parametrize("size", [1, 7, 64, 100000])
+def test_file_part(tmp_path, size):
+    data = bytes(range(256)) * 40 + b"\r\n--b0und"
+    body = form(('name="title"', b"song"), ('name="file"; filename="a.mp3"', data), ('name="other"; filename="b.mp3"', b"x"))
+    upload = receive(tmp_path, body, size)
+    assert upload.filename == "a.mp3"
+    assert upload.size == len(data)
+    # only the first file of the form is kept
+    assert (tmp_path / "original.mp3").read_bytes() == data
+
+def test_missing_file_part(tmp_path):
+    with pytest.raises(UploadError):
+        receive(tmp_path, form(('name="title"', b"song")), 16)
+
+def test_not_multipart(tmp_path):
+    with pytest.raises(UploadError):
+        receive(tmp_path, b"abc", 16, content_type="application/octet-stream")
@@ -63,3 +63,33 @@ def test_wavToMp3():
     assert "stitched.mp3" in files
     assert 34.377143 == getDuration(outputlocation+"stitched.mp3")
     pass
+
+def write_tone(path, seconds, samplerate=44100):
+    import wave
+    import numpy as np
+    t = np.arange(int(seconds * samplerate)) / samplerate
+    tone = (0.3 * np.sin(2 * np.pi * 440 * t) * 32767).astype("<i2")
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(samplerate)
+        f.writeframes(np.repeat(tone, 2).tobytes())
+
+def test_decodeToWav(tmp_path):
+    import wave
+    from ffmpeg_utils import decodeToWav
+    write_tone(tmp_path / "tone.wav", 2, samplerate=22050)
+    decodeToWav(str(tmp_path / "tone.wav"), str(tmp_path / "decoded.wav"), 44100)
+    # resampled to the model rate, in a single pass over a pipe
+    with wave.open(str(tmp_path / "decoded.wav"), "rb") as f:
+        assert (f.getframerate(), f.getnchannels(), f.getsampwidth()) == (44100, 2, 2)
+        assert abs(f.getnframes() - 2 * 44100) < 100
+    assert not (tmp_path / "decoded.wav.part").exists()
+
+def test_encodeAudio(tmp_path):
+    from ffmpeg_utils import encodeAudio, decodePcm
+    write_tone(tmp_path / "tone.wav", 2)
+    # the frames of the WAV go to ffmpeg over its stdin (PcmEncoder)
+    encodeAudio(str(tmp_path / "tone.wav"), str(tmp_path / "tone.mp3"), ["-qscale:a", "2"])
+    frames = sum(len(block) for block in decodePcm(str(tmp_path / "tone.mp3"))) // 4
+    assert 1.9 < frames / 44100 < 2.2